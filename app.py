@@ -1,84 +1,140 @@
 from datetime import datetime
-import logging
-from flask import Flask, request, jsonify
-from watchtower import CloudWatchLogHandler
-import requests
+import hmac
 import os
-from jsonschema import validate, ValidationError
-
-from utils.field_maps import FIELD_MAPS
-from utils.headers import knack_headers
-from utils.schemas import payment_reporting_schema, custom_attributes_schema
-
-KNACK_API_URL = "https://api.knack.com/v1/objects/"
-
-flask_env = os.getenv("FLASK_ENV")
-if not flask_env:
-    raise Exception("Missing defined environment variable")
-knack_env = "PRODUCTION" if flask_env == "production" else "UAT"
-
-STREET_BANNER_MESSAGES_OBJECT_ID = "object_181"
-STREET_BANNER_TRANSACTIONS_OBJECT_ID = "object_180"
-SMART_MOBILITY_MESSAGES_OBJECT_ID = "object_38"
-SMART_MOBILITY_TRANSACTIONS_OBJECT_ID = "object_39"
-
-OTS_OBJECT_ID = "object_164"
-LPB_OBJECT_ID = "object_161"
-NBP_OBJECT_ID = "object_36"
-
-# map citybase payment statuses to knack options
-payment_status_map = {
-    "successful": "PAID",
-    "voided": "VOID",
-    "refunded": "REFUND",
-}
-
-
-app = Flask(__name__)
-
-log_handler = CloudWatchLogHandler(
-    log_group_name=f"/dts/citybase/postback/{flask_env}",
-    log_stream_name=datetime.now().strftime("%Y-%m-%d"),
+import threading
+import time
+from flask import Flask, Response, abort, request, jsonify
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from utils.batch import parse_payment_reports, run_batch, summarize
+from utils.dead_letter import (
+    DEAD_LETTER_PATH,
+    DeadLetterStore,
+    start_dead_letter_worker,
+)
+from utils.deadline import DEADLINE_FALLBACK_QUEUE_PATH, DeadlineExceeded
+from utils.idempotency import IN_PROGRESS_RESPONSE, IdempotencyStore
+from utils.health import LivenessMiddleware, ReadinessProber
+from utils.knack_client import KNACK_POOL_SIZE, get_knack_client, run_concurrently
+from utils.line_items import apply_permits, combine_responses
+from utils.logging_pipeline import configure_logging, format_for_log, stop_logging
+from utils.metrics import (
+    GaugeCallback,
+    last_knack_responses,
+    postback_seconds,
+    postback_stage_seconds,
+    postbacks_total,
+    registry,
 )
-logging.basicConfig(level=logging.INFO)
-logging.getLogger().addHandler(log_handler)
+from utils.postback import (
+    HANDLERS,
+    REFUND_RECORD_FIELDS,
+    create_message_json,
+    create_parent_reservation_payloads,
+    create_refund_payload,
+    flask_env,
+    get_handler,
+    get_permits,
+    get_validators,
+    message_rules,
+    refund_rules,
+    unpack_custom_attributes,
+    validate_postback,
+)
+from utils.postback_queue import (
+    POSTBACK_QUEUE_PATH,
+    PostbackQueue,
+    start_queue_workers,
+)
+from utils.request_body import (
+    BATCH_MAX_BODY_BYTES,
+    POSTBACK_MAX_BODY_BYTES,
+    loads,
+)
+from utils.shutdown import drain
+from utils.tracing import RingBufferExporter, current_span, span, start_trace, tracer
 
+# bearer token for the /admin routes, which are disabled while it is unset
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
-def unpack_custom_attributes(custom_attributes_list):
+app = Flask(__name__)
+# upper bound for every route, /citybase_postback lowers it to POSTBACK_MAX_BODY_BYTES
+app.config["MAX_CONTENT_LENGTH"] = BATCH_MAX_BODY_BYTES
+# GET /healthz is answered before flask, see utils/health.py
+app.wsgi_app = LivenessMiddleware(app.wsgi_app)
+# created by warm_up in each worker, sqlite connections and threads don't survive a fork
+# responses already sent to citybase, keyed by (citybase id, payment status)
+idempotency_store = None
+postback_queue = None
+# postbacks that ran out of time, when they aren't all queued already
+deadline_queue = None
+dead_letter_store = None
+readiness_prober = None
+_warmed_up = False
+_warm_up_lock = threading.Lock()
+
+
+def warm_up():
     """
-    :param custom_attributes_list: list of dicts {"key":"key_name", "object":"value"} from citybase
-    :return: dictionary of "key_name":"value" pairs
+    Starts the log flusher, compiles the validators, opens the Knack clients and the
+    idempotency store and starts the postback queue and dead letter workers. Nothing is done at import, so a worker
+    boots fast and gunicorn can preload the app before forking. Called from the
+    post_fork hook in gunicorn.conf.py, or by the first request. Only runs once.
     """
-    custom_attributes = {}
-    for a in custom_attributes_list:
-        custom_attributes.update({a["key"]: a["value"]})
-    return custom_attributes
-
-
-def get_object_ids(knack_app):
-    """Returns messages table and transactions table object_ids based on knack app input"""
-    if knack_app == "STREET_BANNER":
-        return STREET_BANNER_MESSAGES_OBJECT_ID, STREET_BANNER_TRANSACTIONS_OBJECT_ID
-    if knack_app == "SMART_MOBILITY":
-        return SMART_MOBILITY_MESSAGES_OBJECT_ID, SMART_MOBILITY_TRANSACTIONS_OBJECT_ID
-    else:
-        raise ValueError(
-            f"Incorrect knack app {knack_app}, must be STREET_BANNER or SMART_MOBILITY"
+    global idempotency_store, postback_queue, deadline_queue, dead_letter_store
+    global readiness_prober, _warmed_up
+    if _warmed_up:
+        return
+    with _warm_up_lock:
+        if _warmed_up:
+            return
+        start = time.perf_counter()
+        configure_logging(flask_env)
+        get_validators()
+        for knack_app in HANDLERS:
+            get_knack_client(knack_app)
+        idempotency_store = IdempotencyStore()
+        if POSTBACK_QUEUE_PATH:
+            postback_queue = PostbackQueue(POSTBACK_QUEUE_PATH)
+            drain.on_stop(
+                start_queue_workers(
+                    postback_queue,
+                    lambda citybase_data, received_date, attempts: apply_queued_postback(
+                        citybase_data, received_date, replay=attempts > 1
+                    ),
+                ).set
+            )
+        elif DEADLINE_FALLBACK_QUEUE_PATH:
+            deadline_queue = PostbackQueue(DEADLINE_FALLBACK_QUEUE_PATH)
+            # these ran out of time once already, so every one is a replay
+            drain.on_stop(
+                start_queue_workers(
+                    deadline_queue,
+                    lambda citybase_data, received_date, attempts: apply_queued_postback(
+                        citybase_data, received_date, replay=True
+                    ),
+                ).set
+            )
+        if DEAD_LETTER_PATH:
+            dead_letter_store = DeadLetterStore(DEAD_LETTER_PATH)
+            drain.on_stop(
+                start_dead_letter_worker(dead_letter_store, retry_dead_letter).set
+            )
+        readiness_prober = ReadinessProber(
+            collect_readiness,
+            list(HANDLERS),
+            last_knack_responses,
+            probe_knack,
+            lambda: drain.stopping,
         )
+        drain.on_stop(readiness_prober.start().set)
+        _warmed_up = True
+    app.logger.info(f"Worker warmed up in {time.perf_counter() - start:.3f}s")
 
 
-def create_knack_payload(payment_status, today_date, knack_app):
-    """
-    :param payment_status: info from citybase payload
-    :param today_date: mm/dd/YYYY H:M datetime string
-    :param knack_app: SMART_MOBILITY or STREET_BANNER to select correct fields
-    :return: json object to send along with PUT call to knack
-    """
-    knack_fields = FIELD_MAPS.get(knack_app).get(knack_env).get("TRANSACTIONS")
-    return {
-        knack_fields["transaction_status"]: payment_status_map[payment_status],
-        knack_fields["transaction_paid_date"]: today_date,
-    }
+@app.before_request
+def ensure_warmed_up():
+    warm_up()
 
 
 def get_knack_refund_payload(
@@ -87,7 +143,7 @@ def get_knack_refund_payload(
     knack_invoice,
     today_date,
     knack_record_id,
-    headers,
+    knack_client,
     transactions_object_id,
     knack_app,
 ):
@@ -97,134 +153,75 @@ def get_knack_refund_payload(
     :param knack_invoice: info from citybase payload
     :param today_date: mm/dd/YYYY H:M datetime string
     :param knack_record_id: transaction record id
-    :param headers: headers for knack_app to complete request
+    :param knack_client: KnackClient for knack_app to complete request
     :param transactions_object_id: object_id to use in get request
     :param knack_app: SMART_MOBILITY or STREET_BANNER to select correct fields
     :return: json object to insert into transactions table in knack
     """
 
-    knack_fields = FIELD_MAPS.get(knack_app).get(knack_env).get("TRANSACTION_REFUND")
-    knack_fields.update(FIELD_MAPS.get(knack_app).get(knack_env).get("TRANSACTIONS"))
-    record_response = requests.get(
-        f"{KNACK_API_URL}{transactions_object_id}/records/{knack_record_id}",
-        headers=headers,
+    record_data = knack_client.get_record(
+        transactions_object_id, knack_record_id, REFUND_RECORD_FIELDS[knack_app]
     )
-    record_response.raise_for_status()
-    record_data = record_response.json()
     app.logger.info(
-        f"Complete transaction refund record data from knack: {record_data}"
+        f"Transaction refund record data from knack: {format_for_log(record_data)}"
+    )
+    return create_refund_payload(
+        record_data,
+        payment_status,
+        payment_amount,
+        knack_invoice,
+        today_date,
+        knack_app,
     )
-
-    # the connection record id is in the format "field_3326": "<span class=\"638e58b31370e500241c3388\">486</span>",
-    # using the raw form of the field to get the identifier.
-    try:
-        lpb_connection_id = record_data[
-            f'{knack_fields["banner_reservations_lpb"]}_raw'
-        ][0]["identifier"]
-    except IndexError:
-        lpb_connection_id = None
-
-    try:
-        ots_connection_id = record_data[
-            f'{knack_fields["banner_reservations_ots"]}_raw'
-        ][0]["identifier"]
-    except IndexError:
-        ots_connection_id = None
-
-    return {
-        knack_fields["transaction_status"]: payment_status_map[payment_status],
-        knack_fields["invoice_id"]: knack_invoice,
-        # if it is a refund, store negative amount
-        knack_fields["total_amount"]: f"-{payment_amount}",
-        knack_fields["created_date"]: today_date,
-        knack_fields["transaction_paid_date"]: today_date,
-        knack_fields["customer_name"]: record_data[knack_fields["customer_name"]],
-        knack_fields["event_name"]: record_data[knack_fields["event_name"]],
-        knack_fields["type"]: record_data[knack_fields["type"]],
-        knack_fields["banner_reservations_lpb"]: lpb_connection_id,
-        knack_fields["banner_reservations_ots"]: ots_connection_id,
-        knack_fields["sub_description"]: record_data[knack_fields["sub_description"]],
-    }
 
 
-def create_message_json(
-    citybase_id, today_date, knack_invoice, payment_status, knack_app
+def update_parent_reservation(
+    today_date, parent_record_id, parent_key_value, knack_client, knack_app
 ):
     """
-    :param citybase_id: citybase transaction id
-    :param today_date: mm/dd/YYYY H:M datetime string
-    :param knack_invoice: info from citybase payload
-    :param payment_status: info from citybase payload
-    :param knack_app: SMART_MOBILITY or STREET_BANNER to select correct fields
-    :return: json object to insert in knack citybase_messages table
+    Updates the parent reservation records picked by parent_key_value (the banner type
+    for street banners) in knack
+    Sets payment received status as TRUE, application as Approved and payment date as today
+    :return: list of (object_id, payload, response) for each record updated
     """
-    knack_fields = FIELD_MAPS.get(knack_app).get(knack_env).get("MESSAGES")
+    updates = []
+    for object_id, payload in create_parent_reservation_payloads(
+        today_date, parent_key_value, knack_app
+    ):
+        parent_update_response = knack_client.put(object_id, parent_record_id, payload)
+        app.logger.info(f"Update parent reservation response: {parent_update_response}")
+        updates.append((object_id, payload, parent_update_response))
+    return updates
 
-    return {
-        knack_fields["messages_invoice_id"]: knack_invoice,
-        knack_fields["messages_connected_invoice"]: knack_invoice,
-        knack_fields["messages_created_date"]: today_date,
-        knack_fields["messages_status"]: payment_status,
-        knack_fields["messages_citybase_id"]: citybase_id,
-    }
 
+def get_write_error(result):
+    """Returns why a knack write failed, from its response or exception, or None if it succeeded"""
+    if isinstance(result, Exception):
+        return repr(result)
+    if result.status_code != 200:
+        return f"{result.status_code}: {result.text}"
+    return None
 
-def update_parent_reservation(
-    today_date, parent_record_id, banner_type, headers, knack_app
-):
+
+def dead_letter_steps(citybase_id, knack_app, failed_steps):
     """
-    Checks banner_type and updates appropriate parent reservation record in knack
-    Sets payment received status as TRUE, application as Approved and payment date as today
+    Stores knack writes that failed after the postback's message was written so the
+    dead letter worker resends them, instead of citybase redelivering the whole postback
+    :param failed_steps: list of dicts of DeadLetterStore.add arguments
+    :return: response body and status code to send to citybase
     """
-    if knack_app == "SMART_MOBILITY":
-        knack_fields = (
-            FIELD_MAPS.get("SMART_MOBILITY").get(knack_env).get("BLOCK_PARTY")
-        )
-        nbp_payload = {
-            knack_fields["application_status"]: "Complete - Permit Issued",
-            knack_fields["payment_received"]: True,
-            knack_fields["payment_date"]: today_date,
-        }
-        parent_update_response = requests.put(
-            f"{KNACK_API_URL}{NBP_OBJECT_ID}/records/{parent_record_id}",
-            headers=headers,
-            json=nbp_payload,
+    for failed_step in failed_steps:
+        entry_id = dead_letter_store.add(citybase_id, knack_app, **failed_step)
+        app.logger.error(
+            f"{citybase_id} - {failed_step['step']} failed, stored as dead letter {entry_id}: {failed_step['error']}"
         )
-        app.logger.info(f"Update parent reservation response: {parent_update_response}")
-    if banner_type == "OVER_THE_STREET":
-        knack_fields = (
-            FIELD_MAPS.get("STREET_BANNER").get(knack_env).get("OVER_THE_STREET")
-        )
-        ots_payload = {
-            knack_fields["ots_application_status"]: "Approved",
-            knack_fields["ots_payment_received"]: True,
-            knack_fields["ots_payment_date"]: today_date,
-        }
-        parent_update_response = requests.put(
-            f"{KNACK_API_URL}{OTS_OBJECT_ID}/records/{parent_record_id}",
-            headers=headers,
-            json=ots_payload,
-        )
-        app.logger.info(f"Update parent reservation response: {parent_update_response}")
-    elif banner_type == "LAMPPOST":
-        knack_fields = FIELD_MAPS.get("STREET_BANNER").get(knack_env).get("LAMPPOST")
-        lpb_payload = {
-            knack_fields["lpb_application_status"]: "Approved",
-            knack_fields["lpb_payment_received"]: True,
-            knack_fields["lpb_payment_date"]: today_date,
-        }
-        parent_update_response = requests.put(
-            f"{KNACK_API_URL}{LPB_OBJECT_ID}/records/{parent_record_id}",
-            headers=headers,
-            json=lpb_payload,
-        )
-        app.logger.info(f"Update parent reservation response: {parent_update_response}")
+    return "Payment status accepted", 202
 
 
 @app.route("/")
 def index():
+    # no log line, load balancer probes would flood the logs
     now = datetime.now().isoformat()
-    app.logger.info(f"Health check at {now}")
     payload = {
         "message": "Austin Transportation Public Works Department Citybase health check",
         "status": "OK",
@@ -234,6 +231,55 @@ def index():
     return jsonify(payload)
 
 
+@app.route("/readyz")
+def readiness():
+    """Readiness report cached by the readiness prober, 503 while the worker shouldn't get traffic"""
+    ready = readiness_prober.ready and not drain.stopping
+    return Response(
+        readiness_prober.body,
+        status=200 if ready else 503,
+        mimetype="application/json",
+    )
+
+
+def collect_readiness():
+    """Local counters for the readiness report, refreshed by the readiness prober"""
+    busy = drain.requests_in_flight()
+    knack_pool = {}
+    for knack_app in HANDLERS:
+        in_use, size = get_knack_client(knack_app).pool_usage()
+        knack_pool[knack_app] = {"in_use": in_use, "size": size}
+    queues = {}
+    if postback_queue is not None:
+        queues["postbacks"] = postback_queue.counts()
+    if deadline_queue is not None:
+        queues["deadline"] = deadline_queue.counts()
+    if dead_letter_store is not None:
+        queues["dead_letters"] = dead_letter_store.counts()
+    return {
+        # KNACK_POOL_SIZE is kept equal to gunicorn --threads
+        "threads": {
+            "busy": busy,
+            "total": KNACK_POOL_SIZE,
+            "utilisation": busy / KNACK_POOL_SIZE,
+        },
+        "knack_pool": knack_pool,
+        "queues": queues,
+    }
+
+
+def probe_knack(knack_app):
+    """Reads one message record of knack_app, its response is recorded in last_knack_responses"""
+    get_knack_client(knack_app).request(
+        "GET", HANDLERS[knack_app].messages_object_id, params={"rows_per_page": 1}
+    )
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.errorhandler(500)
 def internal_server_error(e):
     # Log the error with more context
@@ -244,95 +290,492 @@ def internal_server_error(e):
 @app.route("/citybase_postback", methods=["POST"])
 def handle_postback():
     today_date = datetime.now().strftime("%m/%d/%Y %H:%M")
-    citybase_data = request.get_json()
+    if not request.is_json:
+        postbacks_total.inc(status_code=415)
+        abort(415)
+    # a larger Content-Length is answered with a 413 before anything is read
+    request.max_content_length = POSTBACK_MAX_BODY_BYTES
+    try:
+        body = request.get_data(cache=False)
+        # a chunked body is cut at the limit instead, reading past it raises the 413
+        request.stream.read(1)
+    except RequestEntityTooLarge:
+        postbacks_total.inc(status_code=413)
+        raise
+    try:
+        with postback_stage_seconds.time(stage="json_parse"):
+            citybase_data = loads(body)
+    except ValueError as e:
+        app.logger.error(f"Malformed JSON: {e}")
+        postbacks_total.inc(status_code=400)
+        return "Malformed JSON", 400
     # information from citybase payload
-    app.logger.info(f"New POST with payload: {citybase_data}")
+    app.logger.info(f"New POST with payload: {format_for_log(citybase_data)}")
+
+    custom_attributes, error_response = validate_postback(citybase_data, app.logger)
+    if error_response is not None:
+        postbacks_total.inc(status_code=error_response[1])
+        return error_response
 
+    response = None
     try:
-        validate(citybase_data, payment_reporting_schema)
-    except ValidationError as e:
-        app.logger.error(f"Validation error: {e}")
-        return f"Validation error: {e.message}", 400
+        response = process_postback(citybase_data, custom_attributes, today_date)
+    finally:
+        postbacks_total.inc(
+            knack_app=custom_attributes["knack_app"],
+            payment_status=citybase_data["data"]["status"],
+            status_code=response[1] if response is not None else 500,
+        )
+    return response
 
-    custom_attributes = unpack_custom_attributes(
-        citybase_data["data"]["custom_attributes"]
+
+@app.route("/citybase_postback/batch", methods=["POST"])
+def handle_postback_batch():
+    """
+    Replays many citybase payment reports at once, sent as a JSON array or as
+    newline delimited JSON (application/x-ndjson). Responds with a result per report.
+    Needs the ADMIN_TOKEN, a batch can be large and fans out into many Knack writes
+    """
+    # checked before the body is read
+    require_admin()
+    today_date = datetime.now().strftime("%m/%d/%Y %H:%M")
+    body = request.get_data(cache=False)
+    request.stream.read(1)
+    try:
+        reports = parse_payment_reports(body, request.content_type or "")
+    except ValueError as e:
+        app.logger.error(f"Malformed batch: {e}")
+        return f"Malformed batch: {e}", 400
+    app.logger.info(f"New batch POST with {len(reports)} payment reports")
+
+    results = run_batch(
+        reports,
+        lambda report: validate_postback(report, app.logger),
+        lambda report, custom_attributes: process_postback(
+            report, custom_attributes, today_date
+        ),
+    )
+    summary = summarize(results)
+    app.logger.info(f"Batch of {len(reports)} payment reports processed: {summary}")
+    return jsonify({"summary": summary, "results": results})
+
+
+def require_admin(enabled=True):
+    """
+    Hides the admin routes unless ADMIN_TOKEN is set and the request carries it as a bearer token
+    :param enabled: False when the route's feature isn't configured, which also hides it
+    """
+    if not ADMIN_TOKEN or not enabled:
+        abort(404)
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}"):
+        abort(401)
+
+
+@app.route("/admin/dead_letters")
+def list_dead_letters():
+    require_admin(dead_letter_store is not None)
+    entries = dead_letter_store.list(
+        request.args.get("state"), request.args.get("limit", 100, type=int)
     )
+    return jsonify({"counts": dead_letter_store.counts(), "entries": entries})
+
+
+@app.route("/admin/dead_letters/retry", methods=["POST"])
+def retry_dead_letters():
+    """Retries every failed dead letter now, or only the one given as ?id="""
+    require_admin(dead_letter_store is not None)
+    retried = dead_letter_store.retry(request.args.get("id", type=int))
+    app.logger.info(f"{retried} dead letters requeued")
+    return jsonify({"retried": retried})
+
+
+@app.route("/admin/dead_letters/purge", methods=["POST"])
+def purge_dead_letters():
+    """Deletes the dead letter given as ?id=, or every one in ?state= (done by default)"""
+    require_admin(dead_letter_store is not None)
+    purged = dead_letter_store.purge(
+        request.args.get("id", type=int), request.args.get("state", "done")
+    )
+    app.logger.info(f"{purged} dead letters purged")
+    return jsonify({"purged": purged})
+
+
+@app.route("/admin/traces")
+def list_traces():
+    """
+    Sampled postback traces of the worker that answers, newest first. ?min_ms= keeps
+    the slower ones, ?knack_app=, ?payment_status= and ?name= filter on the root span
+    """
+    ring_buffer = tracer.find_exporter(RingBufferExporter)
+    require_admin(ring_buffer is not None)
+    min_ms = request.args.get("min_ms", 0, type=float)
+    filters = {
+        key: request.args[key]
+        for key in ("knack_app", "payment_status")
+        if key in request.args
+    }
+    name = request.args.get("name")
+    traces = [
+        trace
+        for trace in ring_buffer.recent()
+        if trace["duration_ms"] >= min_ms
+        and (name is None or trace["name"] == name)
+        and all(trace["attributes"].get(key) == value for key, value in filters.items())
+    ]
+    return jsonify({"traces": traces[: request.args.get("limit", 100, type=int)]})
+
+
+def process_postback(citybase_data, custom_attributes, today_date):
+    """
+    Queues a validated postback, or applies it to Knack unless it was applied before.
+    Sampled postbacks are traced, see utils/tracing.py
+    :return: response body and status code to send to citybase
+    """
+    with start_trace(
+        "postback",
+        citybase_id=citybase_data["data"]["id"],
+        knack_app=custom_attributes["knack_app"],
+        payment_status=citybase_data["data"]["status"],
+        line_items=len(citybase_data["data"]["line_items"]),
+    ) as trace:
+        response = _process_postback(citybase_data, custom_attributes, today_date)
+        trace.set(status_code=response[1])
+    return response
+
+
+def _process_postback(citybase_data, custom_attributes, today_date):
+    if postback_queue is not None:
+        citybase_id = citybase_data["data"]["id"]
+        if postback_queue.enqueue(citybase_data, today_date):
+            app.logger.info(f"{citybase_id} - Postback queued")
+        else:
+            app.logger.info(f"{citybase_id} - Postback already queued, ignoring")
+        return "Payment status accepted", 202
+
+    if drain.stopping:
+        # citybase redelivers it to the worker that replaces this one
+        app.logger.info(
+            f"{citybase_data['data']['id']} - Worker stopping, postback refused"
+        )
+        return "Service restarting, retry later", 503
+
+    idempotency_key = (citybase_data["data"]["id"], citybase_data["data"]["status"])
+    previous_response = idempotency_store.begin(idempotency_key)
+    if previous_response is not None:
+        if previous_response is IN_PROGRESS_RESPONSE:
+            app.logger.warning(
+                f"{idempotency_key[0]} - Duplicate postback, original still in progress"
+            )
+        else:
+            app.logger.info(
+                f"{idempotency_key[0]} - Duplicate postback, returning original response"
+            )
+        return previous_response
+    # a delivery that failed may have written part of the postback before it gave up
+    replay = idempotency_store.failed_before(idempotency_key)
+
+    response = None
+    start = time.perf_counter()
     try:
-        validate(custom_attributes, custom_attributes_schema)
-    except ValidationError as e:
-        app.logger.error(f"Custom attributes error: {e}")
-        return f"Malformed custom attributes: {e.message}", 400
+        with drain.track():
+            response = apply_postback(
+                citybase_data, custom_attributes, today_date, replay
+            )
+    except DeadlineExceeded as e:
+        response = queue_late_postback(citybase_data, today_date, e)
+    finally:
+        postback_seconds.observe(
+            time.perf_counter() - start,
+            knack_app=custom_attributes["knack_app"],
+            payment_status=citybase_data["data"]["status"],
+        )
+        # only remember successful responses so a failed postback is retried in full
+        idempotency_store.finish(
+            idempotency_key,
+            response if response is not None and response[1] < 300 else None,
+        )
+    return response
+
 
+def queue_late_postback(citybase_data, today_date, error):
+    """
+    Hands a postback that ran out of time to the deadline queue, whose workers apply it
+    again in full without a deadline
+    :return: response body and status code to send to citybase
+    """
+    citybase_id = citybase_data["data"]["id"]
+    if deadline_queue is None:
+        app.logger.error(f"{citybase_id} - Postback deadline exceeded: {error}")
+        return "Knack did not respond in time", 504
+    deadline_queue.enqueue(citybase_data, today_date)
+    app.logger.warning(
+        f"{citybase_id} - Postback deadline exceeded, queued to finish later: {error}"
+    )
+    return "Payment status accepted", 202
+
+
+def apply_postback(citybase_data, custom_attributes, today_date, replay=False):
+    """
+    Writes a validated citybase postback to Knack. A payment whose line items pay for
+    several permits is applied one permit at a time, see utils/line_items.py
+    :param citybase_data: payload from citybase
+    :param custom_attributes: unpacked and validated custom attributes
+    :param today_date: mm/dd/YYYY H:M datetime string
+    :param replay: True when an earlier attempt may have written to Knack, see apply_permit
+    :return: response body and status code to send to citybase
+    """
+    permits = get_permits(citybase_data, custom_attributes, app.logger)
+    current_span().set(permits=len(permits) or 1)
+    if not permits:
+        return apply_permit(
+            citybase_data,
+            custom_attributes,
+            today_date,
+            citybase_data["data"]["total_amount"],
+            replay,
+        )
+    citybase_id = citybase_data["data"]["id"]
+    payment_status = citybase_data["data"]["status"]
+    app.logger.info(f"{citybase_id} - Payment for {len(permits)} permits")
+
+    def apply_line_item(permit):
+        # a redelivery after a partial failure skips the permits already applied
+        idempotency_key = (citybase_id, payment_status, permit.line_item_id)
+        previous_response = idempotency_store.begin(idempotency_key)
+        if previous_response is not None:
+            app.logger.info(
+                f"{citybase_id} - Line item {permit.line_item_id} already applied"
+            )
+            return previous_response
+        response = None
+        try:
+            with span("permit", line_item_id=permit.line_item_id) as permit_span:
+                response = apply_permit(
+                    citybase_data,
+                    permit.custom_attributes,
+                    today_date,
+                    permit.payment_amount,
+                    replay,
+                )
+                permit_span.set(status_code=response[1])
+        finally:
+            idempotency_store.finish(
+                idempotency_key,
+                response if response is not None and response[1] < 300 else None,
+            )
+        return response
+
+    return combine_responses(apply_permits(permits, apply_line_item), app.logger)
+
+
+def apply_permit(
+    citybase_data, custom_attributes, today_date, payment_amount, replay=False
+):
+    """
+    Writes one permit of a validated citybase postback to Knack
+    :param custom_attributes: the permit's custom attributes
+    :param payment_amount: dollars paid for the permit, stored negated on refunds
+    :param replay: True when an earlier attempt may have written to Knack. A POST that
+        timed out may still have created its record, so the message and refund record
+        are then searched for and only inserted if they aren't found. PUTs are sent again
+    :return: response body and status code
+    """
     knack_record_id = custom_attributes.get("knack_record_id")
     knack_invoice = custom_attributes.get("invoice_number")
     knack_app = custom_attributes.get("knack_app")
-    banner_type = (
-        custom_attributes.get("banner_type") if knack_app == "STREET_BANNER" else None
-    )
+    handler = get_handler(knack_app)
+    # banner type for street banners, None for apps with one kind of parent record
+    parent_key_value = handler.get_parent_key_value(custom_attributes)
     parent_record_id = custom_attributes.get("parent_record_id")
     payment_status = citybase_data["data"]["status"]
-    payment_amount = citybase_data["data"]["total_amount"]
     citybase_id = citybase_data["data"]["id"]
     app.logger.info(
         f"{citybase_id} - Payment status: {payment_status}, invoice number: {knack_invoice}"
     )
 
-    headers = knack_headers(knack_app)
-    messages_object_id, transactions_object_id = get_object_ids(knack_app)
+    knack_client = get_knack_client(knack_app)
+    messages_object_id = handler.messages_object_id
+    transactions_object_id = handler.transactions_object_id
 
-    # update the messages table
     message_payload = create_message_json(
         citybase_id, today_date, knack_invoice, payment_status, knack_app
     )
-    app.logger.info(
-        f"{citybase_id} - Updating Knack messages table with payload: {message_payload}"
-    )
-    r = requests.post(
-        f"{KNACK_API_URL}{messages_object_id}/records/",
-        headers=headers,
-        json=message_payload,
+
+    def update_messages():
+        if replay and knack_client.find_record(
+            messages_object_id,
+            message_rules(citybase_id, payment_status, knack_invoice, knack_app),
+        ):
+            app.logger.info(
+                f"{citybase_id} - Message already in Knack, not written again"
+            )
+            return
+        app.logger.info(
+            f"{citybase_id} - Updating Knack messages table with payload: {message_payload}"
+        )
+        r = knack_client.post(messages_object_id, message_payload)
+        app.logger.info(f"{citybase_id} - Response from updating messages table: {r}")
+        r.raise_for_status()
+
+    # if the app records refunds as new transactions (street banners), post a new record
+    # to the knack transactions table
+    refund_creates_record = (
+        payment_status == "refunded" and handler.refund_creates_record
     )
-    app.logger.info(f"{citybase_id} - Response from updating messages table: {r}")
-    r.raise_for_status()
-
-    # if a refund from Banners, post a new record to Street Banner knack transactions table
-    if payment_status == "refunded" and knack_app == "STREET_BANNER":
-        knack_payload = get_knack_refund_payload(
-            payment_status,
-            payment_amount,
-            knack_invoice,
-            today_date,
-            knack_record_id,
-            headers,
-            transactions_object_id,
-            knack_app,
+    current_span().set(refund_record=refund_creates_record)
+    if refund_creates_record:
+        refund_context = {
+            "payment_status": payment_status,
+            "payment_amount": payment_amount,
+            "knack_invoice": knack_invoice,
+            "today_date": today_date,
+            "knack_record_id": knack_record_id,
+        }
+        # the transaction record is read while the message is written, but the refund
+        # record is only inserted once the message succeeded since the insert isn't idempotent
+        message_result, knack_payload = run_concurrently(
+            update_messages,
+            lambda: get_knack_refund_payload(
+                knack_client=knack_client,
+                transactions_object_id=transactions_object_id,
+                knack_app=knack_app,
+                **refund_context,
+            ),
+            return_exceptions=True,
         )
+        if isinstance(message_result, Exception):
+            raise message_result
+        if isinstance(knack_payload, Exception):
+            if dead_letter_store is None:
+                raise knack_payload
+            # the refund record is built by the retry once the transaction can be read
+            return dead_letter_steps(
+                citybase_id,
+                knack_app,
+                [
+                    {
+                        "step": "refund_record",
+                        "method": "POST",
+                        "object_id": transactions_object_id,
+                        "record_id": "",
+                        "payload": None,
+                        "error": get_write_error(knack_payload),
+                        "context": refund_context,
+                    }
+                ],
+            )
+        if replay and knack_client.find_record(
+            transactions_object_id,
+            refund_rules(knack_invoice, payment_amount, today_date, knack_app),
+        ):
+            app.logger.info(
+                f"{citybase_id} - Refund transaction already in Knack, not inserted again"
+            )
+            return "Payment status updated", 200
         app.logger.info(
             f"{citybase_id} - Transaction is refund, creating new transaction record: {knack_payload}"
         )
-        knack_response = requests.post(
-            f"{KNACK_API_URL}{transactions_object_id}/records/",
-            headers=headers,
-            json=knack_payload,
-        )
+        try:
+            knack_response = knack_client.post(transactions_object_id, knack_payload)
+        except Exception as e:
+            if dead_letter_store is None:
+                raise
+            knack_response = e
         app.logger.info(
             f"{citybase_id} - Refund transaction update response {knack_response}"
         )
+        error = get_write_error(knack_response)
+        if error is not None and dead_letter_store is not None:
+            return dead_letter_steps(
+                citybase_id,
+                knack_app,
+                [
+                    {
+                        "step": "refund_record",
+                        "method": "POST",
+                        "object_id": transactions_object_id,
+                        "record_id": "",
+                        "payload": knack_payload,
+                        "error": error,
+                        "context": refund_context,
+                    }
+                ],
+            )
     # otherwise, update existing record payment status on transactions table
     else:
-        app.logger.info(f"{citybase_id} - Updating existing transaction record")
-        knack_payload = create_knack_payload(payment_status, today_date, knack_app)
+        knack_payload = handler.transaction_payload(payment_status, today_date)
+
+        def update_transaction():
+            app.logger.info(f"{citybase_id} - Updating existing transaction record")
+            return knack_client.put(
+                transactions_object_id, knack_record_id, knack_payload
+            )
+
+        # these are all PUTs to different records or a message insert, none depends on
+        # another so they are sent together. a citybase retry after a partial failure
+        # repeats the same PUTs
+        calls = [update_transaction, update_messages]
         if payment_status == "successful":
             # if this was a successful payment we also need to update reservation record
             app.logger.info(f"{citybase_id} - Updating parent reservation")
-            update_parent_reservation(
-                today_date, parent_record_id, banner_type, headers, knack_app
+            calls.append(
+                lambda: update_parent_reservation(
+                    today_date,
+                    parent_record_id,
+                    parent_key_value,
+                    knack_client,
+                    knack_app,
+                )
             )
-        knack_response = requests.put(
-            f"{KNACK_API_URL}{transactions_object_id}/records/{knack_record_id}",
-            headers=headers,
-            json=knack_payload,
-        )
+        results = run_concurrently(*calls, return_exceptions=True)
+        knack_response, message_result = results[:2]
+        if dead_letter_store is None or isinstance(message_result, Exception):
+            # nothing to resume from, fail the postback so citybase redelivers it
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        else:
+            failed_steps = []
+            error = get_write_error(knack_response)
+            if error is not None:
+                failed_steps.append(
+                    {
+                        "step": "transaction",
+                        "method": "PUT",
+                        "object_id": transactions_object_id,
+                        "record_id": knack_record_id,
+                        "payload": knack_payload,
+                        "error": error,
+                    }
+                )
+            if len(results) > 2:
+                parent_result = results[2]
+                if isinstance(parent_result, Exception):
+                    # which updates went through is unknown, resending a PUT is harmless
+                    parent_updates = [
+                        (object_id, payload, parent_result)
+                        for object_id, payload in create_parent_reservation_payloads(
+                            today_date, parent_key_value, knack_app
+                        )
+                    ]
+                else:
+                    parent_updates = parent_result
+                for object_id, payload, response in parent_updates:
+                    error = get_write_error(response)
+                    if error is not None:
+                        failed_steps.append(
+                            {
+                                "step": "parent_reservation",
+                                "method": "PUT",
+                                "object_id": object_id,
+                                "record_id": parent_record_id,
+                                "payload": payload,
+                                "error": error,
+                            }
+                        )
+            if failed_steps:
+                return dead_letter_steps(citybase_id, knack_app, failed_steps)
         app.logger.info(
             f"{citybase_id} - Successful payment transaction update response {knack_response}"
         )
@@ -345,6 +788,119 @@ def handle_postback():
     return knack_response.text, knack_response.status_code
 
 
+def retry_dead_letter(entry):
+    """
+    Resends one failed knack write from the dead letter store
+    :return: response body and status code from knack
+    """
+    with drain.track(0, background=True), start_trace(
+        "dead_letter",
+        citybase_id=entry["citybase_id"],
+        knack_app=entry["knack_app"],
+        step=entry["step"],
+    ) as trace:
+        response = _resend_dead_letter(entry)
+        trace.set(status_code=response[1])
+    return response
+
+
+def _resend_dead_letter(entry):
+    knack_client = get_knack_client(entry["knack_app"])
+    if entry["step"] == "refund_record" and knack_client.find_record(
+        entry["object_id"],
+        refund_rules(
+            entry["context"]["knack_invoice"],
+            entry["context"]["payment_amount"],
+            entry["context"]["today_date"],
+            entry["knack_app"],
+        ),
+    ):
+        # the insert that failed timed out or got a server error after all
+        return "Refund transaction already in Knack", 200
+    payload = entry["payload"]
+    if payload is None:
+        # the transaction being refunded couldn't be read when the postback arrived
+        payload = get_knack_refund_payload(
+            knack_client=knack_client,
+            transactions_object_id=entry["object_id"],
+            knack_app=entry["knack_app"],
+            **entry["context"],
+        )
+    if entry["method"] == "PUT":
+        response = knack_client.put(entry["object_id"], entry["record_id"], payload)
+    else:
+        response = knack_client.post(entry["object_id"], payload)
+    return response.text, response.status_code
+
+
+def apply_queued_postback(citybase_data, received_date, replay=False):
+    """
+    Applies a postback that was validated and queued by handle_postback. It has no
+    deadline, but one left unfinished when the worker stops goes back to the queue
+    :param replay: True when an earlier attempt may have written to Knack, see apply_permit
+    """
+    custom_attributes = unpack_custom_attributes(
+        citybase_data["data"]["custom_attributes"]
+    )
+    with drain.track(0, background=True), start_trace(
+        "queued_postback",
+        citybase_id=citybase_data["data"]["id"],
+        knack_app=custom_attributes["knack_app"],
+        payment_status=citybase_data["data"]["status"],
+        line_items=len(citybase_data["data"]["line_items"]),
+    ) as trace:
+        response = apply_postback(
+            citybase_data, custom_attributes, received_date, replay
+        )
+        trace.set(status_code=response[1])
+    return response
+
+
+def shut_down(timeout):
+    """
+    Waits for the postbacks drain.begin() cut short to finish or be handed off, then
+    flushes buffered logs. Called from the worker_exit hook in gunicorn.conf.py
+    :param timeout: seconds to wait for postbacks still in flight
+    """
+    in_flight = drain.wait(timeout)
+    if in_flight:
+        app.logger.error(f"Worker exiting with {in_flight} postbacks still in flight")
+    else:
+        app.logger.info("Worker drained, exiting")
+    stop_logging()
+
+
+registry.register(
+    GaugeCallback(
+        "citybase_postback_queue_entries",
+        "Queued postbacks per state",
+        lambda: (
+            [
+                ({"state": state}, count)
+                for state, count in postback_queue.counts().items()
+            ]
+            if postback_queue is not None
+            else []
+        ),
+    )
+)
+registry.register(
+    GaugeCallback(
+        "citybase_dead_letter_entries",
+        "Dead lettered Knack writes per state",
+        lambda: (
+            [
+                ({"state": state}, count)
+                for state, count in dead_letter_store.counts().items()
+            ]
+            if dead_letter_store is not None
+            else []
+        ),
+    )
+)
+
+
 if __name__ == "__main__":
     use_debug = flask_env == "development"
+    warm_up()
     app.run(debug=use_debug, host="0.0.0.0")
@@ -0,0 +1,394 @@
+"""
+Async variant of the postback service, run with uvicorn:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+Serves the same routes as app.py with the same validation and Knack writes, but Knack
+calls don't hold a thread while waiting, so one worker can keep hundreds of postbacks
+in flight.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+import logging
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from utils.async_knack_client import (
+    close_async_knack_clients,
+    gather_concurrently,
+    get_async_knack_client,
+)
+from utils.deadline import DeadlineExceeded, deadline
+from utils.idempotency import IN_PROGRESS_RESPONSE, IdempotencyStore
+from utils.line_items import (
+    LINE_ITEM_CONCURRENCY,
+    combine_responses,
+)
+from utils.logging_pipeline import configure_logging, format_for_log
+from utils.metrics import (
+    postback_seconds,
+    postback_stage_seconds,
+    postbacks_total,
+    registry,
+)
+from utils.postback import (
+    REFUND_RECORD_FIELDS,
+    create_message_json,
+    create_parent_reservation_payloads,
+    create_refund_payload,
+    flask_env,
+    get_handler,
+    get_permits,
+    get_validators,
+    message_rules,
+    refund_rules,
+    validate_postback,
+)
+from utils.request_body import (
+    POSTBACK_MAX_BODY_BYTES,
+    content_length_exceeds,
+    is_json,
+    loads,
+)
+from utils.tracing import current_span, span, start_trace
+
+logger = logging.getLogger("asgi")
+# responses already sent to citybase, keyed by (citybase id, payment status)
+# created by lifespan, nothing is opened at import
+idempotency_store = None
+
+
+async def get_knack_refund_payload(
+    payment_status,
+    payment_amount,
+    knack_invoice,
+    today_date,
+    knack_record_id,
+    knack_client,
+    transactions_object_id,
+    knack_app,
+):
+    """Async version of app.get_knack_refund_payload"""
+    record_data = await knack_client.get_record(
+        transactions_object_id, knack_record_id, REFUND_RECORD_FIELDS[knack_app]
+    )
+    logger.info(
+        f"Transaction refund record data from knack: {format_for_log(record_data)}"
+    )
+    return create_refund_payload(
+        record_data,
+        payment_status,
+        payment_amount,
+        knack_invoice,
+        today_date,
+        knack_app,
+    )
+
+
+async def update_parent_reservation(
+    today_date, parent_record_id, parent_key_value, knack_client, knack_app
+):
+    """Async version of app.update_parent_reservation"""
+    for object_id, payload in create_parent_reservation_payloads(
+        today_date, parent_key_value, knack_app
+    ):
+        parent_update_response = await knack_client.put(
+            object_id, parent_record_id, payload
+        )
+        logger.info(f"Update parent reservation response: {parent_update_response}")
+
+
+async def apply_postback(citybase_data, custom_attributes, today_date, replay=False):
+    """
+    Async version of app.apply_postback, sends the same Knack calls in the same order
+    :return: response body and status code to send to citybase
+    """
+    permits = get_permits(citybase_data, custom_attributes, logger)
+    current_span().set(permits=len(permits) or 1)
+    if not permits:
+        return await apply_permit(
+            citybase_data,
+            custom_attributes,
+            today_date,
+            citybase_data["data"]["total_amount"],
+            replay,
+        )
+    citybase_id = citybase_data["data"]["id"]
+    payment_status = citybase_data["data"]["status"]
+    logger.info(f"{citybase_id} - Payment for {len(permits)} permits")
+    semaphore = asyncio.Semaphore(LINE_ITEM_CONCURRENCY)
+
+    async def apply_line_item(permit):
+        idempotency_key = (citybase_id, payment_status, permit.line_item_id)
+        previous_response = await asyncio.to_thread(
+            idempotency_store.begin, idempotency_key
+        )
+        if previous_response is not None:
+            logger.info(
+                f"{citybase_id} - Line item {permit.line_item_id} already applied"
+            )
+            return previous_response
+        response = None
+        try:
+            async with semaphore:
+                with span("permit", line_item_id=permit.line_item_id) as permit_span:
+                    response = await apply_permit(
+                        citybase_data,
+                        permit.custom_attributes,
+                        today_date,
+                        permit.payment_amount,
+                        replay,
+                    )
+                    permit_span.set(status_code=response[1])
+        finally:
+            await asyncio.to_thread(
+                idempotency_store.finish,
+                idempotency_key,
+                response if response is not None and response[1] < 300 else None,
+            )
+        return response
+
+    results = await asyncio.gather(
+        *(apply_line_item(permit) for permit in permits), return_exceptions=True
+    )
+    return combine_responses(list(zip(permits, results)), logger)
+
+
+async def apply_permit(
+    citybase_data, custom_attributes, today_date, payment_amount, replay=False
+):
+    """Async version of app.apply_permit"""
+    knack_record_id = custom_attributes.get("knack_record_id")
+    knack_invoice = custom_attributes.get("invoice_number")
+    knack_app = custom_attributes.get("knack_app")
+    handler = get_handler(knack_app)
+    # banner type for street banners, None for apps with one kind of parent record
+    parent_key_value = handler.get_parent_key_value(custom_attributes)
+    parent_record_id = custom_attributes.get("parent_record_id")
+    payment_status = citybase_data["data"]["status"]
+    citybase_id = citybase_data["data"]["id"]
+    logger.info(
+        f"{citybase_id} - Payment status: {payment_status}, invoice number: {knack_invoice}"
+    )
+
+    knack_client = get_async_knack_client(knack_app)
+    messages_object_id = handler.messages_object_id
+    transactions_object_id = handler.transactions_object_id
+
+    message_payload = create_message_json(
+        citybase_id, today_date, knack_invoice, payment_status, knack_app
+    )
+
+    async def update_messages():
+        if replay and await knack_client.find_record(
+            messages_object_id,
+            message_rules(citybase_id, payment_status, knack_invoice, knack_app),
+        ):
+            logger.info(f"{citybase_id} - Message already in Knack, not written again")
+            return
+        logger.info(
+            f"{citybase_id} - Updating Knack messages table with payload: {message_payload}"
+        )
+        r = await knack_client.post(messages_object_id, message_payload)
+        logger.info(f"{citybase_id} - Response from updating messages table: {r}")
+        r.raise_for_status()
+
+    refund_creates_record = (
+        payment_status == "refunded" and handler.refund_creates_record
+    )
+    current_span().set(refund_record=refund_creates_record)
+    if refund_creates_record:
+        _, knack_payload = await gather_concurrently(
+            update_messages(),
+            get_knack_refund_payload(
+                payment_status,
+                payment_amount,
+                knack_invoice,
+                today_date,
+                knack_record_id,
+                knack_client,
+                transactions_object_id,
+                knack_app,
+            ),
+        )
+        if replay and await knack_client.find_record(
+            transactions_object_id,
+            refund_rules(knack_invoice, payment_amount, today_date, knack_app),
+        ):
+            logger.info(
+                f"{citybase_id} - Refund transaction already in Knack, not inserted again"
+            )
+            return "Payment status updated", 200
+        logger.info(
+            f"{citybase_id} - Transaction is refund, creating new transaction record: {knack_payload}"
+        )
+        knack_response = await knack_client.post(transactions_object_id, knack_payload)
+        logger.info(
+            f"{citybase_id} - Refund transaction update response {knack_response}"
+        )
+    else:
+        knack_payload = handler.transaction_payload(payment_status, today_date)
+        logger.info(f"{citybase_id} - Updating existing transaction record")
+        calls = [
+            knack_client.put(transactions_object_id, knack_record_id, knack_payload),
+            update_messages(),
+        ]
+        if payment_status == "successful":
+            logger.info(f"{citybase_id} - Updating parent reservation")
+            calls.append(
+                update_parent_reservation(
+                    today_date,
+                    parent_record_id,
+                    parent_key_value,
+                    knack_client,
+                    knack_app,
+                )
+            )
+        knack_response = (await gather_concurrently(*calls))[0]
+        logger.info(
+            f"{citybase_id} - Successful payment transaction update response {knack_response}"
+        )
+    if knack_response.status_code == 200:
+        return "Payment status updated", knack_response.status_code
+    # if unsuccessful, return knack's status response as response
+    logger.info(f"{citybase_id} - Payment transaction update response {knack_response}")
+    return knack_response.text, knack_response.status_code
+
+
+async def index(request):
+    # no log line, load balancer probes would flood the logs
+    now = datetime.now().isoformat()
+    payload = {
+        "message": "Austin Transportation Public Works Department Citybase health check",
+        "status": "OK",
+        "environment": flask_env,
+        "timestamp": now,
+    }
+    return JSONResponse(payload)
+
+
+async def read_body(request, limit):
+    """Reads the request body, or returns None as soon as it is larger than limit bytes"""
+    if content_length_exceeds(request.headers.get("content-length"), limit):
+        return None
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+async def handle_postback(request):
+    today_date = datetime.now().strftime("%m/%d/%Y %H:%M")
+    if not is_json(request.headers.get("content-type")):
+        postbacks_total.inc(status_code=415)
+        return PlainTextResponse("Unsupported Media Type", 415)
+    body = await read_body(request, POSTBACK_MAX_BODY_BYTES)
+    if body is None:
+        postbacks_total.inc(status_code=413)
+        return PlainTextResponse("Request Entity Too Large", 413)
+    try:
+        with postback_stage_seconds.time(stage="json_parse"):
+            citybase_data = loads(body)
+    except ValueError as e:
+        logger.error(f"Malformed JSON: {e}")
+        postbacks_total.inc(status_code=400)
+        return PlainTextResponse("Malformed JSON", 400)
+    # information from citybase payload
+    logger.info(f"New POST with payload: {format_for_log(citybase_data)}")
+
+    custom_attributes, error_response = validate_postback(citybase_data, logger)
+    if error_response is not None:
+        postbacks_total.inc(status_code=error_response[1])
+        return PlainTextResponse(*error_response)
+
+    idempotency_key = (citybase_data["data"]["id"], citybase_data["data"]["status"])
+    # the store is sqlite and begin() may wait on a delivery still in progress, keep
+    # its calls off the event loop
+    previous_response = await asyncio.to_thread(
+        idempotency_store.begin, idempotency_key
+    )
+    metric_labels = {
+        "knack_app": custom_attributes["knack_app"],
+        "payment_status": citybase_data["data"]["status"],
+    }
+    if previous_response is not None:
+        if previous_response is IN_PROGRESS_RESPONSE:
+            logger.warning(
+                f"{idempotency_key[0]} - Duplicate postback, original still in progress"
+            )
+        else:
+            logger.info(
+                f"{idempotency_key[0]} - Duplicate postback, returning original response"
+            )
+        postbacks_total.inc(status_code=previous_response[1], **metric_labels)
+        return PlainTextResponse(*previous_response)
+    # a delivery that failed may have written part of the postback before it gave up
+    replay = await asyncio.to_thread(idempotency_store.failed_before, idempotency_key)
+
+    response = None
+    start = time.perf_counter()
+    try:
+        with deadline(), start_trace(
+            "postback",
+            citybase_id=citybase_data["data"]["id"],
+            line_items=len(citybase_data["data"]["line_items"]),
+            **metric_labels,
+        ) as trace:
+            response = await apply_postback(
+                citybase_data, custom_attributes, today_date, replay
+            )
+            trace.set(status_code=response[1])
+    except DeadlineExceeded as e:
+        logger.error(f"{idempotency_key[0]} - Postback deadline exceeded: {e}")
+        response = ("Knack did not respond in time", 504)
+    finally:
+        postback_seconds.observe(time.perf_counter() - start, **metric_labels)
+        postbacks_total.inc(
+            status_code=response[1] if response is not None else 500, **metric_labels
+        )
+        # only remember successful responses so a failed postback is retried in full
+        await asyncio.to_thread(
+            idempotency_store.finish,
+            idempotency_key,
+            response if response is not None and response[1] < 300 else None,
+        )
+    return PlainTextResponse(*response)
+
+
+async def metrics(request):
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def internal_server_error(request, e):
+    # Log the error with more context
+    logger.error(f"Internal Server Error: {e}", exc_info=e)
+    return PlainTextResponse("Internal server error", 500)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # same warm-up as app.warm_up, done once the server starts rather than at import
+    global idempotency_store
+    configure_logging(flask_env)
+    get_validators()
+    idempotency_store = IdempotencyStore()
+    yield
+    await close_async_knack_clients()
+
+
+app = Starlette(
+    routes=[
+        Route("/", index),
+        Route("/citybase_postback", handle_postback, methods=["POST"]),
+        Route("/metrics", metrics),
+    ],
+    exception_handlers={500: internal_server_error},
+    lifespan=lifespan,
+)
@@ -0,0 +1,77 @@
+"""
+Measures how long a fresh worker process takes to import app.py, to finish warm_up() and
+to answer its first request, the cost every gunicorn worker pays on boot. Each sample
+runs in a new interpreter so nothing is cached. Run from the repository root:
+
+    python -m benchmarks.bench_startup
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# runs inside the fresh interpreter, prints the timings as json
+MEASURE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+warm_up = getattr(app, "warm_up", None)
+if warm_up is not None:
+    warm_up()
+warmed = time.perf_counter()
+response = app.app.test_client().get("/")
+first_response = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({
+    "import": imported - start,
+    "warm_up": warmed - imported,
+    "first_response": first_response - warmed,
+    "total": first_response - start,
+}))
+"""
+
+
+def measure_once(env):
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--log-sink",
+        default=os.devnull,
+        help="LOG_SINK for the measured process, 'cloudwatch' needs AWS credentials",
+    )
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("FLASK_ENV", "development")
+    env["LOG_SINK"] = args.log_sink
+    for knack_app in ("STREET_BANNER", "SMART_MOBILITY"):
+        env.setdefault(f"KNACK_{knack_app}_APP_ID", "benchmark")
+        env.setdefault(f"KNACK_{knack_app}_API_KEY", "benchmark")
+
+    samples = [measure_once(env) for _ in range(args.runs)]
+    print(f"{args.runs} fresh processes, median ms (min - max)")
+    for stage in ("import", "warm_up", "first_response", "total"):
+        values = [sample[stage] * 1000 for sample in samples]
+        print(
+            f"  {stage:<15} {statistics.median(values):7.1f}"
+            f"  ({min(values):.1f} - {max(values):.1f})"
+        )
+
+
+if __name__ == "__main__":
+    main()
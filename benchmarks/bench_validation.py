@@ -0,0 +1,87 @@
+"""
+Compares per-request schema validation cost of jsonschema.validate, which checks the
+schema and builds a new validator on every call, with the validators compiled once in
+utils/postback.py. Run from the repository root:
+
+    python -m benchmarks.bench_validation
+"""
+
+import os
+import timeit
+
+os.environ.setdefault("FLASK_ENV", "development")
+
+import jsonschema
+
+from utils.postback import get_validators, unpack_custom_attributes, validate
+from utils.schemas import custom_attributes_schema, payment_reporting_schema
+
+ITERATIONS = 200
+
+# example payload from the README
+citybase_data = {
+    "data": {
+        "total_amount": 50.55,
+        "service_fee": 0.55,
+        "amount": 50.0,
+        "voidable": False,
+        "refundable": True,
+        "id": 70020064,
+        "payment_source_channel": "web",
+        "status": "successful",
+        "request_id": "not used",
+        "payment_type": "check",
+        "agency": "Austin Transportation",
+        "credit_card": None,
+        "bank_account": {
+            "account_number_last_four": "1234",
+            "routing_number": "00000000",
+            "bank_account_type": "checking",
+            "account_holder_name": "fake person today",
+        },
+        "check_number": None,
+        "created_at": "2025-08-18T19:17:09Z",
+        "line_items": [
+            {
+                "id": "3c45f190-6bd3-4b7a-8062-c8bd21d9a359",
+                "amount": 5000,
+                "custom_attributes": {
+                    "invoice_number": "INV1970-100040",
+                    "knack_record_id": "6883b7b282a48402f6eb4a9e",
+                },
+            }
+        ],
+        "associated_payments": [],
+        "custom_attributes": [
+            {"key": "knack_app", "value": "SMART_MOBILITY"},
+            {"key": "invoice_number", "value": "INV1970-100040"},
+            {"key": "knack_record_id", "value": "6883b7b282a48402f6eb4a9e"},
+            {"key": "parent_record_id", "value": "6883b7b282a48402f6eb4a9e"},
+        ],
+    }
+}
+custom_attributes = unpack_custom_attributes(citybase_data["data"]["custom_attributes"])
+payment_reporting_validator, custom_attributes_validator = get_validators()
+
+
+def validate_per_request():
+    jsonschema.validate(citybase_data, payment_reporting_schema)
+    jsonschema.validate(custom_attributes, custom_attributes_schema)
+
+
+def validate_precompiled():
+    validate(citybase_data, payment_reporting_validator)
+    validate(custom_attributes, custom_attributes_validator)
+
+
+def microseconds_per_call(func):
+    best = min(timeit.repeat(func, number=ITERATIONS, repeat=3))
+    return best / ITERATIONS * 1_000_000
+
+
+if __name__ == "__main__":
+    before = microseconds_per_call(validate_per_request)
+    after = microseconds_per_call(validate_precompiled)
+    print(f"jsonschema.validate per request: {before:8.1f} us")
+    print(f"precompiled validators:          {after:8.1f} us")
+    print(f"speedup:                         {before / after:8.1f}x")
@@ -0,0 +1,260 @@
+"""
+Local stand-in for the Knack records API, for benchmarks and offline testing:
+
+    python -m benchmarks.fake_knack --port 8001 --latency 0.2 --error-rate 0.01
+
+then start the service with KNACK_API_URL=http://localhost:8001/v1/objects/
+
+Every GET, POST and PUT to /v1/objects/<object_id>/records/[<record_id>] succeeds after
+the configured latency unless it is picked to fail with a 500 (error rate) or to be
+rate limited with a 429 and Retry-After (rate limit rate), or scripted with fail_next.
+GETs return a record holding every transaction field in utils/field_maps.py.
+
+With --keep-records, records that are POSTed are stored, PUTs update them and GETs
+return them, and GET /v1/objects/<object_id>/records pages through them with Knack's
+page and rows_per_page parameters and "is" filters, for trying reconcile.py.
+Otherwise the collection is always empty.
+"""
+
+import argparse
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from utils.field_maps import FIELD_MAPS
+
+RECORDS_PATH = re.compile(r"^/v1/objects/(object_\d+)/records/([^/?]*)")
+
+
+def build_record(record_id):
+    """Returns a knack record with a value for every refund field of every app and env"""
+    record = {"id": record_id}
+    for envs in FIELD_MAPS.values():
+        for sections in envs.values():
+            for key, field in sections["TRANSACTION_REFUND"].items():
+                if key.startswith("banner_reservations"):
+                    record[field] = f'<span class="{record_id}">1</span>'
+                    record[f"{field}_raw"] = [{"id": record_id, "identifier": "1"}]
+                else:
+                    record[field] = f"{key} of {record_id}"
+                    record[f"{field}_raw"] = record[field]
+    return record
+
+
+class FakeKnack:
+    """
+    Threaded fake Knack server.
+
+    :param latency: seconds each response is delayed
+    :param jitter: up to this many extra seconds are added at random
+    :param error_rate: fraction of requests answered with a 500
+    :param rate_limit_rate: fraction of requests answered with a 429
+    :param keep_records: store written records and serve them back
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        keep_records=False,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.keep_records = keep_records
+        # object_id -> record_id -> record, in insertion order
+        self.records = {}
+        self.calls = Counter()
+        self.statuses = Counter()
+        # (status, headers) answered to the next requests, see fail_next
+        self._scripted = deque()
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/objects/"
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                match = RECORDS_PATH.match(self.path)
+                query = parse_qs(urlsplit(self.path).query)
+                status, payload, headers = fake.handle(
+                    self.command, match, json.loads(body) if body else None, query
+                )
+                out = json.dumps(payload).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_POST = do_PUT = _respond
+
+        return Handler
+
+    def fail_next(self, status, count=1, headers=None):
+        """Answers the next count requests with status and headers, ex: 429 and Retry-After"""
+        with self._lock:
+            self._scripted.extend([(status, headers or {})] * count)
+
+    def add_records(self, object_id, records):
+        """Stores records as if they had been POSTed, each needs an id"""
+        with self._lock:
+            stored = self.records.setdefault(object_id, {})
+            for record in records:
+                stored[record["id"]] = dict(record)
+
+    def list_page(self, object_id, query):
+        """Returns one page of an object's stored records in Knack's list response shape"""
+        page = int(query.get("page", ["1"])[0])
+        rows_per_page = int(query.get("rows_per_page", ["25"])[0])
+        with self._lock:
+            records = list(self.records.get(object_id, {}).values())
+        if "filters" in query:
+            rules = json.loads(query["filters"][0])["rules"]
+            records = [
+                record
+                for record in records
+                if all(
+                    str(record.get(rule["field"])) == str(rule["value"])
+                    for rule in rules
+                )
+            ]
+        start = (page - 1) * rows_per_page
+        return {
+            "total_pages": -(-len(records) // rows_per_page),
+            "current_page": page,
+            "total_records": len(records),
+            "records": records[start : start + rows_per_page],
+        }
+
+    def write_record(self, method, object_id, record_id, payload):
+        record = {"id": record_id, **(payload or {})}
+        if not self.keep_records:
+            return record
+        with self._lock:
+            stored = self.records.setdefault(object_id, {})
+            if method == "PUT" and record_id in stored:
+                stored[record_id].update(record)
+                return dict(stored[record_id])
+            stored[record_id] = record
+        return record
+
+    def handle(self, method, match, payload, query=None):
+        """:return: (status code, response json, extra headers)"""
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        with self._lock:
+            scripted = self._scripted.popleft() if self._scripted else None
+        if match is None:
+            status, response, headers = 404, {"errors": ["not found"]}, {}
+        elif scripted is not None:
+            status, headers = scripted
+            response = {"errors": [f"scripted {status}"]}
+        elif random.random() < self.rate_limit_rate:
+            status, response, headers = (
+                429,
+                {"errors": ["rate limited"]},
+                {"Retry-After": "1"},
+            )
+        elif random.random() < self.error_rate:
+            status, response, headers = 500, {"errors": ["server error"]}, {}
+        else:
+            object_id, record_id = match.group(1), match.group(2)
+            if method == "GET" and not record_id:
+                response = self.list_page(object_id, query or {})
+            elif method == "GET":
+                with self._lock:
+                    stored = self.records.get(object_id, {}).get(record_id)
+                response = dict(stored) if stored else build_record(record_id)
+            else:
+                record_id = record_id or f"{random.getrandbits(96):024x}"
+                response = self.write_record(method, object_id, record_id, payload)
+            status, headers = 200, {}
+        with self._lock:
+            object_id = match.group(1) if match else None
+            self.calls[(method, object_id)] += 1
+            self.statuses[status] += 1
+        return status, response, headers
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.statuses.clear()
+            self._scripted.clear()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.server.serve_forever, name="fake-knack", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Knack API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="seconds per response"
+    )
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--keep-records", action="store_true", help="store and serve written records"
+    )
+    args = parser.parse_args()
+    fake = FakeKnack(
+        args.host,
+        args.port,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.rate_limit_rate,
+        args.keep_records,
+    )
+    print(f"Fake Knack listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(dict(fake.statuses))
+
+
+if __name__ == "__main__":
+    main()
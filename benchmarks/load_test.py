@@ -0,0 +1,197 @@
+"""
+Load test of the postback against a local fake Knack, runs offline:
+
+    python -m benchmarks.load_test --requests 450 --concurrency 8 --latency 0.2
+
+By default the Flask app runs in this process on a threaded werkzeug server. To size
+gunicorn, start the fake Knack (python -m benchmarks.fake_knack) and the service with
+KNACK_API_URL pointing at it, then pass --target http://localhost:5000 and
+--fake-knack-url so Knack calls can't be counted locally.
+
+Reports throughput, p50/p95/p99 latency and Knack calls per postback, overall and per
+postback shape (status / knack app / banner type).
+"""
+
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks.fake_knack import FakeKnack
+from benchmarks.payloads import generate_payment_reports
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def start_local_app(fake_knack_url, rate_limit):
+    """Imports app.py configured against the fake Knack and serves it on a free port"""
+    os.environ["KNACK_API_URL"] = fake_knack_url
+    os.environ.setdefault("FLASK_ENV", "development")
+    os.environ.setdefault("LOG_SINK", os.devnull)
+    os.environ.setdefault("KNACK_RATE_LIMIT", str(rate_limit))
+    os.environ.setdefault("KNACK_RATE_BURST", str(int(rate_limit)))
+    # keep the responses of earlier runs, and the database, out of the working tree
+    os.environ.setdefault(
+        "IDEMPOTENCY_PATH",
+        os.path.join(tempfile.mkdtemp(prefix="load-test-"), "idempotency.sqlite3"),
+    )
+    for knack_app in ("STREET_BANNER", "SMART_MOBILITY"):
+        os.environ.setdefault(f"KNACK_{knack_app}_APP_ID", "benchmark")
+        os.environ.setdefault(f"KNACK_{knack_app}_API_KEY", "benchmark")
+
+    from werkzeug.serving import make_server
+
+    from app import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def report(title, latencies, statuses, elapsed, knack_calls):
+    count = len(latencies)
+    print(f"\n{title}")
+    print(f"  postbacks:        {count}  {dict(statuses)}")
+    if elapsed:
+        print(f"  throughput:       {count / elapsed:.1f} postbacks/s")
+    print(
+        f"  latency ms:       p50 {percentile(latencies, 50) * 1000:.0f}"
+        f"  p95 {percentile(latencies, 95) * 1000:.0f}"
+        f"  p99 {percentile(latencies, 99) * 1000:.0f}"
+        f"  mean {statistics.fmean(latencies) * 1000:.0f}"
+    )
+    if knack_calls is not None:
+        print(f"  knack calls/post: {knack_calls / count:.2f}")
+
+
+def run(args):
+    fake_knack = None
+    if args.fake_knack_url is None:
+        fake_knack = FakeKnack(
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate,
+        ).start()
+    target = args.target
+    if target is None:
+        _, target = start_local_app(
+            fake_knack.url if fake_knack else args.fake_knack_url, args.rate_limit
+        )
+
+    first_id = int(time.time())
+    warm_up = list(generate_payment_reports(args.concurrency, first_id=first_id))
+    reports = list(
+        generate_payment_reports(args.requests, first_id=first_id + args.concurrency)
+    )
+    session = requests.Session()
+    session.mount(
+        "http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    )
+    latencies = defaultdict(list)
+    statuses = defaultdict(lambda: defaultdict(int))
+    calls_by_shape = defaultdict(int)
+    lock = threading.Lock()
+
+    def send(item):
+        shape, payment_report = item
+        start = time.perf_counter()
+        response = session.post(f"{target}/citybase_postback", json=payment_report)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies[shape].append(elapsed)
+            statuses[shape][response.status_code] += 1
+
+    # warm up connections and imports, these aren't counted
+    for item in warm_up:
+        send(item)
+    latencies.clear()
+    statuses.clear()
+    if fake_knack:
+        fake_knack.reset()
+
+    if args.per_shape and fake_knack:
+        # one shape at a time to attribute knack calls to it
+        start = time.perf_counter()
+        by_shape = defaultdict(list)
+        for item in reports:
+            by_shape[item[0]].append(item)
+        for shape, items in by_shape.items():
+            before = fake_knack.total_calls()
+            with ThreadPoolExecutor(args.concurrency) as executor:
+                list(executor.map(send, items))
+            calls_by_shape[shape] = fake_knack.total_calls() - before
+        elapsed = time.perf_counter() - start
+    else:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            list(executor.map(send, reports))
+        elapsed = time.perf_counter() - start
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    all_statuses = defaultdict(int)
+    for shape_statuses in statuses.values():
+        for status, count in shape_statuses.items():
+            all_statuses[status] += count
+    report(
+        f"All postbacks, concurrency {args.concurrency}, knack latency {args.latency}s",
+        all_latencies,
+        all_statuses,
+        elapsed,
+        fake_knack.total_calls() if fake_knack else None,
+    )
+    for shape in sorted(latencies):
+        report(
+            shape,
+            latencies[shape],
+            statuses[shape],
+            None,
+            calls_by_shape.get(shape) if args.per_shape and fake_knack else None,
+        )
+    if fake_knack:
+        print(f"\nKnack responses: {dict(fake_knack.statuses)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Postback load test")
+    parser.add_argument("--requests", type=int, default=450)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="fake Knack seconds per response"
+    )
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=1000,
+        help="KNACK_RATE_LIMIT for the local app, high so the fake Knack is measured rather than the limiter",
+    )
+    parser.add_argument(
+        "--per-shape",
+        action="store_true",
+        help="send one shape at a time to count knack calls per shape",
+    )
+    parser.add_argument("--target", help="base url of an already running service")
+    parser.add_argument(
+        "--fake-knack-url",
+        help="Knack url the local app should use instead of starting a fake",
+    )
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
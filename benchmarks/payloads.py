@@ -0,0 +1,77 @@
+"""Generates citybase payment reports covering every postback shape the service handles"""
+
+import itertools
+import random
+from datetime import datetime, timezone
+
+PAYMENT_STATUSES = ("successful", "voided", "refunded")
+# (knack_app, banner_type)
+PERMIT_TYPES = (
+    ("STREET_BANNER", "OVER_THE_STREET"),
+    ("STREET_BANNER", "LAMPPOST"),
+    ("SMART_MOBILITY", None),
+)
+SHAPES = list(itertools.product(PAYMENT_STATUSES, PERMIT_TYPES))
+
+
+def shape_name(payment_status, knack_app, banner_type):
+    return "/".join(part for part in (payment_status, knack_app, banner_type) if part)
+
+
+def _record_id():
+    return f"{random.getrandbits(96):024x}"
+
+
+def payment_report(citybase_id, payment_status, knack_app, banner_type=None):
+    """Returns a payment report in the payment_reporting_schema shape"""
+    invoice_number = f"INV{citybase_id}"
+    knack_record_id = _record_id()
+    custom_attributes = [
+        {"key": "knack_app", "value": knack_app},
+        {"key": "invoice_number", "value": invoice_number},
+        {"key": "knack_record_id", "value": knack_record_id},
+        {"key": "parent_record_id", "value": _record_id()},
+    ]
+    if banner_type:
+        custom_attributes.append({"key": "banner_type", "value": banner_type})
+    return {
+        "data": {
+            "total_amount": 50.55,
+            "service_fee": 0.55,
+            "amount": 50.0,
+            "voidable": payment_status == "successful",
+            "refundable": payment_status == "successful",
+            "id": citybase_id,
+            "payment_source_channel": "web",
+            "status": payment_status,
+            "payment_type": "credit_card",
+            "agency": "Austin Transportation",
+            "created_at": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "line_items": [
+                {
+                    "id": _record_id(),
+                    "amount": 5000,
+                    "custom_attributes": {
+                        "invoice_number": invoice_number,
+                        "knack_record_id": knack_record_id,
+                    },
+                }
+            ],
+            "associated_payments": [],
+            "custom_attributes": custom_attributes,
+        }
+    }
+
+
+def generate_payment_reports(count, shapes=SHAPES, first_id=70000000):
+    """
+    Yields (shape name, payment report) pairs cycling through shapes, each with a
+    unique citybase id so none is answered from the idempotency store
+    """
+    for i, (payment_status, (knack_app, banner_type)) in zip(
+        range(count), itertools.cycle(shapes)
+    ):
+        yield (
+            shape_name(payment_status, knack_app, banner_type),
+            payment_report(first_id + i, payment_status, knack_app, banner_type),
+        )
@@ -0,0 +1,52 @@
+"""
+Gunicorn hooks, loaded automatically when gunicorn is started from the repository root.
+Worker counts and the bind address stay on the command line in docker-compose.yml.
+"""
+
+import os
+import signal
+
+# import the app once in the master and fork workers from it, so they share its memory
+# copy-on-write and boot without importing anything
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+# seconds a stopping worker waits for requests in flight before it is killed, must be
+# longer than SHUTDOWN_DRAIN_SECONDS plus KNACK_READ_TIMEOUT, and docker compose's
+# stop_grace_period longer still
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        # built before the fork so every worker shares them
+        from utils.postback import get_validators
+
+        get_validators()
+
+
+def post_fork(server, worker):
+    # threads, sockets and sqlite connections must be created after the fork
+    from app import warm_up
+
+    warm_up()
+
+
+def post_worker_init(worker):
+    # on SIGTERM gunicorn stops accepting connections and waits graceful_timeout for the
+    # requests in flight. Start draining first so postbacks still waiting on Knack are
+    # handed off within SHUTDOWN_DRAIN_SECONDS instead of being killed half written
+    from utils.shutdown import drain
+
+    handle_exit = worker.handle_exit
+
+    def handle_term(sig, frame):
+        drain.begin()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    from app import shut_down
+    from utils.shutdown import drain
+
+    shut_down(drain.drain_seconds)
@@ -0,0 +1,83 @@
+"""
+Finds citybase payments that never made it to Knack, by comparing a citybase export
+with the Knack messages and transactions objects:
+
+    python reconcile.py payments.ndjson --repairs > mismatches.ndjson
+
+The export holds one payment report per line (NDJSON), "-" reads stdin. Knack is read
+a page at a time and only the fields compared are kept, and the export is read one
+line at a time, so tens of thousands of records reconcile in bounded memory. Each
+mismatch is written to stdout as NDJSON, with a summary on stderr. Point
+KNACK_API_URL at benchmarks/fake_knack.py to try it without Knack.
+"""
+
+import argparse
+from datetime import datetime
+import json
+import sys
+
+from utils.knack_client import KNACK_ROWS_PER_PAGE, get_knack_client
+from utils.postback import HANDLERS
+from utils.reconcile import (
+    build_index,
+    build_refund_repair,
+    iter_payment_reports,
+    reconcile,
+)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("file", help="NDJSON of citybase payment reports, - for stdin")
+    parser.add_argument(
+        "--app",
+        action="append",
+        choices=list(HANDLERS),
+        help="knack app to reconcile, repeat for several, every app by default",
+    )
+    parser.add_argument(
+        "--repairs",
+        action="store_true",
+        help="add the knack write that would fix each mismatch, refund records are read from knack",
+    )
+    parser.add_argument("--rows-per-page", type=int, default=KNACK_ROWS_PER_PAGE)
+    args = parser.parse_args(argv)
+
+    today_date = datetime.now().strftime("%m/%d/%Y %H:%M")
+    indexes = {}
+    for knack_app in args.app or HANDLERS:
+        index = build_index(
+            get_knack_client(knack_app), HANDLERS[knack_app], args.rows_per_page
+        )
+        print(
+            f"{knack_app}: {len(index.messages)} messages, "
+            f"{len(index.transaction_statuses)} transactions read from Knack",
+            file=sys.stderr,
+        )
+        indexes[knack_app] = index
+
+    summary = {}
+    f = sys.stdin if args.file == "-" else open(args.file, encoding="utf-8")
+    try:
+        for mismatch in reconcile(iter_payment_reports(f), indexes, today_date):
+            repair = mismatch.pop("repair", None)
+            if args.repairs and repair is not None:
+                if repair["payload"] is None:
+                    repair["payload"] = build_refund_repair(
+                        mismatch,
+                        get_knack_client(mismatch["knack_app"]),
+                        today_date,
+                        repair.pop("payment_amount"),
+                    )
+                mismatch["repair"] = repair
+            summary[mismatch["kind"]] = summary.get(mismatch["kind"], 0) + 1
+            print(json.dumps(mismatch))
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    print(f"mismatches: {summary or 'none'}", file=sys.stderr)
+    return 1 if summary else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
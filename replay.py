@@ -0,0 +1,76 @@
+"""
+Replays citybase payment reports against a running postback service, for backfilling
+after a Knack or host outage:
+
+    ADMIN_TOKEN=... python replay.py payments.ndjson --url https://citybase.austinmobility.io
+
+The file holds a JSON array or one payment report per line (NDJSON), "-" reads stdin.
+Reports are sent to /citybase_postback/batch in chunks and a result per report is
+written to stdout as NDJSON, with a summary on stderr. The endpoint needs the service's
+ADMIN_TOKEN, read from the environment or --token.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import requests
+
+from utils.batch import parse_payment_reports
+
+CHUNK_SIZE = 200
+
+
+def send_chunk(session, url, chunk, timeout):
+    body = "\n".join(json.dumps(report) for report in chunk)
+    response = session.post(
+        f"{url.rstrip('/')}/citybase_postback/batch",
+        data=body.encode("utf-8"),
+        headers={"Content-Type": "application/x-ndjson"},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return response.json()["results"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "file", help="JSON array or NDJSON of payment reports, - for stdin"
+    )
+    parser.add_argument(
+        "--url", default="http://localhost:5000", help="postback service base url"
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="seconds to wait for each chunk"
+    )
+    parser.add_argument(
+        "--token", default=os.getenv("ADMIN_TOKEN"), help="service's ADMIN_TOKEN"
+    )
+    args = parser.parse_args(argv)
+    if not args.token:
+        parser.error("set ADMIN_TOKEN or pass --token")
+
+    if args.file == "-":
+        reports = parse_payment_reports(sys.stdin.read())
+    else:
+        with open(args.file, encoding="utf-8") as f:
+            reports = parse_payment_reports(f.read())
+
+    summary = {}
+    session = requests.Session()
+    session.headers["Authorization"] = f"Bearer {args.token}"
+    for start in range(0, len(reports), args.chunk_size):
+        chunk = reports[start : start + args.chunk_size]
+        for result in send_chunk(session, args.url, chunk, args.timeout):
+            result["index"] += start
+            summary[result["result"]] = summary.get(result["result"], 0) + 1
+            print(json.dumps(result))
+        print(f"{start + len(chunk)}/{len(reports)} sent: {summary}", file=sys.stderr)
+    return 1 if summary.get("failed") or summary.get("invalid") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
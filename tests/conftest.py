@@ -0,0 +1,52 @@
+"""
+The service reads its configuration at import, so the environment is set here before
+any test imports app. Knack is replaced by benchmarks/fake_knack.py.
+"""
+
+import os
+import tempfile
+
+_data_dir = tempfile.mkdtemp(prefix="citybase-tests-")
+os.environ.update(
+    {
+        "FLASK_ENV": "development",
+        "LOG_SINK": os.path.join(_data_dir, "service.log"),
+        "KNACK_STREET_BANNER_APP_ID": "app",
+        "KNACK_STREET_BANNER_API_KEY": "key",
+        "KNACK_SMART_MOBILITY_APP_ID": "app",
+        "KNACK_SMART_MOBILITY_API_KEY": "key",
+        "KNACK_RATE_LIMIT": "1000",
+        "KNACK_RATE_BURST": "1000",
+        "TRACE_SAMPLE_RATE": "0",
+        "POSTBACK_DEADLINE_SECONDS": "1",
+        "DEADLINE_FALLBACK_QUEUE_PATH": os.path.join(_data_dir, "deadline.sqlite3"),
+        "DEAD_LETTER_PATH": os.path.join(_data_dir, "dead_letters.sqlite3"),
+        "ADMIN_TOKEN": "test-token",
+        "IDEMPOTENCY_PATH": os.path.join(_data_dir, "idempotency.sqlite3"),
+    }
+)
+
+import pytest  # noqa: E402
+
+from benchmarks.fake_knack import FakeKnack  # noqa: E402
+import utils.knack_client  # noqa: E402
+
+
+@pytest.fixture
+def fake_knack():
+    """FakeKnack keeping written records, with the Knack clients pointed at it"""
+    fake = FakeKnack(keep_records=True).start()
+    api_url = utils.knack_client.KNACK_API_URL
+    utils.knack_client.KNACK_API_URL = fake.url
+    yield fake
+    utils.knack_client.KNACK_API_URL = api_url
+    fake.stop()
+
+
+@pytest.fixture
+def client(fake_knack):
+    """Flask test client of a warmed up app"""
+    import app
+
+    app.warm_up()
+    return app.app.test_client()
@@ -0,0 +1,44 @@
+import pytest
+from starlette.testclient import TestClient
+
+import asgi
+from utils.headers import knack_headers
+
+
+@pytest.fixture
+def asgi_client():
+    with TestClient(asgi.app) as client:
+        yield client
+
+
+def test_non_json_content_type_is_unsupported(asgi_client):
+    response = asgi_client.post(
+        "/citybase_postback", content=b"{}", headers={"Content-Type": "text/plain"}
+    )
+
+    assert response.status_code == 415
+
+
+def test_malformed_json_matches_flask(asgi_client):
+    response = asgi_client.post(
+        "/citybase_postback",
+        content=b"{not json",
+        headers={"Content-Type": "application/json"},
+    )
+
+    assert response.status_code == 400
+    assert response.text == "Malformed JSON"
+
+
+def test_malformed_content_length_is_ignored(asgi_client):
+    response = asgi_client.post(
+        "/citybase_postback",
+        content=b"{not json",
+        headers={"Content-Type": "application/json", "Content-Length": "ten"},
+    )
+
+    assert response.status_code == 400
+
+
+def test_unset_knack_keys_are_left_out_of_the_headers():
+    assert knack_headers("NOT_CONFIGURED") == {"Content-Type": "application/json"}
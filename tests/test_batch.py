@@ -0,0 +1,18 @@
+from benchmarks.payloads import payment_report
+from utils.postback import HANDLERS
+
+ADMIN = {"Authorization": "Bearer test-token"}
+
+
+def test_batch_needs_the_admin_token(fake_knack, client):
+    messages_object_id = HANDLERS["SMART_MOBILITY"].messages_object_id
+    reports = [payment_report(84000001, "successful", "SMART_MOBILITY")]
+
+    response = client.post("/citybase_postback/batch", json=reports)
+    assert response.status_code == 401
+    assert fake_knack.calls[("POST", messages_object_id)] == 0
+
+    response = client.post("/citybase_postback/batch", json=reports, headers=ADMIN)
+    assert response.status_code == 200
+    assert response.get_json()["summary"] == {"applied": 1}
+    assert fake_knack.calls[("POST", messages_object_id)] == 1
@@ -0,0 +1,135 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+from utils.dead_letter import DeadLetterStore
+from utils.postback import HANDLERS
+from utils.work_queue import FAILED, PENDING, PROCESSING
+
+ADMIN = {"Authorization": "Bearer test-token"}
+
+
+@pytest.fixture
+def store():
+    return DeadLetterStore(
+        os.path.join(tempfile.mkdtemp(prefix="dead-letters-"), "dead_letters.sqlite3")
+    )
+
+
+def add_transaction_update(store, citybase_id=85000001):
+    handler = HANDLERS["STREET_BANNER"]
+    return store.add(
+        citybase_id,
+        "STREET_BANNER",
+        "transaction",
+        "PUT",
+        handler.transactions_object_id,
+        "record-1",
+        {"field_1": "PAID"},
+        "500: server error",
+    )
+
+
+def claim_now(store):
+    # new entries are due a second after they are added
+    time.sleep(1.05)
+    return store.claim()
+
+
+def test_failed_resend_backs_off_until_out_of_attempts(store):
+    entry_id = add_transaction_update(store)
+
+    entry = claim_now(store)
+    assert (entry["id"], entry["attempts"], entry["payload"]) == (
+        entry_id,
+        1,
+        {"field_1": "PAID"},
+    )
+    assert store.counts() == {PROCESSING: 1}
+
+    assert store.fail(entry, "500: server error") == PENDING
+    # backed off, not due yet
+    assert store.claim() is None
+
+    entry["attempts"] = store.max_attempts
+    assert store.fail(entry, "500: server error") == FAILED
+    assert store.retry() == 1
+    assert store.list(PENDING)[0]["attempts"] == 0
+
+
+def test_resend_puts_the_stored_payload(fake_knack, client):
+    import app
+
+    handler = HANDLERS["STREET_BANNER"]
+    entry = {
+        "citybase_id": 85000002,
+        "knack_app": "STREET_BANNER",
+        "step": "transaction",
+        "method": "PUT",
+        "object_id": handler.transactions_object_id,
+        "record_id": "record-2",
+        "payload": {"field_1": "PAID"},
+        "context": None,
+    }
+
+    assert app.retry_dead_letter(entry)[1] == 200
+    assert fake_knack.records[handler.transactions_object_id]["record-2"] == {
+        "id": "record-2",
+        "field_1": "PAID",
+    }
+
+
+def test_resend_builds_a_refund_that_couldnt_be_read(fake_knack, client):
+    import app
+
+    handler = HANDLERS["STREET_BANNER"]
+    refund_fields = handler.fields.transaction_refund
+    entry = {
+        "citybase_id": 85000003,
+        "knack_app": "STREET_BANNER",
+        "step": "refund_record",
+        "method": "POST",
+        "object_id": handler.transactions_object_id,
+        "record_id": "",
+        "payload": None,
+        "context": {
+            "payment_status": "refunded",
+            "payment_amount": "25.00",
+            "knack_invoice": "INV85000003",
+            "today_date": "05/01/2024 10:00",
+            "knack_record_id": "record-3",
+        },
+    }
+
+    assert app._resend_dead_letter(entry)[1] == 200
+    assert fake_knack.calls[("GET", handler.transactions_object_id)] >= 1
+    (refund,) = fake_knack.records[handler.transactions_object_id].values()
+    assert refund[refund_fields.total_amount] == "-25.00"
+    assert refund[refund_fields.invoice_id] == "INV85000003"
+    assert refund[refund_fields.customer_name] == "customer_name of record-3"
+
+
+def test_admin_routes_need_the_token(client, store, monkeypatch):
+    import app
+
+    # a store of its own, out of reach of the worker's retry thread
+    monkeypatch.setattr(app, "dead_letter_store", store)
+    entry_id = add_transaction_update(store, 85000004)
+
+    assert client.get("/admin/dead_letters").status_code == 401
+    assert client.post("/admin/dead_letters/purge").status_code == 401
+
+    listed = client.get("/admin/dead_letters", headers=ADMIN).get_json()
+    assert listed["counts"] == {PENDING: 1}
+    assert [entry["id"] for entry in listed["entries"]] == [entry_id]
+    assert listed["entries"][0]["payload"] == {"field_1": "PAID"}
+
+    response = client.post(f"/admin/dead_letters/retry?id={entry_id}", headers=ADMIN)
+    assert response.get_json() == {"retried": 1}
+
+    store.complete(entry_id)
+    response = client.post("/admin/dead_letters/purge", headers=ADMIN)
+    assert response.get_json() == {"purged": 1}
+    assert store.counts() == {}
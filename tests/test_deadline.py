@@ -0,0 +1,80 @@
+import time
+
+from benchmarks.payloads import payment_report
+from utils.postback import HANDLERS, refund_rules
+
+
+def stored(fake_knack, object_id, **fields):
+    """Records of object_id in the fake whose fields have the given values"""
+    return [
+        record
+        for record in fake_knack.records.get(object_id, {}).values()
+        if all(record.get(field) == value for field, value in fields.items())
+    ]
+
+
+def test_timed_out_message_is_written_once(fake_knack, client):
+    import app
+
+    handler = HANDLERS["STREET_BANNER"]
+    messages = handler.fields.messages
+    # every call outlives the 1s deadline, the message still reaches Knack after it
+    fake_knack.latency = 1.5
+    report = payment_report(81000001, "successful", "STREET_BANNER", "LAMPPOST")
+
+    response = client.post("/citybase_postback", json=report)
+    assert response.status_code == 202
+
+    # the deadline queue applies it again, searching for the message first
+    started = time.monotonic()
+    while app.deadline_queue.counts().get("done") != 1:
+        assert time.monotonic() - started < 30, app.deadline_queue.counts()
+        time.sleep(0.2)
+    assert (
+        len(
+            stored(
+                fake_knack,
+                handler.messages_object_id,
+                **{messages.messages_citybase_id: 81000001}
+            )
+        )
+        == 1
+    )
+    assert fake_knack.calls[("POST", handler.messages_object_id)] == 1
+
+
+def test_dead_lettered_refund_is_not_inserted_twice(fake_knack, client):
+    import app
+
+    handler = HANDLERS["STREET_BANNER"]
+    context = {
+        "knack_invoice": "INV81000002",
+        "payment_amount": "25.00",
+        "today_date": "05/01/2024 10:00",
+    }
+    entry = {
+        "citybase_id": 81000002,
+        "knack_app": "STREET_BANNER",
+        "step": "refund_record",
+        "method": "POST",
+        "object_id": handler.transactions_object_id,
+        "record_id": "",
+        "payload": {"field": "value"},
+        "context": context,
+    }
+    # the insert that timed out was created after all
+    fake_knack.add_records(
+        handler.transactions_object_id,
+        [{"id": "refund", **refund_rules(*context.values(), "STREET_BANNER")}],
+    )
+    assert app.retry_dead_letter(entry)[1] == 200
+    assert fake_knack.calls[("POST", handler.transactions_object_id)] == 0
+
+    # a second partial refund of the same invoice is still inserted
+    entry["context"] = {
+        **context,
+        "payment_amount": "10.00",
+        "today_date": "05/02/2024 09:30",
+    }
+    assert app.retry_dead_letter(entry)[1] == 200
+    assert fake_knack.calls[("POST", handler.transactions_object_id)] == 1
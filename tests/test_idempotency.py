@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+from utils.idempotency import IN_PROGRESS_RESPONSE, IdempotencyStore
+
+
+def _path():
+    return os.path.join(tempfile.mkdtemp(prefix="idempotency-"), "idempotency.sqlite3")
+
+
+def test_response_is_shared_between_workers():
+    path = _path()
+    # one store per gunicorn worker, all on the same database
+    first, second = IdempotencyStore(path), IdempotencyStore(path)
+
+    assert first.begin((1, "successful")) is None
+    first.finish((1, "successful"), ("Payment status updated", 200))
+
+    assert second.begin((1, "successful")) == ("Payment status updated", 200)
+
+
+def test_redelivery_waits_for_the_original():
+    path = _path()
+    first, second = IdempotencyStore(path), IdempotencyStore(path)
+    assert first.begin((2, "successful")) is None
+
+    timer = threading.Timer(
+        0.5, first.finish, ((2, "successful"), ("Payment status updated", 200))
+    )
+    timer.start()
+    assert second.begin((2, "successful"), wait=5) == ("Payment status updated", 200)
+    timer.join()
+
+
+def test_redelivery_gets_a_conflict_while_the_original_is_in_progress():
+    path = _path()
+    first, second = IdempotencyStore(path), IdempotencyStore(path)
+    assert first.begin((3, "successful")) is None
+
+    assert second.begin((3, "successful"), wait=0.3) is IN_PROGRESS_RESPONSE
+
+    # the original failed, the next redelivery applies it again as a replay
+    first.finish((3, "successful"), None)
+    assert second.begin((3, "successful"), wait=0.3) is None
+    assert second.failed_before((3, "successful"))
+
+
+def test_importing_the_apps_opens_no_database():
+    path = _path()
+    # a fresh interpreter, the test session imported app already
+    subprocess.run(
+        [sys.executable, "-c", "import app, asgi"],
+        env={**os.environ, "IDEMPOTENCY_PATH": path},
+        check=True,
+    )
+
+    assert not os.path.exists(path)
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+import requests
+
+from utils.deadline import DeadlineExceeded, deadline
+from utils.knack_client import KnackClient
+from utils.rate_limit import TokenBucket
+
+
+def test_token_bucket_spaces_out_calls_past_the_burst():
+    bucket = TokenBucket(rate=10, burst=2)
+
+    waits = [bucket.reserve() for _ in range(4)]
+
+    assert waits[:2] == [0.0, 0.0]
+    # each call past the burst waits for one more token, served in order
+    assert waits[2] == pytest.approx(0.1, abs=0.01)
+    assert waits[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_rate_limited_call_waits_for_retry_after(fake_knack):
+    knack_client = KnackClient("STREET_BANNER")
+    fake_knack.fail_next(429, headers={"Retry-After": "0.5"})
+
+    started = time.monotonic()
+    response = knack_client.post("object_1", {"field_1": "value"})
+
+    assert response.status_code == 200
+    assert time.monotonic() - started >= 0.5
+    # a 429 was never processed, so even a POST is sent again
+    assert fake_knack.calls[("POST", "object_1")] == 2
+
+
+def test_server_error_is_only_retried_for_idempotent_methods(fake_knack):
+    knack_client = KnackClient("STREET_BANNER")
+
+    fake_knack.fail_next(500)
+    assert knack_client.get("object_1", "record_1").status_code == 200
+    assert fake_knack.calls[("GET", "object_1")] == 2
+
+    # a POST answered with a 500 may have created its record
+    fake_knack.fail_next(500)
+    assert knack_client.post("object_1", {"field_1": "value"}).status_code == 500
+    assert fake_knack.calls[("POST", "object_1")] == 1
+
+
+def test_timed_out_post_is_not_retried(fake_knack):
+    knack_client = KnackClient("STREET_BANNER", timeout=(1, 0.2))
+    fake_knack.latency = 0.5
+
+    with pytest.raises(requests.Timeout):
+        knack_client.post("object_1", {"field_1": "value"})
+
+    # let the fake finish the request it is still sleeping on
+    time.sleep(0.5)
+    assert fake_knack.calls[("POST", "object_1")] == 1
+
+
+def test_call_abandoned_at_the_deadline_gives_its_token_back(fake_knack):
+    knack_client = KnackClient("STREET_BANNER")
+    knack_client.rate_limiter = TokenBucket(rate=1, burst=1)
+    knack_client.get("object_1", "record_1")
+
+    # the next token is a second away, more than the deadline has left
+    with deadline(0.5), pytest.raises(DeadlineExceeded):
+        knack_client.get("object_1", "record_1")
+
+    assert knack_client.rate_limiter.tokens == pytest.approx(0, abs=0.1)
+    assert knack_client.rate_limiter.stats()["acquired"] == 1
+    assert fake_knack.calls[("GET", "object_1")] == 1
+
+
+def test_written_record_is_read_again_from_knack(fake_knack):
+    knack_client = KnackClient("STREET_BANNER")
+    response = knack_client.post("object_1", {"field_1": "PENDING"})
+    record_id = response.json()["id"]
+
+    assert knack_client.get_record("object_1", record_id)["field_1"] == "PENDING"
+    # cached, knack isn't asked again
+    assert knack_client.get_record("object_1", record_id)["field_1"] == "PENDING"
+    assert fake_knack.calls[("GET", "object_1")] == 1
+
+    knack_client.put("object_1", record_id, {"field_1": "PAID"})
+    assert knack_client.get_record("object_1", record_id)["field_1"] == "PAID"
+
+    # the uncoalesced PUT of a call with its own timeout invalidates the record too
+    knack_client.put("object_1", record_id, {"field_1": "REFUND"}, timeout=5)
+    assert knack_client.get_record("object_1", record_id)["field_1"] == "REFUND"
+    assert fake_knack.calls[("GET", "object_1")] == 3
@@ -0,0 +1,58 @@
+from benchmarks.payloads import payment_report
+from utils.postback import HANDLERS, unpack_custom_attributes
+
+
+def multi_permit_report(citybase_id, *line_attributes):
+    """A street banner payment whose line items carry line_attributes, 10.00 each"""
+    report = payment_report(citybase_id, "successful", "STREET_BANNER", "LAMPPOST")
+    report["data"]["line_items"] = [
+        {"id": f"line-{i}", "amount": 1000, "custom_attributes": attributes}
+        for i, attributes in enumerate(line_attributes)
+    ]
+    return report
+
+
+def test_line_items_take_missing_attributes_from_the_payment(fake_knack, client):
+    # the line item shape of the example in the README, without parent_record_id or banner_type
+    report = multi_permit_report(
+        82000001,
+        {"invoice_number": "INV-A", "knack_record_id": "record-a"},
+        {"invoice_number": "INV-B", "knack_record_id": "record-b"},
+    )
+    payment_attributes = unpack_custom_attributes(report["data"]["custom_attributes"])
+    handler = HANDLERS["STREET_BANNER"]
+
+    response = client.post("/citybase_postback", json=report)
+
+    assert response.status_code == 200, response.text
+    transactions = fake_knack.records[handler.transactions_object_id]
+    assert {"record-a", "record-b"} <= set(transactions)
+    assert payment_attributes["knack_record_id"] not in transactions
+    # both permits update the payment's parent reservation, picked by its banner_type
+    for parent in handler.get_parent_reservations("LAMPPOST"):
+        assert (
+            payment_attributes["parent_record_id"]
+            in fake_knack.records[parent.object_id]
+        )
+    assert fake_knack.calls[("POST", handler.messages_object_id)] == 2
+
+
+def test_incomplete_line_item_applies_the_payment_as_one_permit(fake_knack, client):
+    report = multi_permit_report(
+        82000002,
+        {"invoice_number": "INV-C", "knack_record_id": "record-c"},
+        {
+            "invoice_number": "INV-D",
+            "knack_record_id": "record-d",
+            "banner_type": "NOT_A_BANNER",
+        },
+    )
+    payment_attributes = unpack_custom_attributes(report["data"]["custom_attributes"])
+    handler = HANDLERS["STREET_BANNER"]
+
+    response = client.post("/citybase_postback", json=report)
+
+    assert response.status_code == 200, response.text
+    transactions = fake_knack.records[handler.transactions_object_id]
+    assert set(transactions) == {payment_attributes["knack_record_id"]}
+    assert fake_knack.calls[("POST", handler.messages_object_id)] == 1
@@ -0,0 +1,22 @@
+import logging
+import queue
+import threading
+
+from utils.logging_pipeline import DroppingQueueHandler
+
+
+def test_every_record_is_counted_as_enqueued_or_dropped():
+    handler = DroppingQueueHandler(queue.Queue(maxsize=500))
+    record = logging.makeLogRecord({"msg": "Payment status updated"})
+
+    def log():
+        for _ in range(1000):
+            handler.enqueue(record)
+
+    threads = [threading.Thread(target=log) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert handler.counts() == (500, 7500)
@@ -0,0 +1,31 @@
+from utils.request_body import POSTBACK_MAX_BODY_BYTES
+
+
+def rejected(client, status_code):
+    """Postbacks counted with status_code and no app or status, they were never read"""
+    sample = (
+        "citybase_postbacks_total"
+        f'{{knack_app="",payment_status="",status_code="{status_code}"}} '
+    )
+    for line in client.get("/metrics").get_data(as_text=True).splitlines():
+        if line.startswith(sample):
+            return int(line[len(sample) :])
+    return 0
+
+
+def test_rejected_postbacks_are_counted(client):
+    unsupported, too_large = rejected(client, 415), rejected(client, 413)
+
+    response = client.post(
+        "/citybase_postback", data=b"{}", headers={"Content-Type": "text/plain"}
+    )
+    assert response.status_code == 415
+    response = client.post(
+        "/citybase_postback",
+        data=b" " * (POSTBACK_MAX_BODY_BYTES + 1),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 413
+
+    assert rejected(client, 415) == unsupported + 1
+    assert rejected(client, 413) == too_large + 1
@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from utils.health import ReadinessProber
+
+
+def _prober(last_responses, probed):
+    return ReadinessProber(
+        lambda: {"threads": {"utilisation": 0}},
+        ["street_banner", "smart_mobility"],
+        last_responses,
+        probed.append,
+        lambda: False,
+        knack_interval=60,
+    )
+
+
+def test_only_idle_apps_are_probed():
+    now = time.monotonic()
+    last_responses = {"street_banner": (now, 200), "smart_mobility": (now - 120, 200)}
+    probed = []
+
+    _prober(last_responses, probed).probe_idle_apps()
+
+    assert probed == ["smart_mobility"]
+
+
+def test_readiness_follows_the_last_knack_response():
+    last_responses = {"street_banner": (time.monotonic(), 200)}
+    prober = _prober(last_responses, [])
+    prober.update()
+    assert prober.ready
+
+    # a postback's request got no response
+    last_responses["street_banner"] = (time.monotonic(), 0)
+    prober.update()
+    assert not prober.ready
+    assert prober.knack["street_banner"]["error"] == "no response"
+
+    last_responses["street_banner"] = (time.monotonic(), 404)
+    prober.update()
+    assert prober.ready
+
+
+def test_unreachable_app_is_probed_again_until_it_recovers():
+    last_responses = {"street_banner": (time.monotonic(), 0)}
+    probed = []
+
+    def probe_knack(knack_app):
+        probed.append(knack_app)
+        # first probe times out too, the second is answered
+        status_code = 0 if len(probed) == 1 else 200
+        last_responses[knack_app] = (time.monotonic(), status_code)
+
+    prober = ReadinessProber(
+        lambda: {"threads": {"utilisation": 0}},
+        ["street_banner"],
+        last_responses,
+        probe_knack,
+        lambda: False,
+        refresh=0.05,
+        knack_interval=60,
+    )
+    prober.update()
+    assert not prober.ready
+
+    # the traffic stopped along with readiness, the prober doesn't wait knack_interval
+    time.sleep(0.06)
+    next_probe = prober.probe_idle_apps()
+    assert probed == ["street_banner"]
+    # backs off after a probe that failed
+    assert next_probe - last_responses["street_banner"][0] == pytest.approx(0.1)
+
+    time.sleep(0.11)
+    prober.probe_idle_apps()
+    prober.update()
+    assert probed == ["street_banner", "street_banner"]
+    assert prober.ready
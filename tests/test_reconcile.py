@@ -0,0 +1,73 @@
+import json
+
+from benchmarks.payloads import payment_report
+from utils.knack_client import KnackClient
+from utils.postback import (
+    HANDLERS,
+    create_message_json,
+    create_refund_payload,
+    payment_status_map,
+)
+from utils.reconcile import build_index, iter_payment_reports, reconcile
+
+TODAY = "05/01/2024 10:00"
+
+
+def _custom_attribute(report, key):
+    return next(
+        attribute["value"]
+        for attribute in report["data"]["custom_attributes"]
+        if attribute["key"] == key
+    )
+
+
+def test_mismatches_are_found_across_pages(fake_knack):
+    handler = HANDLERS["STREET_BANNER"]
+    transaction_status = handler.fields.transactions.transaction_status
+    reports = [
+        payment_report(86000001, "successful", "STREET_BANNER"),
+        payment_report(86000002, "successful", "STREET_BANNER"),
+        payment_report(86000003, "successful", "STREET_BANNER"),
+        payment_report(86000004, "refunded", "STREET_BANNER"),
+    ]
+    messages, transactions = [], []
+    for report in reports:
+        invoice = _custom_attribute(report, "invoice_number")
+        record_id = _custom_attribute(report, "knack_record_id")
+        status = report["data"]["status"]
+        # the message of 86000002 never made it to knack
+        if report["data"]["id"] != 86000002:
+            message = create_message_json(
+                report["data"]["id"], TODAY, invoice, status, "STREET_BANNER"
+            )
+            messages.append({"id": f"message-{invoice}", **message})
+        transactions.append(
+            {"id": record_id, transaction_status: payment_status_map["successful"]}
+        )
+    # only an earlier partial refund of the refunded invoice is in knack, not the 50.55
+    refund = create_refund_payload(
+        {}, "refunded", "20.00", "INV86000004", TODAY, "STREET_BANNER"
+    )
+    transactions.append({"id": "refund-86000004", **refund})
+    fake_knack.add_records(handler.messages_object_id, messages)
+    fake_knack.add_records(handler.transactions_object_id, transactions)
+
+    index = build_index(KnackClient("STREET_BANNER"), handler, rows_per_page=2)
+    lines = [json.dumps(report) for report in reports]
+    mismatches = list(
+        reconcile(iter_payment_reports(lines), {"STREET_BANNER": index}, TODAY)
+    )
+
+    # 3 messages and 5 transactions, 2 rows per page
+    assert fake_knack.calls[("GET", handler.messages_object_id)] == 2
+    assert fake_knack.calls[("GET", handler.transactions_object_id)] == 3
+    assert [(m["kind"], m["citybase_id"]) for m in mismatches] == [
+        ("missing_message", 86000002),
+        ("refund_amount", 86000004),
+    ]
+    missing_message, refund_amount = mismatches
+    assert missing_message["repair"]["payload"] == create_message_json(
+        86000002, TODAY, "INV86000002", "successful", "STREET_BANNER"
+    )
+    assert (refund_amount["expected"], refund_amount["found"]) == ("50.55", ["20.00"])
+    assert refund_amount["repair"]["payment_amount"] == "50.55"
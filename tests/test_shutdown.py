@@ -0,0 +1,76 @@
+import importlib.util
+import os
+import signal
+import threading
+
+import pytest
+
+import utils.shutdown
+from benchmarks.payloads import payment_report
+from utils.postback import HANDLERS
+from utils.shutdown import Drain
+
+
+def test_drain_shortens_the_deadlines_in_flight():
+    drain = Drain(drain_seconds=0.5)
+    stopped = threading.Event()
+    drain.on_stop(stopped.set)
+
+    with drain.track(30) as in_flight:
+        assert in_flight.remaining() > 29
+        assert drain.begin() == 1
+        assert in_flight.remaining() <= 0.5
+        assert stopped.is_set()
+
+        # work started while stopping gets no more than the drain either
+        with drain.track(30, background=True) as late:
+            assert late.remaining() <= 0.5
+        # still waiting on the first postback
+        assert drain.wait(0.1) == 1
+
+    assert drain.wait(0) == 0
+
+
+@pytest.fixture
+def gunicorn_worker(monkeypatch):
+    """The SIGTERM handler of gunicorn.conf.py installed on a drain of its own"""
+    import app
+
+    drain = Drain()
+    # the hook imports the drain when it runs, the app has it imported already
+    monkeypatch.setattr(utils.shutdown, "drain", drain)
+    monkeypatch.setattr(app, "drain", drain)
+    spec = importlib.util.spec_from_file_location(
+        "gunicorn_conf", os.path.join(os.path.dirname(app.__file__), "gunicorn.conf.py")
+    )
+    gunicorn_conf = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(gunicorn_conf)
+
+    class Worker:
+        def __init__(self):
+            self.exits = []
+
+        def handle_exit(self, sig, frame):
+            self.exits.append(sig)
+
+    worker = Worker()
+    previous_handler = signal.getsignal(signal.SIGTERM)
+    gunicorn_conf.post_worker_init(worker)
+    yield drain, worker
+    signal.signal(signal.SIGTERM, previous_handler)
+
+
+def test_postbacks_are_refused_after_sigterm(fake_knack, client, gunicorn_worker):
+    drain, worker = gunicorn_worker
+
+    os.kill(os.getpid(), signal.SIGTERM)
+
+    assert drain.stopping
+    assert worker.exits == [signal.SIGTERM]
+    report = payment_report(87000001, "successful", "STREET_BANNER", "LAMPPOST")
+    response = client.post("/citybase_postback", json=report)
+    assert response.status_code == 503
+    handler = HANDLERS["STREET_BANNER"]
+    assert not fake_knack.calls[("POST", handler.messages_object_id)]
+    assert not fake_knack.calls[("PUT", handler.transactions_object_id)]
+    assert client.get("/readyz").status_code == 503
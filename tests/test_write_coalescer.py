@@ -0,0 +1,58 @@
+import threading
+import time
+
+from utils.deadline import current_deadline, deadline
+from utils.write_coalescer import WriteCoalescer
+
+
+class SlowSend:
+    """Records each PUT and the deadline it was sent under, taking delay seconds"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sent = []
+
+    def __call__(self, object_id, record_id, payload):
+        self.sent.append((record_id, dict(payload), current_deadline()))
+        time.sleep(self.delay)
+        return payload
+
+
+def test_write_to_an_idle_record_is_sent_at_once():
+    send = SlowSend(0)
+    coalescer = WriteCoalescer(send, enabled=True)
+    start = time.perf_counter()
+    coalescer.put("object_1", "record", {"field_1": "PAID"})
+    assert time.perf_counter() - start < 0.05
+    assert len(send.sent) == 1
+
+
+def test_writes_during_a_request_are_merged_under_the_latest_deadline():
+    send = SlowSend(0.3)
+    coalescer = WriteCoalescer(send, enabled=True)
+    deadlines = []
+
+    def put(payload, seconds):
+        with deadline(seconds) as caller_deadline:
+            deadlines.append(caller_deadline)
+            coalescer.put("object_1", "record", payload)
+
+    first = threading.Thread(target=put, args=({"field_1": "PAID"}, 5))
+    first.start()
+    time.sleep(0.1)
+    # both arrive while the first request is in flight
+    merged = [
+        threading.Thread(target=put, args=({"field_1": "REFUND"}, 1)),
+        threading.Thread(target=put, args=({"field_2": "x"}, 10)),
+    ]
+    for thread in merged:
+        thread.start()
+    for thread in [first, *merged]:
+        thread.join()
+
+    assert [payload for _, payload, _ in send.sent] == [
+        {"field_1": "PAID"},
+        {"field_1": "REFUND", "field_2": "x"},
+    ]
+    assert send.sent[1][2] is max(deadlines[1:], key=lambda d: d.expires_at)
+    assert coalescer.stats() == {"submitted": 3, "sent": 2}
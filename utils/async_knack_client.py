@@ -0,0 +1,173 @@
+import asyncio
+import os
+
+import httpx
+
+from utils.deadline import DeadlineExceeded, current_deadline
+from utils.headers import knack_headers
+from utils.knack_client import (
+    KNACK_API_URL,
+    KNACK_CONNECT_TIMEOUT,
+    KNACK_READ_TIMEOUT,
+    search_params,
+)
+from utils.metrics import time_knack_request
+from utils.rate_limit import TokenBucket, get_retry_delay
+from utils.record_cache import RecordCache, project
+from utils.request_body import loads
+from utils.tracing import span
+from utils.write_coalescer import AsyncWriteCoalescer
+
+# one event loop holds every in-flight postback, so this is far larger than KNACK_POOL_SIZE
+ASYNC_KNACK_MAX_CONNECTIONS = int(os.getenv("ASYNC_KNACK_MAX_CONNECTIONS", "100"))
+
+
+class AsyncKnackClient:
+    """
+    Non-blocking counterpart of KnackClient for the ASGI service.
+
+    Wraps an httpx.AsyncClient with keep-alive connections to api.knack.com. Responses
+    expose the same status_code, text, json() and raise_for_status() as requests does.
+    """
+
+    def __init__(self, knack_app, max_connections=ASYNC_KNACK_MAX_CONNECTIONS):
+        self.knack_app = knack_app
+        self.client = httpx.AsyncClient(
+            headers=knack_headers(knack_app),
+            timeout=httpx.Timeout(KNACK_READ_TIMEOUT, connect=KNACK_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+        )
+        self.record_cache = RecordCache()
+        self.rate_limiter = TokenBucket()
+        self.write_coalescer = AsyncWriteCoalescer(self._send_put)
+        self.retries = 0
+
+    async def request(self, method, object_id, record_id="", **kwargs):
+        """Same rate limiting, retries and deadline as KnackClient.request"""
+        url = f"{KNACK_API_URL}{object_id}/records/{record_id}"
+        deadline = current_deadline()
+        attempt = 0
+        while True:
+            wait = self.rate_limiter.reserve()
+            try:
+                if deadline is not None:
+                    deadline.check(wait)
+                if wait:
+                    await asyncio.sleep(wait)
+                if deadline is not None:
+                    connect, read = deadline.cap_timeout(
+                        (KNACK_CONNECT_TIMEOUT, KNACK_READ_TIMEOUT)
+                    )
+                    kwargs["timeout"] = httpx.Timeout(read, connect=connect)
+            except DeadlineExceeded:
+                # the call is abandoned, leave its token to the next one
+                self.rate_limiter.release(wait)
+                raise
+            try:
+                with span(
+                    "knack",
+                    knack_app=self.knack_app,
+                    object_id=object_id,
+                    method=method,
+                    attempt=attempt,
+                    rate_limit_wait_ms=round(wait * 1000, 3),
+                ) as knack_span, time_knack_request(
+                    self.knack_app, object_id, method
+                ) as result:
+                    response = await self.client.request(method, url, **kwargs)
+                    result["status_code"] = response.status_code
+                    knack_span.set(
+                        status_code=response.status_code,
+                        request_bytes=len(response.request.content),
+                        response_bytes=len(response.content),
+                    )
+            except httpx.TimeoutException as e:
+                if deadline is not None and deadline.remaining() <= 0:
+                    raise DeadlineExceeded(
+                        f"{method} {object_id} timed out at the postback deadline"
+                    ) from e
+                raise
+            delay = get_retry_delay(
+                method, response.status_code, response.headers, attempt
+            )
+            if delay is None:
+                return response
+            if deadline is not None:
+                deadline.check(delay)
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, object_id, record_id, **kwargs):
+        return await self.request("GET", object_id, record_id, **kwargs)
+
+    async def post(self, object_id, payload, **kwargs):
+        return await self.request("POST", object_id, json=payload, **kwargs)
+
+    async def _send_put(self, object_id, record_id, payload):
+        return await self.request("PUT", object_id, record_id, json=payload)
+
+    async def put(self, object_id, record_id, payload, **kwargs):
+        if kwargs:
+            response = await self.request(
+                "PUT", object_id, record_id, json=payload, **kwargs
+            )
+        else:
+            response = await self.write_coalescer.put(object_id, record_id, payload)
+        self.record_cache.invalidate(object_id, record_id)
+        return response
+
+    async def get_record(self, object_id, record_id, fields=None):
+        """Async version of KnackClient.get_record"""
+        record = self.record_cache.get(object_id, record_id, fields)
+        if record is None:
+            response = await self.get(object_id, record_id)
+            response.raise_for_status()
+            record = project(loads(response.content), fields)
+            self.record_cache.set(object_id, record_id, record, fields)
+        return record
+
+    async def find_record(self, object_id, rules):
+        """Async version of KnackClient.find_record"""
+        response = await self.get(object_id, "", params=search_params(rules))
+        response.raise_for_status()
+        records = loads(response.content)["records"]
+        return records[0] if records else None
+
+    async def close(self):
+        await self.client.aclose()
+
+
+_clients = {}
+
+
+def get_async_knack_client(knack_app):
+    """Returns the shared AsyncKnackClient for knack_app, must be called from the event loop"""
+    client = _clients.get(knack_app)
+    if client is None:
+        client = AsyncKnackClient(knack_app)
+        _clients[knack_app] = client
+    return client
+
+
+async def close_async_knack_clients():
+    while _clients:
+        _, client = _clients.popitem()
+        await client.close()
+
+
+async def gather_concurrently(*calls):
+    """
+    Async version of run_concurrently
+    :param calls: awaitables
+    :return: list of results, in the order given
+    :raises: the first exception raised by a call, once every call has finished
+    """
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
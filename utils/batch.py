@@ -0,0 +1,111 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.request_body import loads
+
+# payment reports applied at the same time, each one still fans out its own Knack calls
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+
+def parse_payment_reports(body, content_type=""):
+    """
+    :param body: request body bytes, a JSON array or newline delimited JSON of payment reports
+    :param content_type: request content type, application/x-ndjson forces NDJSON
+    :return: list of payment reports
+    :raises ValueError: if the body can't be decoded
+    """
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    if "ndjson" not in content_type and text.lstrip().startswith("["):
+        reports = loads(text)
+        if not isinstance(reports, list):
+            raise ValueError("expected a JSON array of payment reports")
+        return reports
+    reports = []
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            reports.append(loads(line))
+        except ValueError as e:
+            raise ValueError(f"line {line_number}: {e}") from e
+    return reports
+
+
+def _result(index, report, outcome, status_code=None, message=None):
+    data = report.get("data") if isinstance(report, dict) else None
+    data = data if isinstance(data, dict) else {}
+    return {
+        "index": index,
+        "id": data.get("id"),
+        "status": data.get("status"),
+        "result": outcome,
+        "response_status": status_code,
+        "message": message,
+    }
+
+
+def run_batch(reports, validate, apply, concurrency=BATCH_CONCURRENCY):
+    """
+    Validates, dedupes and applies a batch of citybase payment reports.
+
+    Reports for the same payment id and status are applied once. Knack has no bulk
+    write, so reports are grouped by the transaction record they update: each group is
+    applied in created_at order on one thread, so a payment is marked paid before its
+    refund, and up to concurrency groups run at the same time.
+
+    :param reports: list of payment reports in the payment_reporting_schema shape
+    :param validate: callable(report) returning (custom_attributes, error_response), see validate_postback
+    :param apply: callable(report, custom_attributes) returning (body, status_code),
+        202 meaning the report was queued
+    :return: list of per report results, in the order given
+    """
+    results = [None] * len(reports)
+    seen = set()
+    groups = {}
+    for index, report in enumerate(reports):
+        custom_attributes, error_response = validate(report)
+        if error_response is not None:
+            message, status_code = error_response
+            results[index] = _result(index, report, "invalid", status_code, message)
+            continue
+        key = (report["data"]["id"], report["data"]["status"])
+        if key in seen:
+            results[index] = _result(index, report, "duplicate")
+            continue
+        seen.add(key)
+        group_key = (
+            custom_attributes["knack_app"],
+            custom_attributes["knack_record_id"],
+        )
+        groups.setdefault(group_key, []).append((index, report, custom_attributes))
+
+    def apply_group(group):
+        group.sort(key=lambda item: (item[1]["data"]["created_at"], item[0]))
+        for index, report, custom_attributes in group:
+            try:
+                body, status_code = apply(report, custom_attributes)
+            except Exception as e:
+                results[index] = _result(index, report, "failed", None, repr(e))
+                continue
+            if status_code == 202:
+                outcome = "queued"
+            elif status_code < 300:
+                outcome = "applied"
+            else:
+                outcome = "failed"
+            results[index] = _result(index, report, outcome, status_code, body)
+
+    with ThreadPoolExecutor(
+        max_workers=concurrency, thread_name_prefix="postback-batch"
+    ) as executor:
+        # list() re-raises anything apply_group didn't catch
+        list(executor.map(apply_group, groups.values()))
+    return results
+
+
+def summarize(results):
+    """Returns the number of results per outcome"""
+    summary = {}
+    for result in results:
+        summary[result["result"]] = summary.get(result["result"], 0) + 1
+    return summary
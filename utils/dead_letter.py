@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import time
+
+from utils.work_queue import (
+    DONE,
+    FAILED,
+    PENDING,
+    PROCESSING,
+    WorkQueue,
+    start_workers,
+)
+
+logger = logging.getLogger(__name__)
+
+# when set, Knack writes that fail after the postback's message was written are stored
+# here and resent in the background instead of failing the whole postback
+DEAD_LETTER_PATH = os.getenv("DEAD_LETTER_PATH")
+DEAD_LETTER_MAX_ATTEMPTS = int(os.getenv("DEAD_LETTER_MAX_ATTEMPTS", "8"))
+DEAD_LETTER_POLL_INTERVAL = 5.0
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    citybase_id INTEGER NOT NULL,
+    knack_app TEXT NOT NULL,
+    step TEXT NOT NULL,
+    method TEXT NOT NULL,
+    object_id TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    payload TEXT,
+    context TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+CREATE_INDEX = "CREATE INDEX IF NOT EXISTS dead_letters_state ON dead_letters (state, available_at)"
+
+
+def _decode(row):
+    entry = dict(row)
+    for column in ("payload", "context"):
+        if entry[column] is not None:
+            entry[column] = json.loads(entry[column])
+    return entry
+
+
+class DeadLetterStore(WorkQueue):
+    """
+    Knack writes that failed part way through a postback, stored in a SQLite database in
+    WAL mode with the payload that was sent.
+
+    Each entry is a single step (one PUT or POST), so a retry only resends what didn't
+    reach Knack. Entries are retried with backoff until DEAD_LETTER_MAX_ATTEMPTS, then
+    stay failed until retried or purged from the admin endpoints.
+    """
+
+    schema = (CREATE_TABLE, CREATE_INDEX)
+    table = "dead_letters"
+    max_attempts = DEAD_LETTER_MAX_ATTEMPTS
+    poll_interval = DEAD_LETTER_POLL_INTERVAL
+    logger = logger
+
+    def backoff(self, attempts):
+        return min(2 ** (attempts + 2), 3600)
+
+    def describe(self, entry):
+        return f"{entry['citybase_id']} - Dead letter {entry['step']}"
+
+    def decode(self, row):
+        return _decode(row)
+
+    def add(
+        self,
+        citybase_id,
+        knack_app,
+        step,
+        method,
+        object_id,
+        record_id,
+        payload,
+        error,
+        context=None,
+    ):
+        """
+        :param step: name of the failed step, ex: transaction, parent_reservation
+        :param payload: json body that was sent, None if it couldn't be built yet
+        :param error: why the write failed
+        :param context: whatever else is needed to build a missing payload
+        :return: id of the new entry
+        """
+        now = time.time()
+        cursor = self._connection().execute(
+            """
+            INSERT INTO dead_letters (citybase_id, knack_app, step, method, object_id,
+                                      record_id, payload, context, state, available_at,
+                                      last_error, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                citybase_id,
+                knack_app,
+                step,
+                method,
+                object_id,
+                record_id or "",
+                None if payload is None else json.dumps(payload),
+                None if context is None else json.dumps(context),
+                PENDING,
+                now + 1,
+                str(error),
+                now,
+                now,
+            ),
+        )
+        return cursor.lastrowid
+
+    def list(self, state=None, limit=100):
+        """Returns the newest entries, optionally only those in state"""
+        if state is None:
+            rows = self._connection().execute(
+                "SELECT * FROM dead_letters ORDER BY id DESC LIMIT ?", (limit,)
+            )
+        else:
+            rows = self._connection().execute(
+                "SELECT * FROM dead_letters WHERE state = ? ORDER BY id DESC LIMIT ?",
+                (state, limit),
+            )
+        return [_decode(row) for row in rows.fetchall()]
+
+    def retry(self, entry_id=None):
+        """
+        Makes failed entries due for a retry now with a fresh set of attempts
+        :param entry_id: only this entry, which may also be pending, None for every failed entry
+        :return: number of entries requeued
+        """
+        now = time.time()
+        if entry_id is None:
+            cursor = self._connection().execute(
+                "UPDATE dead_letters SET state = ?, attempts = 0, available_at = ?, updated_at = ? WHERE state = ?",
+                (PENDING, now, now, FAILED),
+            )
+        else:
+            cursor = self._connection().execute(
+                "UPDATE dead_letters SET state = ?, attempts = 0, available_at = ?, updated_at = ? WHERE id = ? AND state IN (?, ?)",
+                (PENDING, now, now, entry_id, PENDING, FAILED),
+            )
+        return cursor.rowcount
+
+    def purge(self, entry_id=None, state=DONE):
+        """
+        Deletes entries
+        :param entry_id: only this entry, whatever its state
+        :param state: without an entry_id, delete every entry in this state
+        :return: number of entries deleted
+        """
+        if entry_id is None:
+            cursor = self._connection().execute(
+                "DELETE FROM dead_letters WHERE state = ?", (state,)
+            )
+        else:
+            cursor = self._connection().execute(
+                "DELETE FROM dead_letters WHERE id = ? AND state != ?",
+                (entry_id, PROCESSING),
+            )
+        return cursor.rowcount
+
+
+def start_dead_letter_worker(store, handler):
+    """
+    Starts a background thread that resends dead lettered Knack writes
+
+    :param store: DeadLetterStore to retry from
+    :param handler: callable(entry) that resends one entry and returns a (body, status_code) tuple
+    :return: threading.Event that stops the worker when set
+    """
+    return start_workers(store, handler, 1, "dead-letter-retry")
@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+import contextvars
+import math
+import os
+import time
+
+# seconds a postback may spend on Knack calls before citybase gives up waiting, 0 disables
+POSTBACK_DEADLINE_SECONDS = float(os.getenv("POSTBACK_DEADLINE_SECONDS", "20"))
+# a Knack call isn't started with less time than this left before the deadline
+DEADLINE_MIN_CALL_SECONDS = float(os.getenv("DEADLINE_MIN_CALL_SECONDS", "0.5"))
+# postbacks that run out of time are queued here and answered with a 202
+DEADLINE_FALLBACK_QUEUE_PATH = os.getenv("DEADLINE_FALLBACK_QUEUE_PATH")
+
+
+class DeadlineExceeded(Exception):
+    """Raised in place of a Knack call there is no time left for"""
+
+
+class Deadline:
+    __slots__ = ("expires_at",)
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def shorten(self, seconds):
+        """Moves the deadline to seconds from now, unless it is sooner already"""
+        self.expires_at = min(self.expires_at, time.monotonic() + seconds)
+
+    def check(self, needed=DEADLINE_MIN_CALL_SECONDS):
+        """
+        :param needed: seconds the caller needs
+        :return: seconds left before the deadline
+        :raises DeadlineExceeded: if less than needed is left
+        """
+        remaining = self.remaining()
+        if remaining < needed:
+            raise DeadlineExceeded(
+                f"{max(remaining, 0):.2f}s left of the postback deadline"
+            )
+        return remaining
+
+    def cap_timeout(self, timeout):
+        """Cuts a (connect, read) timeout to the time left, see check"""
+        remaining = self.check()
+        connect, read = timeout
+        return min(connect, remaining), min(read, remaining)
+
+
+_current_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline():
+    """Returns the Deadline of the postback being handled, or None outside of one"""
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline(seconds=POSTBACK_DEADLINE_SECONDS):
+    """
+    Sets a deadline for every Knack call made inside the block. Threads started by
+    run_concurrently and asyncio tasks inherit it. seconds of 0 or less sets no time
+    limit, the deadline can still be shortened, see utils/shutdown.py
+    """
+    token = _current_deadline.set(Deadline(seconds if seconds > 0 else math.inf))
+    try:
+        yield _current_deadline.get()
+    finally:
+        _current_deadline.reset(token)
+
+
+def latest_deadline(deadlines):
+    """
+    :param deadlines: Deadlines of several callers, None for one without a deadline
+    :return: the Deadline expiring last, None if any caller has none
+    """
+    latest = None
+    for caller_deadline in deadlines:
+        if caller_deadline is None:
+            return None
+        if latest is None or caller_deadline.expires_at > latest.expires_at:
+            latest = caller_deadline
+    return latest
+
+
+@contextmanager
+def use_deadline(existing):
+    """Runs the block under an existing Deadline, or without one when it is None"""
+    token = _current_deadline.set(existing)
+    try:
+        yield existing
+    finally:
+        _current_deadline.reset(token)
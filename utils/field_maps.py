@@ -1,3 +1,5 @@
+from utils.knack_apps import KNACK_APP_CONFIG
+
 FIELD_MAPS = {
     "STREET_BANNER": {
         "PRODUCTION": {
@@ -94,7 +96,7 @@ FIELD_MAPS = {
             "BLOCK_PARTY": {
                 "payment_received": "field_845",
                 "payment_date": "field_844",
-                "application_status": "field_704"
+                "application_status": "field_704",
             },
         },
         "UAT": {
@@ -121,8 +123,158 @@ FIELD_MAPS = {
             "BLOCK_PARTY": {
                 "payment_received": "field_845",
                 "payment_date": "field_844",
-                "application_status": "field_704"
+                "application_status": "field_704",
             },
         },
     },
 }
+
+
+class FrozenFields:
+    """
+    Read-only set of knack field ids, one attribute per key of a FIELD_MAPS section.
+
+    Subclasses list the keys they need in __slots__, keys in _optional may be missing
+    from the map and are then None.
+    """
+
+    __slots__ = ()
+    _optional = ()
+
+    def __init__(self, field_map, name):
+        missing = [
+            key
+            for key in self.__slots__
+            if key not in field_map and key not in self._optional
+        ]
+        if missing:
+            raise ValueError(f"Field map {name} is missing {', '.join(missing)}")
+        for key in self.__slots__:
+            object.__setattr__(self, key, field_map.get(key))
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, key):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __repr__(self):
+        fields = ", ".join(f"{key}={getattr(self, key)!r}" for key in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class TransactionFields(FrozenFields):
+    __slots__ = ("transaction_status", "transaction_paid_date")
+
+
+class TransactionRefundFields(FrozenFields):
+    __slots__ = (
+        "total_amount",
+        "invoice_id",
+        "created_date",
+        "customer_name",
+        "event_name",
+        "type",
+        "banner_reservations_lpb",
+        "banner_reservations_ots",
+        "sub_description",
+    )
+    # not in smart mobility's table
+    _optional = ("type", "banner_reservations_lpb", "banner_reservations_ots")
+
+
+class MessageFields(FrozenFields):
+    __slots__ = (
+        "messages_invoice_id",
+        "messages_connected_invoice",
+        "messages_created_date",
+        "messages_status",
+        "messages_citybase_id",
+    )
+
+
+def parent_section_class(section, fields):
+    """
+    :param section: section of FIELD_MAPS holding a parent reservation's fields, ex: LAMPPOST
+    :param fields: keys the parent reservation needs from it, see KNACK_APP_CONFIG
+    :return: FrozenFields subclass freezing that section, ex: LamppostFields
+    """
+    name = section.title().replace("_", "") + "Fields"
+    return type(name, (FrozenFields,), {"__slots__": tuple(fields)})
+
+
+class AppFields(FrozenFields):
+    """
+    Every field section of one knack app in one environment. parent_sections holds the
+    sections of the app's parent reservations by lower case name, ex: lamppost
+    """
+
+    __slots__ = ("transactions", "transaction_refund", "messages", "parent_sections")
+
+
+# sections every app must define, with the class used to freeze them
+COMMON_SECTIONS = {
+    "TRANSACTIONS": TransactionFields,
+    "TRANSACTION_REFUND": TransactionRefundFields,
+    "MESSAGES": MessageFields,
+}
+
+
+def get_app_sections(config=KNACK_APP_CONFIG):
+    """
+    :param config: dict shaped like KNACK_APP_CONFIG
+    :return: dict of knack_app -> section each app must define -> class used to freeze it
+    """
+    app_sections = {}
+    for knack_app, app_config in config.items():
+        parent_fields = {}
+        for parent in app_config["parent_reservations"].values():
+            fields = parent_fields.setdefault(parent["section"].upper(), [])
+            fields.extend(field for field in parent["fields"] if field not in fields)
+        app_sections[knack_app] = {
+            **COMMON_SECTIONS,
+            **{
+                section: parent_section_class(section, fields)
+                for section, fields in parent_fields.items()
+            },
+        }
+    return app_sections
+
+
+APP_SECTIONS = get_app_sections()
+KNACK_ENVS = ("PRODUCTION", "UAT")
+
+
+def compile_field_maps(field_maps, app_sections=APP_SECTIONS):
+    """
+    Validates field_maps and freezes them
+    :param field_maps: dict shaped like FIELD_MAPS
+    :param app_sections: sections each app must define, see get_app_sections
+    :return: dict of knack_app -> knack_env -> AppFields
+    :raises ValueError: if an app, environment, section or required field is missing
+    """
+    compiled = {}
+    for knack_app, sections in app_sections.items():
+        compiled[knack_app] = {}
+        for knack_env in KNACK_ENVS:
+            env_map = field_maps.get(knack_app, {}).get(knack_env)
+            if env_map is None:
+                raise ValueError(f"Field map {knack_app}.{knack_env} is missing")
+            section_fields = {"parent_sections": {}}
+            for section, fields_class in sections.items():
+                name = f"{knack_app}.{knack_env}.{section}"
+                if section not in env_map:
+                    raise ValueError(f"Field map {name} is missing")
+                frozen = fields_class(env_map[section], name)
+                if section in COMMON_SECTIONS:
+                    section_fields[section.lower()] = frozen
+                else:
+                    section_fields["parent_sections"][section.lower()] = frozen
+            compiled[knack_app][knack_env] = AppFields(
+                section_fields, f"{knack_app}.{knack_env}"
+            )
+    return compiled
+
+
+# validated once at import so a bad field map fails on startup rather than mid-postback
+FIELDS = compile_field_maps(FIELD_MAPS)
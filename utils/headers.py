@@ -1,20 +1,12 @@
 import os
 
-KNACK_APP_KEYS = {
-    "STREET_BANNER": {
-        "app_id": os.getenv("KNACK_STREET_BANNER_APP_ID"),
-        "api_key": os.getenv("KNACK_STREET_BANNER_API_KEY"),
-    },
-    "SMART_MOBILITY": {
-        "app_id": os.getenv("KNACK_SMART_MOBILITY_APP_ID"),
-        "api_key": os.getenv("KNACK_SMART_MOBILITY_API_KEY"),
-    },
-}
 
 def knack_headers(knack_app):
+    # read when a client is created rather than at import, so importing doesn't depend on the environment
     headers = {
-        "X-Knack-Application-Id": KNACK_APP_KEYS.get(knack_app).get("app_id"),
-        "X-Knack-REST-API-Key": KNACK_APP_KEYS.get(knack_app).get("api_key"),
+        "X-Knack-Application-Id": os.getenv(f"KNACK_{knack_app}_APP_ID"),
+        "X-Knack-REST-API-Key": os.getenv(f"KNACK_{knack_app}_API_KEY"),
         "Content-Type": "application/json",
     }
-    return headers
+    # an unset key is left out, httpx can't send a None header (requests drops them)
+    return {name: value for name, value in headers.items() if value is not None}
@@ -0,0 +1,206 @@
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+# seconds between refreshes of the readiness report from local counters
+READINESS_REFRESH_SECONDS = float(os.getenv("READINESS_REFRESH_SECONDS", "2"))
+# a knack app is probed once it has had no requests for this long, otherwise readiness
+# follows the responses to postbacks, every probe counts against the knack api limits
+KNACK_PROBE_INTERVAL_SECONDS = float(os.getenv("KNACK_PROBE_INTERVAL_SECONDS", "300"))
+# share of request threads busy with postbacks above which the worker reports not ready
+READY_MAX_THREAD_UTILISATION = float(os.getenv("READY_MAX_THREAD_UTILISATION", "0.75"))
+
+LIVENESS_PATH = "/healthz"
+_LIVENESS_STATUS = "200 OK"
+_LIVENESS_HEADERS = [("Content-Type", "text/plain"), ("Content-Length", "2")]
+_LIVENESS_BODY = (b"OK",)
+
+logger = logging.getLogger(__name__)
+
+
+class LivenessMiddleware:
+    """
+    Answers GET /healthz in front of the wsgi app, without routing, logging or building
+    a response, so load balancer probes cost nothing. It only shows the worker can
+    still serve requests, see ReadinessProber for whether it should get traffic.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO") == LIVENESS_PATH:
+            start_response(_LIVENESS_STATUS, _LIVENESS_HEADERS)
+            return _LIVENESS_BODY
+        return self.wsgi_app(environ, start_response)
+
+
+def _response_error(status_code):
+    """Why a knack response shows its app unreachable, None if the app answered"""
+    if status_code == 0:
+        return "no response"
+    if status_code >= 500:
+        return f"{status_code} response"
+    return None
+
+
+class ReadinessProber:
+    """
+    Background threads that keep a readiness report ready to send, so a readiness
+    probe only reads a cached body instead of calling knack or sqlite.
+
+    Local counters are collected every refresh seconds. Whether each knack app is
+    reachable comes from the last response it sent to this worker, postbacks included.
+    An app that has had no requests for knack_interval seconds is probed on a thread
+    of its own, so a slow knack doesn't hold back the local counters. An app whose last
+    request failed is probed again after refresh seconds, then with a growing backoff. The worker is not
+    ready while it is stopping, while a knack app's last request got no response or a
+    5xx, or while more than max_utilisation of its request threads are busy with
+    postbacks.
+
+    :param collect: callable returning a dict of local counters, with a "threads" dict
+        holding "utilisation"
+    :param knack_apps: names of the knack apps to report on
+    :param last_responses: dict of knack app to (time.monotonic(), status code) of its
+        last request, 0 when no response came back, see utils/metrics.py
+    :param probe_knack: callable(knack_app) sending a cheap request to that app, its
+        response is expected to land in last_responses
+    :param is_stopping: callable returning True once the worker is shutting down
+    """
+
+    def __init__(
+        self,
+        collect,
+        knack_apps,
+        last_responses,
+        probe_knack,
+        is_stopping,
+        refresh=READINESS_REFRESH_SECONDS,
+        knack_interval=KNACK_PROBE_INTERVAL_SECONDS,
+        max_utilisation=READY_MAX_THREAD_UTILISATION,
+    ):
+        self.collect = collect
+        self.knack_apps = knack_apps
+        self.last_responses = last_responses
+        self.probe_knack = probe_knack
+        self.is_stopping = is_stopping
+        self.refresh = refresh
+        self.knack_interval = knack_interval
+        self.max_utilisation = max_utilisation
+        self.knack = {}
+        # knack app -> probes in a row that found it unreachable
+        self._failed_probes = {}
+        self.ready = False
+        self.body = b'{"ready": false, "reasons": ["starting"]}'
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """:return: threading.Event that stops the prober when set"""
+        threading.Thread(
+            target=self._refresh_loop, name="readiness-prober", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._knack_loop, name="knack-prober", daemon=True
+        ).start()
+        return self._stop_event
+
+    def _refresh_loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self.update()
+            except Exception:
+                logger.exception("Readiness report failed")
+            self._stop_event.wait(self.refresh)
+
+    def _knack_loop(self):
+        while not self._stop_event.is_set():
+            next_probe = self.probe_idle_apps()
+            self._stop_event.wait(max(next_probe - time.monotonic(), self.refresh))
+
+    def _probe_delay(self, knack_app, status_code):
+        """Seconds after a response with status_code before knack_app is probed"""
+        if _response_error(status_code) is None:
+            self._failed_probes.pop(knack_app, None)
+            return self.knack_interval
+        # no traffic may come to clear it once the worker is not ready, so probe again
+        # soon, backing off while the app stays unreachable
+        failures = self._failed_probes.get(knack_app, 0)
+        return min(self.refresh * 2**failures, self.knack_interval)
+
+    def probe_idle_apps(self):
+        """
+        Probes the knack apps without a request in the last knack_interval seconds, and
+        the apps whose last request failed after a backoff starting at refresh seconds
+        :return: time.monotonic() at which the next app is due a probe
+        """
+        next_probe = time.monotonic() + self.knack_interval
+        for knack_app in self.knack_apps:
+            last = self.last_responses.get(knack_app)
+            if last is None or time.monotonic() - last[0] >= self._probe_delay(
+                knack_app, last[1]
+            ):
+                try:
+                    self.probe_knack(knack_app)
+                except Exception:
+                    # the response, if any, is in last_responses already
+                    logger.exception(f"Knack probe of {knack_app} failed")
+                last = self.last_responses.get(knack_app)
+                if last is not None and _response_error(last[1]) is not None:
+                    self._failed_probes[knack_app] = (
+                        self._failed_probes.get(knack_app, 0) + 1
+                    )
+            if last is not None:
+                next_probe = min(
+                    next_probe, last[0] + self._probe_delay(knack_app, last[1])
+                )
+        return next_probe
+
+    def check_knack(self):
+        """:return: dict of knack app to its reachability, from its last response"""
+        knack = {}
+        now = time.monotonic()
+        for knack_app in self.knack_apps:
+            last = self.last_responses.get(knack_app)
+            if last is None:
+                # not probed yet, don't hold back readiness for it
+                continue
+            responded_at, status_code = last
+            error = _response_error(status_code)
+            if error is not None and self.knack.get(knack_app, {}).get(
+                "reachable", True
+            ):
+                logger.error(f"Knack app {knack_app} unreachable: {error}")
+            knack[knack_app] = {
+                "reachable": error is None,
+                "error": error,
+                "last_response_seconds_ago": round(now - responded_at, 3),
+            }
+        self.knack = knack
+        return knack
+
+    def update(self):
+        """Rebuilds the cached readiness report"""
+        stats = self.collect()
+        reasons = []
+        if self.is_stopping():
+            reasons.append("stopping")
+        knack = self.check_knack()
+        for knack_app, status in knack.items():
+            if not status["reachable"]:
+                reasons.append(f"{knack_app} unreachable")
+        utilisation = stats["threads"]["utilisation"]
+        if utilisation > self.max_utilisation:
+            reasons.append(f"{utilisation:.0%} of request threads busy")
+        ready = not reasons
+        report = {
+            "ready": ready,
+            "reasons": reasons,
+            "checked_at": datetime.now().isoformat(),
+            "knack": knack,
+            **stats,
+        }
+        self.body = json.dumps(report).encode()
+        self.ready = ready
@@ -0,0 +1,173 @@
+import json
+import os
+import time
+
+from utils.work_queue import SqliteStore
+
+# shared by every gunicorn worker, so a redelivery is recognized whichever worker gets it
+IDEMPOTENCY_PATH = os.getenv("IDEMPOTENCY_PATH", "data/idempotency.sqlite3")
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 60 * 60)))
+# how long a redelivery waits for the original delivery that is still being applied
+IDEMPOTENCY_WAIT_SECONDS = 30
+IDEMPOTENCY_POLL_INTERVAL = 0.2
+# a delivery in progress for this long belongs to a worker that died, the key is free again
+IDEMPOTENCY_STALE_SECONDS = 300
+
+# sent to a redelivery when the original delivery is still being applied after the wait,
+# citybase delivers it again later
+IN_PROGRESS_RESPONSE = ("Postback is still being applied, retry later", 409)
+
+IN_PROGRESS = "in_progress"
+DONE = "done"
+FAILED = "failed"
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    body TEXT,
+    status_code INTEGER,
+    -- until when a failed delivery is remembered, see failed_before
+    failed_until REAL,
+    expires_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+CREATE_INDEX = (
+    "CREATE INDEX IF NOT EXISTS idempotency_expires ON idempotency (expires_at)"
+)
+
+
+class IdempotencyStore(SqliteStore):
+    """
+    Remembers the response sent for each citybase payment event so redeliveries can be
+    answered without calling Knack again.
+
+    Keys are tuples such as (citybase id, payment status). Entries expire after ttl
+    seconds. Only successful responses should be stored, so a delivery that failed is
+    applied again on retry. Failed deliveries are remembered too, since a write that
+    timed out may still have reached Knack, see failed_before.
+    The store is a SQLite database in WAL mode shared by every gunicorn worker process,
+    a key is claimed inside an immediate transaction so only one delivery applies it.
+    """
+
+    schema = (CREATE_TABLE, CREATE_INDEX)
+
+    def __init__(self, path=IDEMPOTENCY_PATH, ttl=IDEMPOTENCY_TTL_SECONDS):
+        super().__init__(path)
+        self.ttl = ttl
+        self._last_purge = 0
+
+    def _claim(self, key):
+        """
+        :return: the stored response, IN_PROGRESS if another delivery holds key, or None
+            once key is claimed by the caller
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT state, body, status_code, expires_at, updated_at FROM idempotency WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is not None and row["expires_at"] >= now:
+                if row["state"] == DONE:
+                    conn.execute("COMMIT")
+                    return row["body"], row["status_code"]
+                if (
+                    row["state"] == IN_PROGRESS
+                    and row["updated_at"] >= now - IDEMPOTENCY_STALE_SECONDS
+                ):
+                    conn.execute("COMMIT")
+                    return IN_PROGRESS
+            # new, expired, failed or abandoned by a worker that died, keep failed_until
+            conn.execute(
+                """
+                INSERT INTO idempotency (key, state, expires_at, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    state = excluded.state,
+                    body = NULL,
+                    status_code = NULL,
+                    expires_at = excluded.expires_at,
+                    updated_at = excluded.updated_at
+                """,
+                (key, IN_PROGRESS, now + self.ttl, now),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+    def begin(self, key, wait=IDEMPOTENCY_WAIT_SECONDS):
+        """
+        Looks up a stored response for key, waiting for a delivery of the same event that is in progress
+        :return: the stored response, IN_PROGRESS_RESPONSE if that delivery is still in
+            progress after wait seconds, or None if the caller should apply the postback
+            and then call finish()
+        """
+        key = json.dumps(key)
+        give_up_at = time.monotonic() + wait
+        while True:
+            response = self._claim(key)
+            if response is not IN_PROGRESS:
+                return response
+            if time.monotonic() >= give_up_at:
+                return IN_PROGRESS_RESPONSE
+            # the delivery may be in another worker process, so poll rather than wait on an event
+            time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+    def failed_before(self, key):
+        """
+        :return: True if the last delivery of key failed, its writes may then have
+            reached Knack and should be looked up before being sent again
+        """
+        row = (
+            self._connection()
+            .execute(
+                "SELECT failed_until FROM idempotency WHERE key = ?", (json.dumps(key),)
+            )
+            .fetchone()
+        )
+        return row is not None and (row["failed_until"] or 0) >= time.time()
+
+    def finish(self, key, response=None):
+        """
+        Releases key after begin() returned None
+        :param response: response to store for redeliveries, None to store nothing and
+            remember the delivery failed
+        """
+        now = time.time()
+        if response is not None:
+            body, status_code = response
+            self._connection().execute(
+                "UPDATE idempotency SET state = ?, body = ?, status_code = ?, failed_until = NULL, expires_at = ?, updated_at = ? WHERE key = ?",
+                (DONE, body, status_code, now + self.ttl, now, json.dumps(key)),
+            )
+        else:
+            self._connection().execute(
+                "UPDATE idempotency SET state = ?, failed_until = ?, expires_at = ?, updated_at = ? WHERE key = ?",
+                (FAILED, now + self.ttl, now + self.ttl, now, json.dumps(key)),
+            )
+        if now - self._last_purge > 60:
+            self._last_purge = now
+            self.purge_expired()
+
+    def purge_expired(self):
+        cursor = self._connection().execute(
+            "DELETE FROM idempotency WHERE expires_at < ? AND state != ?",
+            (time.time(), IN_PROGRESS),
+        )
+        return cursor.rowcount
+
+    def __len__(self):
+        return (
+            self._connection()
+            .execute(
+                "SELECT COUNT(*) FROM idempotency WHERE state = ? AND expires_at >= ?",
+                (DONE, time.time()),
+            )
+            .fetchone()[0]
+        )
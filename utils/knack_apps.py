@@ -0,0 +1,145 @@
+# knack apps citybase reports payments for. A new permit program needs an entry here,
+# its field ids in field_maps.FIELD_MAPS and its knack api keys in the environment
+KNACK_APP_CONFIG = {
+    "STREET_BANNER": {
+        "messages_object_id": "object_181",
+        "transactions_object_id": "object_180",
+        # a refund inserts a new negative transaction rather than updating the paid one
+        "refund_creates_record": True,
+        # custom attribute that picks which parent reservation a payment approves
+        "parent_key": "banner_type",
+        "parent_reservations": {
+            "OVER_THE_STREET": {
+                "object_id": "object_164",
+                "section": "over_the_street",
+                "fields": (
+                    "ots_application_status",
+                    "ots_payment_received",
+                    "ots_payment_date",
+                ),
+                "application_status": "Approved",
+            },
+            "LAMPPOST": {
+                "object_id": "object_161",
+                "section": "lamppost",
+                "fields": (
+                    "lpb_application_status",
+                    "lpb_payment_received",
+                    "lpb_payment_date",
+                ),
+                "application_status": "Approved",
+            },
+        },
+    },
+    "SMART_MOBILITY": {
+        "messages_object_id": "object_38",
+        "transactions_object_id": "object_39",
+        "refund_creates_record": False,
+        # every payment approves the same kind of parent record
+        "parent_key": None,
+        "parent_reservations": {
+            None: {
+                "object_id": "object_36",
+                "section": "block_party",
+                "fields": ("application_status", "payment_received", "payment_date"),
+                "application_status": "Complete - Permit Issued",
+            },
+        },
+    },
+}
+
+
+class ParentReservation:
+    """Parent reservation record type a successful payment approves"""
+
+    __slots__ = ("object_id", "date_field", "_template")
+
+    def __init__(self, object_id, section_fields, fields, application_status):
+        status_field, received_field, date_field = (
+            getattr(section_fields, field) for field in fields
+        )
+        self.object_id = object_id
+        self.date_field = date_field
+        self._template = {status_field: application_status, received_field: True}
+
+    def payload(self, today_date):
+        """Sets application status, payment received as TRUE and payment date as today"""
+        return {**self._template, self.date_field: today_date}
+
+
+class KnackAppHandler:
+    """
+    Everything a postback for one knack app needs, resolved once at startup: object ids,
+    field ids, transaction payload templates and the parent reservation for each value of
+    the app's parent_key custom attribute.
+    """
+
+    __slots__ = (
+        "knack_app",
+        "fields",
+        "messages_object_id",
+        "transactions_object_id",
+        "refund_creates_record",
+        "parent_key",
+        "parent_reservations",
+        "_status_templates",
+    )
+
+    def __init__(self, knack_app, app_fields, config, payment_status_map):
+        self.knack_app = knack_app
+        self.fields = app_fields
+        self.messages_object_id = config["messages_object_id"]
+        self.transactions_object_id = config["transactions_object_id"]
+        self.refund_creates_record = config["refund_creates_record"]
+        self.parent_key = config["parent_key"]
+        self.parent_reservations = {
+            key: ParentReservation(
+                parent["object_id"],
+                app_fields.parent_sections[parent["section"]],
+                parent["fields"],
+                parent["application_status"],
+            )
+            for key, parent in config["parent_reservations"].items()
+        }
+        status_field = app_fields.transactions.transaction_status
+        self._status_templates = {
+            payment_status: {status_field: knack_status}
+            for payment_status, knack_status in payment_status_map.items()
+        }
+
+    def get_parent_reservations(self, parent_key_value):
+        """
+        :param parent_key_value: value of the parent_key custom attribute, None if the app has none
+        :return: tuple of the ParentReservations to update for a successful payment
+        """
+        parent = self.parent_reservations.get(parent_key_value)
+        return () if parent is None else (parent,)
+
+    def get_parent_key_value(self, custom_attributes):
+        """Returns the custom attribute choosing the parent reservation, ex: the banner type"""
+        if self.parent_key is None:
+            return None
+        return custom_attributes.get(self.parent_key)
+
+    def transaction_payload(self, payment_status, today_date):
+        """Payload updating the status and paid date of the existing transaction record"""
+        return {
+            **self._status_templates[payment_status],
+            self.fields.transactions.transaction_paid_date: today_date,
+        }
+
+
+def build_handlers(app_fields, payment_status_map, config=KNACK_APP_CONFIG):
+    """
+    :param app_fields: AppFields of each knack app in this environment
+    :param payment_status_map: citybase payment status to knack transaction status
+    :return: dict of knack app name to KnackAppHandler
+    """
+    handlers = {}
+    for knack_app, app_config in config.items():
+        if knack_app not in app_fields:
+            raise ValueError(f"Knack app {knack_app} has no field map")
+        handlers[knack_app] = KnackAppHandler(
+            knack_app, app_fields[knack_app], app_config, payment_status_map
+        )
+    return handlers
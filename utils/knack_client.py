@@ -0,0 +1,337 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from utils.deadline import DeadlineExceeded, current_deadline
+from utils.headers import knack_headers
+from utils.metrics import GaugeCallback, registry, time_knack_request
+from utils.rate_limit import TokenBucket, get_retry_delay
+from utils.record_cache import RecordCache, project
+from utils.request_body import loads
+from utils.tracing import span
+from utils.write_coalescer import WriteCoalescer
+
+# point at benchmarks/fake_knack.py to run without Knack
+KNACK_API_URL = os.getenv("KNACK_API_URL", "https://api.knack.com/v1/objects/")
+
+# one pooled connection per request thread, keep this in line with gunicorn --threads
+KNACK_POOL_SIZE = int(os.getenv("KNACK_POOL_SIZE", "4"))
+# (connect, read) timeouts in seconds so a slow Knack can't hold a worker thread forever
+KNACK_CONNECT_TIMEOUT = float(os.getenv("KNACK_CONNECT_TIMEOUT", "3.05"))
+KNACK_READ_TIMEOUT = float(os.getenv("KNACK_READ_TIMEOUT", "10"))
+# most Knack calls a single postback sends at once, see run_concurrently
+KNACK_FANOUT_WIDTH = 3
+# records per page when reading a whole object, knack allows at most 1000
+KNACK_ROWS_PER_PAGE = 1000
+
+
+def search_params(rules):
+    """
+    Query parameters of a knack search for the first record with the given field values
+    :param rules: dict of knack field key to value
+    """
+    filters = {
+        "match": "and",
+        "rules": [
+            {"field": field, "operator": "is", "value": value}
+            for field, value in rules.items()
+        ],
+    }
+    return {"filters": json.dumps(filters), "rows_per_page": 1}
+
+
+class KnackClient:
+    """
+    Keep-alive HTTP client for a single Knack app.
+
+    Holds one requests.Session with a connection pool sized for every request thread
+    sending KNACK_FANOUT_WIDTH calls at once, so TLS connections to api.knack.com are
+    reused across postbacks instead of being opened for every call. The session is
+    configured once here and only used for sending afterwards, which makes it safe to
+    share between threads.
+    """
+
+    def __init__(
+        self,
+        knack_app,
+        pool_size=KNACK_POOL_SIZE,
+        timeout=(KNACK_CONNECT_TIMEOUT, KNACK_READ_TIMEOUT),
+    ):
+        self.knack_app = knack_app
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size * KNACK_FANOUT_WIDTH
+        )
+        self.session = requests.Session()
+        self.session.headers.update(knack_headers(knack_app))
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.record_cache = RecordCache()
+        self.rate_limiter = TokenBucket()
+        self.write_coalescer = WriteCoalescer(self._send_put)
+        self._lock = threading.Lock()
+        self._request_count = 0
+        self._retry_count = 0
+
+    def request(self, method, object_id, record_id="", **kwargs):
+        """
+        :param method: HTTP verb
+        :param object_id: knack object id, ex: object_180
+        :param record_id: knack record id, leave empty to address the records collection
+        :return: requests.Response
+
+        Waits for the app's rate limiter before each attempt and retries rate limited
+        and server error responses with backoff, see get_retry_delay. Inside a postback
+        deadline each attempt's timeout is cut to the time left
+        :raises DeadlineExceeded: when the deadline passes before knack responded
+        """
+        timeout = kwargs.pop("timeout", self.timeout)
+        url = f"{KNACK_API_URL}{object_id}/records/{record_id}"
+        deadline = current_deadline()
+        attempt = 0
+        while True:
+            wait = self.rate_limiter.reserve()
+            try:
+                if deadline is not None:
+                    deadline.check(wait)
+                if wait:
+                    time.sleep(wait)
+                if deadline is not None:
+                    kwargs["timeout"] = deadline.cap_timeout(timeout)
+                else:
+                    kwargs["timeout"] = timeout
+            except DeadlineExceeded:
+                # the call is abandoned, leave its token to the next one
+                self.rate_limiter.release(wait)
+                raise
+            with self._lock:
+                self._request_count += 1
+            try:
+                with span(
+                    "knack",
+                    knack_app=self.knack_app,
+                    object_id=object_id,
+                    method=method,
+                    attempt=attempt,
+                    rate_limit_wait_ms=round(wait * 1000, 3),
+                ) as knack_span, time_knack_request(
+                    self.knack_app, object_id, method
+                ) as result:
+                    response = self.session.request(method, url, **kwargs)
+                    result["status_code"] = response.status_code
+                    knack_span.set(
+                        status_code=response.status_code,
+                        request_bytes=len(response.request.body or b""),
+                        response_bytes=len(response.content),
+                    )
+            except requests.Timeout as e:
+                if deadline is not None and deadline.remaining() <= 0:
+                    raise DeadlineExceeded(
+                        f"{method} {object_id} timed out at the postback deadline"
+                    ) from e
+                raise
+            delay = get_retry_delay(
+                method, response.status_code, response.headers, attempt
+            )
+            if delay is None:
+                return response
+            if deadline is not None:
+                deadline.check(delay)
+            attempt += 1
+            with self._lock:
+                self._retry_count += 1
+            response.close()
+            time.sleep(delay)
+
+    def get(self, object_id, record_id, **kwargs):
+        return self.request("GET", object_id, record_id, **kwargs)
+
+    def post(self, object_id, payload, **kwargs):
+        return self.request("POST", object_id, json=payload, **kwargs)
+
+    def _send_put(self, object_id, record_id, payload):
+        return self.request("PUT", object_id, record_id, json=payload)
+
+    def put(self, object_id, record_id, payload, **kwargs):
+        """PUTs to the same record close together are merged into one request, see WriteCoalescer"""
+        if kwargs:
+            response = self.request("PUT", object_id, record_id, json=payload, **kwargs)
+        else:
+            response = self.write_coalescer.put(object_id, record_id, payload)
+        self.record_cache.invalidate(object_id, record_id)
+        return response
+
+    def get_record(self, object_id, record_id, fields=None):
+        """
+        Reads a record through the record cache
+        :param fields: knack field keys or a RecordProjection to keep from the record, None
+            keeps the whole record. Knack always returns the full record, only the
+            projection is kept and cached
+        :return: dict of the record's (projected) fields
+        :raises requests.HTTPError: if knack doesn't return the record
+        """
+        record = self.record_cache.get(object_id, record_id, fields)
+        if record is None:
+            response = self.get(object_id, record_id)
+            response.raise_for_status()
+            record = project(loads(response.content), fields)
+            self.record_cache.set(object_id, record_id, record, fields)
+        return record
+
+    def iter_records(self, object_id, fields=None, rows_per_page=KNACK_ROWS_PER_PAGE):
+        """
+        Reads every record of an object, one page at a time. Records aren't cached
+        :param fields: knack field keys or a RecordProjection to keep from each record,
+            see get_record
+        :return: generator of (projected) records, only one page is held in memory
+        :raises requests.HTTPError: if knack doesn't return a page
+        """
+        page = 1
+        while True:
+            response = self.get(
+                object_id, "", params={"page": page, "rows_per_page": rows_per_page}
+            )
+            response.raise_for_status()
+            body = loads(response.content)
+            for record in body["records"]:
+                yield project(record, fields)
+            if page >= int(body.get("total_pages") or 0):
+                return
+            page += 1
+
+    def find_record(self, object_id, rules):
+        """
+        Searches an object with knack's filters, for a record a timed out POST may have
+        created. Records aren't cached
+        :param rules: dict of knack field key to the value the record must have
+        :return: the first matching record, or None
+        :raises requests.HTTPError: if knack doesn't answer the search
+        """
+        response = self.get(object_id, "", params=search_params(rules))
+        response.raise_for_status()
+        records = loads(response.content)["records"]
+        return records[0] if records else None
+
+    def pool_usage(self):
+        """Returns (connections in use, pool size) of the connection pool to knack"""
+        in_use = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            try:
+                pool = pools[key].pool
+            except KeyError:
+                continue
+            if pool is not None:
+                in_use += pool.maxsize - pool.qsize()
+        return in_use, self.adapter._pool_maxsize
+
+    def stats(self):
+        """Returns request and connection counts, reused = requests sent over an already open connection"""
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        for key in pools.keys():
+            try:
+                connections += pools[key].num_connections
+            except KeyError:
+                # pool was evicted between listing and lookup
+                continue
+        with self._lock:
+            request_count = self._request_count
+            retry_count = self._retry_count
+        return {
+            "knack_app": self.knack_app,
+            "requests": request_count,
+            "connections_opened": connections,
+            "connections_reused": max(request_count - connections, 0),
+            "retries": retry_count,
+            "rate_limiter": self.rate_limiter.stats(),
+            "record_cache": self.record_cache.stats(),
+            "write_coalescer": self.write_coalescer.stats(),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_knack_client(knack_app):
+    """Returns the shared KnackClient for knack_app, creating it on first use"""
+    client = _clients.get(knack_app)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(knack_app)
+            if client is None:
+                client = KnackClient(knack_app)
+                _clients[knack_app] = client
+    return client
+
+
+def knack_client_stats():
+    return [client.stats() for client in list(_clients.values())]
+
+
+def _knack_client_samples():
+    for stats in knack_client_stats():
+        for stat in ("requests", "connections_opened", "connections_reused", "retries"):
+            yield {"knack_app": stats["knack_app"], "stat": stat}, stats[stat]
+        for group in ("rate_limiter", "record_cache", "write_coalescer"):
+            for stat, value in stats[group].items():
+                yield {
+                    "knack_app": stats["knack_app"],
+                    "stat": f"{group}_{stat}",
+                }, value
+
+
+registry.register(
+    GaugeCallback(
+        "citybase_knack_client",
+        "Knack client connection reuse, retry, rate limiter, record cache and write coalescing counts",
+        _knack_client_samples,
+    )
+)
+
+
+# the first call of each fan-out runs on the request thread, the rest run here
+_executor = ThreadPoolExecutor(
+    max_workers=KNACK_POOL_SIZE * (KNACK_FANOUT_WIDTH - 1),
+    thread_name_prefix="knack-fanout",
+)
+
+
+def run_concurrently(*calls, return_exceptions=False):
+    """
+    Runs independent Knack calls at the same time and waits for all of them
+    :param calls: callables taking no arguments
+    :param return_exceptions: put exceptions in the results in place of raising them
+    :return: list of the calls' return values, in the order given
+    :raises: the first exception raised by a call, once every call has finished
+    """
+    # each call runs in a copy of this context so it sees the postback's deadline
+    futures = [
+        _executor.submit(contextvars.copy_context().run, call) for call in calls[1:]
+    ]
+    results = []
+    error = None
+    try:
+        results.append(calls[0]())
+    except Exception as e:
+        error = e
+        results.append(e)
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            error = error or e
+            results.append(e)
+    if error is not None and not return_exceptions:
+        raise error
+    return results
@@ -0,0 +1,58 @@
+from typing import NamedTuple
+
+
+class Connection(NamedTuple):
+    """One record linked through a knack connection field"""
+
+    id: str
+    identifier: str
+
+
+def decode_connections(raw):
+    """
+    :param raw: raw value of a connection field, ex: [{"id": "638e...", "identifier": "486"}]
+    :return: tuple of Connection, empty when nothing is connected or the field is missing
+    """
+    if not isinstance(raw, list):
+        return ()
+    return tuple(
+        Connection(item.get("id"), item.get("identifier"))
+        for item in raw
+        if isinstance(item, dict)
+    )
+
+
+class RecordProjection:
+    """
+    The fields of a knack record a caller reads. Plain fields keep their value, or None
+    when knack leaves them out, connection fields are decoded from their _raw form into
+    a tuple of Connection.
+
+    Knack always returns the whole record, projecting it right after it is parsed keeps
+    only these fields in memory and in the record cache. Iterating a projection yields
+    the keys of the records it returns.
+    """
+
+    __slots__ = ("fields", "connection_fields")
+
+    def __init__(self, fields=(), connection_fields=()):
+        self.fields = tuple(fields)
+        self.connection_fields = tuple(connection_fields)
+
+    def __iter__(self):
+        yield from self.fields
+        yield from self.connection_fields
+
+    def __repr__(self):
+        return f"RecordProjection(fields={self.fields!r}, connection_fields={self.connection_fields!r})"
+
+    def decode(self, record):
+        """Projects a record as returned by knack, or a record this projection already returned"""
+        projected = {field: record.get(field) for field in self.fields}
+        for field in self.connection_fields:
+            value = record.get(field)
+            if isinstance(value, tuple):
+                projected[field] = value
+            else:
+                projected[field] = decode_connections(record.get(f"{field}_raw"))
+        return projected
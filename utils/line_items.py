@@ -0,0 +1,125 @@
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+# permits of one multi-permit payment applied at the same time, each one still fans out
+# its own Knack calls
+LINE_ITEM_CONCURRENCY = int(os.getenv("LINE_ITEM_CONCURRENCY", "4"))
+# custom attributes a line item can carry for its own permit, the payment's are used
+# for the ones it doesn't and for knack_app
+PERMIT_ATTRIBUTES = (
+    "knack_record_id",
+    "invoice_number",
+    "parent_record_id",
+    "banner_type",
+)
+
+
+class Permit(NamedTuple):
+    """One permit paid for by a payment's line items"""
+
+    line_item_id: str
+    custom_attributes: dict
+    # dollars as a string, like the payment's total_amount
+    payment_amount: str
+
+
+def expand_line_items(citybase_data, custom_attributes):
+    """
+    Splits a payment whose line items pay for several permits into one Permit per
+    transaction record. Line items naming the same knack_record_id are one permit and
+    their amounts are added up. Line items without a knack_record_id are ignored. A
+    permit takes the payment's custom attributes its line item doesn't carry, the
+    permits aren't validated here, see get_permits in utils/postback.py
+    :param citybase_data: payload from citybase
+    :param custom_attributes: unpacked custom attributes of the payment
+    :return: list of Permit, empty when the line items name at most one permit, which
+        is then applied from the payment's own custom attributes as before
+    """
+    permits = {}
+    cents = {}
+    for line_item in citybase_data["data"]["line_items"]:
+        line_attributes = line_item.get("custom_attributes")
+        if not isinstance(line_attributes, dict):
+            continue
+        knack_record_id = line_attributes.get("knack_record_id")
+        if not knack_record_id:
+            continue
+        if knack_record_id not in permits:
+            permit_attributes = {"knack_app": custom_attributes.get("knack_app")}
+            for key in PERMIT_ATTRIBUTES:
+                if key in line_attributes:
+                    permit_attributes[key] = line_attributes[key]
+                elif key in custom_attributes:
+                    permit_attributes[key] = custom_attributes[key]
+            permits[knack_record_id] = (line_item.get("id"), permit_attributes)
+            cents[knack_record_id] = 0
+        # line item amounts are in pennies
+        cents[knack_record_id] += line_item.get("amount") or 0
+    if len(permits) < 2:
+        return []
+    return [
+        Permit(line_item_id, permit_attributes, f"{cents[knack_record_id] / 100:.2f}")
+        for knack_record_id, (line_item_id, permit_attributes) in permits.items()
+    ]
+
+
+_executor = ThreadPoolExecutor(
+    max_workers=LINE_ITEM_CONCURRENCY, thread_name_prefix="line-item"
+)
+
+
+def apply_permits(permits, apply):
+    """
+    Applies every permit of a payment, up to LINE_ITEM_CONCURRENCY at the same time.
+    Knack has no bulk write, so each permit sends its own calls; they run in a copy of
+    the caller's context so the postback deadline still applies.
+    :param permits: list of Permit from expand_line_items
+    :param apply: callable(permit) returning (body, status_code)
+    :return: list of (permit, response or the exception apply raised), in order
+    """
+    futures = [
+        _executor.submit(contextvars.copy_context().run, apply, permit)
+        for permit in permits
+    ]
+    results = []
+    for permit, future in zip(permits, futures):
+        try:
+            results.append((permit, future.result()))
+        except Exception as e:
+            results.append((permit, e))
+    return results
+
+
+def combine_responses(results, logger):
+    """
+    Turns the per permit results of apply_permits into the one response citybase gets.
+    Any failure fails the payment so citybase redelivers it, permits that were applied
+    are then answered from the idempotency store instead of being written again.
+    :param results: list of (permit, response or exception)
+    :param logger: logger to report failed permits to
+    :return: response body and status code to send to citybase
+    :raises Exception: the first exception a permit raised
+    """
+    error = None
+    failed_response = None
+    accepted = False
+    for permit, result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Line item {permit.line_item_id} failed: {result!r}")
+            error = error or result
+        elif result[1] >= 300:
+            logger.error(
+                f"Line item {permit.line_item_id} failed with {result[1]}: {result[0]}"
+            )
+            failed_response = failed_response or result
+        elif result[1] == 202:
+            accepted = True
+    if error is not None:
+        raise error
+    if failed_response is not None:
+        return failed_response
+    if accepted:
+        return "Payment status accepted", 202
+    return "Payment status updated", 200
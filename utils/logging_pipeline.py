@@ -0,0 +1,292 @@
+import atexit
+from datetime import datetime
+import logging
+from logging.handlers import QueueHandler
+import os
+import queue
+import sys
+import threading
+import time
+
+from utils.metrics import GaugeCallback, postback_stage_seconds, registry
+
+# where log records end up: "cloudwatch" (and stderr), "stdout", or a file path
+LOG_SINK = os.getenv("LOG_SINK", "cloudwatch")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+# payloads and records written to a log line are cut to this many characters
+LOG_VALUE_MAX_CHARS = int(os.getenv("LOG_VALUE_MAX_CHARS", "2000"))
+# keys whose values never reach the logs, citybase reports bank and card details
+LOG_REDACTED_KEYS = frozenset(
+    (
+        "bank_account",
+        "credit_card",
+        "account_number",
+        "routing_number",
+        "account_holder_name",
+        "card_number",
+    )
+)
+
+_STOP = object()
+
+
+def redact(value):
+    """Returns a copy of value with the values of LOG_REDACTED_KEYS replaced, at any depth"""
+    if isinstance(value, dict):
+        return {
+            key: (
+                "[redacted]"
+                if key in LOG_REDACTED_KEYS and item is not None
+                else redact(item)
+            )
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def format_for_log(value, limit=LOG_VALUE_MAX_CHARS):
+    """
+    Formats a payload or record for a log line, redacted and cut to limit characters.
+    Format it once per request and reuse the string rather than logging the dict.
+    """
+    text = repr(redact(value))
+    if len(text) > limit:
+        return f"{text[:limit]}... ({len(text)} characters)"
+    return text
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts log records on a bounded queue without ever blocking the calling thread.
+    When the queue is full the record is dropped and counted instead.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.enqueued = 0
+        self.dropped = 0
+        # every request thread logs through this handler
+        self._counts_lock = threading.Lock()
+
+    def emit(self, record):
+        start = time.perf_counter()
+        super().emit(record)
+        postback_stage_seconds.observe(time.perf_counter() - start, stage="logging")
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._counts_lock:
+                self.dropped += 1
+        else:
+            with self._counts_lock:
+                self.enqueued += 1
+
+    def counts(self):
+        """:return: (enqueued, dropped) records, read together"""
+        with self._counts_lock:
+            return self.enqueued, self.dropped
+
+
+class BatchingQueueListener:
+    """
+    Single background thread that takes records off the queue in batches of up to
+    batch_size, or whatever arrived within flush_interval, and hands them to the sink
+    handlers. Stream and file sinks get each batch in one write.
+
+    The sink handlers are created by create_handlers on the flusher thread, so a slow
+    CloudWatch setup delays the first log lines instead of the worker's startup.
+    """
+
+    def __init__(
+        self,
+        log_queue,
+        create_handlers,
+        queue_handler,
+        batch_size=LOG_BATCH_SIZE,
+        flush_interval=LOG_FLUSH_INTERVAL,
+    ):
+        self.queue = log_queue
+        self.create_handlers = create_handlers
+        self.handlers = []
+        self.queue_handler = queue_handler
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batches = 0
+        self.flushed = 0
+        self._reported_drops = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="log-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Flushes queued records and stops the flusher thread"""
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+    def _open_handlers(self):
+        try:
+            self.handlers = self.create_handlers()
+        except Exception as e:
+            # keep logging to stderr when the sink can't be set up, ex: missing AWS config
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            self.handlers = [handler]
+            handler.handle(
+                logging.makeLogRecord(
+                    {
+                        "name": __name__,
+                        "levelno": logging.ERROR,
+                        "levelname": "ERROR",
+                        "msg": f"Log sink {LOG_SINK} unavailable, logging to stderr: {e!r}",
+                    }
+                )
+            )
+
+    def _run(self):
+        self._open_handlers()
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                batch = [record for record in batch if record is not _STOP]
+                stopping = True
+            self._report_drops(batch)
+            if batch:
+                self._write(batch)
+
+    def _report_drops(self, batch):
+        _, dropped = self.queue_handler.counts()
+        if dropped > self._reported_drops:
+            batch.append(
+                logging.makeLogRecord(
+                    {
+                        "name": __name__,
+                        "levelno": logging.WARNING,
+                        "levelname": "WARNING",
+                        "msg": f"Log queue full, dropped {dropped - self._reported_drops} records",
+                    }
+                )
+            )
+            self._reported_drops = dropped
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            records = [record for record in batch if record.levelno >= handler.level]
+            if not records:
+                continue
+            try:
+                if isinstance(handler, logging.StreamHandler):
+                    text = "".join(
+                        handler.format(record) + handler.terminator
+                        for record in records
+                    )
+                    with handler.lock:
+                        handler.stream.write(text)
+                        handler.stream.flush()
+                else:
+                    for record in records:
+                        handler.handle(record)
+            except Exception:
+                # a failing sink must not kill the flusher
+                handler.handleError(records[-1])
+        self.batches += 1
+        self.flushed += len(batch)
+
+    def stats(self):
+        enqueued, dropped = self.queue_handler.counts()
+        return {
+            "queued": self.queue.qsize(),
+            "enqueued": enqueued,
+            "dropped": dropped,
+            "flushed": self.flushed,
+            "batches": self.batches,
+        }
+
+
+def create_sink_handlers(flask_env, sink=LOG_SINK):
+    formatter = logging.Formatter(logging.BASIC_FORMAT)
+    if sink == "cloudwatch":
+        from watchtower import CloudWatchLogHandler
+
+        cloudwatch_handler = CloudWatchLogHandler(
+            log_group_name=f"/dts/citybase/postback/{flask_env}",
+            log_stream_name=datetime.now().strftime("%Y-%m-%d"),
+        )
+        handlers = [logging.StreamHandler(), cloudwatch_handler]
+    elif sink == "stdout":
+        handlers = [logging.StreamHandler(sys.stdout)]
+    else:
+        handlers = [logging.FileHandler(sink)]
+    handlers[0].setFormatter(formatter)
+    return handlers
+
+
+log_listener = None
+
+
+def configure_logging(flask_env, level=logging.INFO):
+    """
+    Routes every log record through a bounded queue to a background flusher, so
+    logging from a request thread never waits on CloudWatch
+    :return: the started BatchingQueueListener
+    """
+    global log_listener
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+    log_listener = BatchingQueueListener(
+        log_queue, lambda: create_sink_handlers(flask_env), queue_handler
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    return log_listener
+
+
+def stop_logging():
+    """Writes out queued log records, for a worker that is about to exit"""
+    if log_listener is not None:
+        log_listener.stop()
+
+
+def _log_pipeline_samples():
+    if log_listener is None:
+        return
+    for stat, value in log_listener.stats().items():
+        yield {"stat": stat}, value
+
+
+registry.register(
+    GaugeCallback(
+        "citybase_log_pipeline",
+        "Log records queued, written and dropped by the log pipeline",
+        _log_pipeline_samples,
+    )
+)
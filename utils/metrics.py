@@ -0,0 +1,195 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# seconds, from a fast validation up to a Knack call close to its read timeout
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    labels = list(labels)
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            labels = _format_labels(zip(self.labelnames, key))
+            lines.append(f"{self.name}{labels} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        for key, counts in values:
+            label_pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                labels = _format_labels(label_pairs + [("le", bound)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(label_pairs)
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        return lines
+
+
+class GaugeCallback:
+    """Gauge whose samples are read from callback() at scrape time, as (labels dict, value) pairs"""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        for labels, value in self.callback():
+            lines.append(f"{self.name}{_format_labels(sorted(labels.items()))} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+postback_stage_seconds = registry.register(
+    Histogram(
+        "citybase_postback_stage_seconds",
+        "Time spent in each stage of handling a postback",
+        ("stage",),
+    )
+)
+postback_seconds = registry.register(
+    Histogram(
+        "citybase_postback_seconds",
+        "Time to apply a postback to Knack",
+        ("knack_app", "payment_status"),
+    )
+)
+postbacks_total = registry.register(
+    Counter(
+        "citybase_postbacks_total",
+        "Postbacks answered, by response status code",
+        ("knack_app", "payment_status", "status_code"),
+    )
+)
+knack_request_seconds = registry.register(
+    Histogram(
+        "citybase_knack_request_seconds",
+        "Duration of each request to the Knack API, retries included separately",
+        ("knack_app", "object_id", "method"),
+    )
+)
+knack_requests_total = registry.register(
+    Counter(
+        "citybase_knack_requests_total",
+        "Requests to the Knack API by response status code, 0 when no response came back",
+        ("knack_app", "object_id", "method", "status_code"),
+    )
+)
+
+# knack app -> (time.monotonic(), status code) of its last request to the Knack API, 0 when
+# no response came back, so readiness follows real traffic instead of extra probes
+last_knack_responses = {}
+
+
+@contextmanager
+def time_knack_request(knack_app, object_id, method):
+    """
+    Times one request to Knack, yields a dict the caller puts the response status code in
+    """
+    result = {"status_code": 0}
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        knack_request_seconds.observe(
+            time.perf_counter() - start,
+            knack_app=knack_app,
+            object_id=object_id,
+            method=method,
+        )
+        knack_requests_total.inc(
+            knack_app=knack_app,
+            object_id=object_id,
+            method=method,
+            status_code=result["status_code"],
+        )
+        last_knack_responses[knack_app] = (time.monotonic(), result["status_code"])
@@ -0,0 +1,272 @@
+from functools import cache
+import os
+
+from jsonschema import ValidationError
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+from utils.field_maps import FIELDS
+from utils.knack_apps import build_handlers
+from utils.knack_records import RecordProjection
+from utils.line_items import expand_line_items
+from utils.metrics import postback_stage_seconds
+from utils.schemas import payment_reporting_schema, custom_attributes_schema
+
+flask_env = os.getenv("FLASK_ENV")
+if not flask_env:
+    raise Exception("Missing defined environment variable")
+knack_env = "PRODUCTION" if flask_env == "production" else "UAT"
+# field ids of each knack app in this environment
+APP_FIELDS = {knack_app: envs[knack_env] for knack_app, envs in FIELDS.items()}
+
+# map citybase payment statuses to knack options
+payment_status_map = {
+    "successful": "PAID",
+    "voided": "VOID",
+    "refunded": "REFUND",
+}
+# object ids, fields and payload templates of each knack app, see utils/knack_apps.py
+HANDLERS = build_handlers(APP_FIELDS, payment_status_map)
+
+
+def compile_validator(schema):
+    """
+    Checks schema against its metaschema once and builds a reusable validator.
+    Validators only read their schema, so one instance is shared by every thread.
+    """
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema, format_checker=cls.FORMAT_CHECKER)
+
+
+@cache
+def get_validators():
+    """
+    Compiles the validators on first use, or ahead of time from app.warm_up
+    :return: (payment reporting validator, custom attributes validator)
+    """
+    return (
+        compile_validator(payment_reporting_schema),
+        compile_validator(custom_attributes_schema),
+    )
+
+
+def validate(instance, validator):
+    """Same as jsonschema.validate, for a validator from compile_validator"""
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+
+def unpack_custom_attributes(custom_attributes_list):
+    """
+    :param custom_attributes_list: list of dicts {"key":"key_name", "object":"value"} from citybase
+    :return: dictionary of "key_name":"value" pairs
+    """
+    custom_attributes = {}
+    for a in custom_attributes_list:
+        custom_attributes.update({a["key"]: a["value"]})
+    return custom_attributes
+
+
+def validate_postback(citybase_data, logger):
+    """
+    Validates a citybase payload and its custom attributes
+    :param citybase_data: payload from citybase
+    :param logger: logger to report validation errors to
+    :return: (custom_attributes, None) if valid, otherwise (None, (error message, status code))
+    """
+    payment_reporting_validator, custom_attributes_validator = get_validators()
+    try:
+        with postback_stage_seconds.time(stage="schema_validation"):
+            validate(citybase_data, payment_reporting_validator)
+    except ValidationError as e:
+        # str(e) holds the whole schema and payload, keep the log line short
+        logger.error(f"Validation error: {e.message} at {e.json_path}")
+        return None, (f"Validation error: {e.message}", 400)
+
+    try:
+        with postback_stage_seconds.time(stage="custom_attributes"):
+            custom_attributes = unpack_custom_attributes(
+                citybase_data["data"]["custom_attributes"]
+            )
+            validate(custom_attributes, custom_attributes_validator)
+    except ValidationError as e:
+        logger.error(f"Custom attributes error: {e.message} at {e.json_path}")
+        return None, (f"Malformed custom attributes: {e.message}", 400)
+
+    return custom_attributes, None
+
+
+def get_permits(citybase_data, custom_attributes, logger=None):
+    """
+    Splits a multi-permit payment into its permits, see expand_line_items. When a
+    permit's custom attributes don't pass the same validation as a payment's, the line
+    items aren't trusted and the payment is applied as a single permit, as it was before
+    line items were read
+    :param custom_attributes: unpacked and validated custom attributes of the payment
+    :param logger: logger to report an incomplete permit to
+    :return: list of Permit, empty to apply the payment from its own custom attributes
+    """
+    permits = expand_line_items(citybase_data, custom_attributes)
+    _, custom_attributes_validator = get_validators()
+    for permit in permits:
+        error = best_match(
+            custom_attributes_validator.iter_errors(permit.custom_attributes)
+        )
+        if error is not None:
+            if logger is not None:
+                logger.warning(
+                    f"{citybase_data['data']['id']} - Line item {permit.line_item_id} "
+                    f"custom attributes error: {error.message}, applying the payment as one permit"
+                )
+            return []
+    return permits
+
+
+def get_handler(knack_app):
+    """Returns the KnackAppHandler for knack_app"""
+    handler = HANDLERS.get(knack_app)
+    if handler is None:
+        raise ValueError(
+            f"Incorrect knack app {knack_app}, must be one of {', '.join(HANDLERS)}"
+        )
+    return handler
+
+
+def create_knack_payload(payment_status, today_date, knack_app):
+    """
+    :param payment_status: info from citybase payload
+    :param today_date: mm/dd/YYYY H:M datetime string
+    :param knack_app: SMART_MOBILITY or STREET_BANNER to select correct fields
+    :return: json object to send along with PUT call to knack
+    """
+    return get_handler(knack_app).transaction_payload(payment_status, today_date)
+
+
+def get_refund_record_fields(knack_app):
+    """Returns the RecordProjection create_refund_payload reads from the transaction record being refunded"""
+    knack_fields = APP_FIELDS[knack_app].transaction_refund
+    fields = (
+        knack_fields.customer_name,
+        knack_fields.event_name,
+        knack_fields.type,
+        knack_fields.sub_description,
+    )
+    connection_fields = (
+        knack_fields.banner_reservations_lpb,
+        knack_fields.banner_reservations_ots,
+    )
+    return RecordProjection(
+        [field for field in fields if field is not None],
+        [field for field in connection_fields if field is not None],
+    )
+
+
+REFUND_RECORD_FIELDS = {
+    knack_app: get_refund_record_fields(knack_app) for knack_app in APP_FIELDS
+}
+
+
+def create_refund_payload(
+    record_data, payment_status, payment_amount, knack_invoice, today_date, knack_app
+):
+    """
+    :param record_data: transaction record being refunded, projected with REFUND_RECORD_FIELDS
+    :param payment_status: info from citybase payload
+    :param payment_amount: string amount from citybase payload
+    :param knack_invoice: info from citybase payload
+    :param today_date: mm/dd/YYYY H:M datetime string
+    :param knack_app: SMART_MOBILITY or STREET_BANNER to select correct fields
+    :return: json object to insert into transactions table in knack
+    """
+    knack_fields = APP_FIELDS[knack_app].transaction_refund
+    transaction_fields = APP_FIELDS[knack_app].transactions
+
+    # connection fields are decoded from their raw form, the identifier of the first
+    # connected reservation is copied to the refund. None when nothing is connected
+    lpb_connections = record_data.get(knack_fields.banner_reservations_lpb) or ()
+    lpb_connection_id = lpb_connections[0].identifier if lpb_connections else None
+    ots_connections = record_data.get(knack_fields.banner_reservations_ots) or ()
+    ots_connection_id = ots_connections[0].identifier if ots_connections else None
+
+    return {
+        transaction_fields.transaction_status: payment_status_map[payment_status],
+        knack_fields.invoice_id: knack_invoice,
+        # if it is a refund, store negative amount
+        knack_fields.total_amount: f"-{payment_amount}",
+        knack_fields.created_date: today_date,
+        transaction_fields.transaction_paid_date: today_date,
+        knack_fields.customer_name: record_data.get(knack_fields.customer_name),
+        knack_fields.event_name: record_data.get(knack_fields.event_name),
+        knack_fields.type: record_data.get(knack_fields.type),
+        knack_fields.banner_reservations_lpb: lpb_connection_id,
+        knack_fields.banner_reservations_ots: ots_connection_id,
+        knack_fields.sub_description: record_data.get(knack_fields.sub_description),
+    }
+
+
+def create_message_json(
+    citybase_id, today_date, knack_invoice, payment_status, knack_app
+):
+    """
+    :param citybase_id: citybase transaction id
+    :param today_date: mm/dd/YYYY H:M datetime string
+    :param knack_invoice: info from citybase payload
+    :param payment_status: info from citybase payload
+    :param knack_app: SMART_MOBILITY or STREET_BANNER to select correct fields
+    :return: json object to insert in knack citybase_messages table
+    """
+    knack_fields = APP_FIELDS[knack_app].messages
+
+    return {
+        knack_fields.messages_invoice_id: knack_invoice,
+        knack_fields.messages_connected_invoice: knack_invoice,
+        knack_fields.messages_created_date: today_date,
+        knack_fields.messages_status: payment_status,
+        knack_fields.messages_citybase_id: citybase_id,
+    }
+
+
+def message_rules(citybase_id, payment_status, knack_invoice, knack_app):
+    """
+    Field values of the message create_message_json builds, to search for it with
+    KnackClient.find_record before writing it again
+    """
+    knack_fields = APP_FIELDS[knack_app].messages
+    return {
+        knack_fields.messages_citybase_id: citybase_id,
+        knack_fields.messages_status: payment_status,
+        knack_fields.messages_invoice_id: knack_invoice,
+    }
+
+
+def refund_rules(knack_invoice, payment_amount, today_date, knack_app):
+    """
+    Field values of the refund create_refund_payload builds, to search for it with
+    KnackClient.find_record before inserting it again. The amount and created date
+    tell it apart from an earlier partial refund of the same invoice
+    """
+    knack_fields = APP_FIELDS[knack_app].transaction_refund
+    return {
+        APP_FIELDS[knack_app].transactions.transaction_status: payment_status_map[
+            "refunded"
+        ],
+        knack_fields.invoice_id: knack_invoice,
+        knack_fields.total_amount: f"-{payment_amount}",
+        knack_fields.created_date: today_date,
+    }
+
+
+def create_parent_reservation_payloads(today_date, parent_key_value, knack_app):
+    """
+    Builds the updates for the parent reservation record in knack
+    Sets payment received status as TRUE, application as Approved and payment date as today
+    :param parent_key_value: custom attribute picking the parent record type, ex: banner_type,
+        see KnackAppHandler.get_parent_key_value
+    :return: list of (object_id, payload) pairs to PUT to the parent record
+    """
+    return [
+        (parent.object_id, parent.payload(today_date))
+        for parent in get_handler(knack_app).get_parent_reservations(parent_key_value)
+    ]
@@ -0,0 +1,123 @@
+import json
+import logging
+import os
+import time
+
+from utils.work_queue import DONE, FAILED, PENDING, WorkQueue, start_workers
+
+logger = logging.getLogger(__name__)
+
+# when set, postbacks are acknowledged with a 202 and applied to Knack in the background
+POSTBACK_QUEUE_PATH = os.getenv("POSTBACK_QUEUE_PATH")
+POSTBACK_QUEUE_WORKERS = int(os.getenv("POSTBACK_QUEUE_WORKERS", "2"))
+POSTBACK_QUEUE_MAX_ATTEMPTS = int(os.getenv("POSTBACK_QUEUE_MAX_ATTEMPTS", "5"))
+POSTBACK_QUEUE_POLL_INTERVAL = 1.0
+# completed entries are kept this long so redeliveries from citybase are still recognized
+POSTBACK_QUEUE_RETENTION_SECONDS = 30 * 24 * 60 * 60
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS postbacks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    citybase_id INTEGER NOT NULL,
+    payment_status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    received_date TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (citybase_id, payment_status)
+)
+"""
+CREATE_INDEX = (
+    "CREATE INDEX IF NOT EXISTS postbacks_state ON postbacks (state, available_at)"
+)
+
+
+class PostbackQueue(WorkQueue):
+    """
+    Durable queue of citybase postbacks stored in a SQLite database in WAL mode.
+
+    Entries are keyed by citybase payment id and status, so a payment that is paid and
+    later refunded gets two entries while a redelivery of the same event is ignored.
+    The database can be shared by every gunicorn worker process, see WorkQueue.
+    """
+
+    schema = (CREATE_TABLE, CREATE_INDEX)
+    table = "postbacks"
+    entry_name = "Queued postback"
+    max_attempts = POSTBACK_QUEUE_MAX_ATTEMPTS
+    poll_interval = POSTBACK_QUEUE_POLL_INTERVAL
+    logger = logger
+
+    def enqueue(self, citybase_data, received_date):
+        """
+        :param citybase_data: validated payload from citybase
+        :param received_date: mm/dd/YYYY H:M datetime string the postback arrived
+        :return: True if queued, False if this payment event was already queued
+        """
+        now = time.time()
+        cursor = self._connection().execute(
+            """
+            INSERT INTO postbacks (citybase_id, payment_status, payload, received_date,
+                                   state, available_at, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (citybase_id, payment_status) DO UPDATE SET
+                payload = excluded.payload,
+                state = excluded.state,
+                attempts = 0,
+                available_at = excluded.available_at,
+                updated_at = excluded.updated_at
+            WHERE postbacks.state = ?
+            """,
+            (
+                citybase_data["data"]["id"],
+                citybase_data["data"]["status"],
+                json.dumps(citybase_data),
+                received_date,
+                PENDING,
+                now,
+                now,
+                now,
+                FAILED,
+            ),
+        )
+        return cursor.rowcount > 0
+
+    def decode(self, row):
+        entry = dict(row)
+        entry["payload"] = json.loads(entry["payload"])
+        return entry
+
+    def purge_completed(self):
+        cursor = self._connection().execute(
+            "DELETE FROM postbacks WHERE state = ? AND updated_at < ?",
+            (DONE, time.time() - POSTBACK_QUEUE_RETENTION_SECONDS),
+        )
+        return cursor.rowcount
+
+    def maintain(self):
+        self.requeue_stale()
+        self.purge_completed()
+
+
+def start_queue_workers(postback_queue, handler, count=POSTBACK_QUEUE_WORKERS):
+    """
+    Starts background threads that apply queued postbacks to Knack.
+
+    :param postback_queue: PostbackQueue to drain
+    :param handler: callable(citybase_data, received_date, attempts) returning a
+        (body, status_code) tuple, attempts counts this one
+    :param count: number of worker threads
+    :return: threading.Event that stops the workers when set
+    """
+    return start_workers(
+        postback_queue,
+        lambda entry: handler(
+            entry["payload"], entry["received_date"], entry["attempts"]
+        ),
+        count,
+        "postback-queue",
+    )
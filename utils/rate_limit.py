@@ -0,0 +1,117 @@
+from email.utils import parsedate_to_datetime
+import os
+import random
+import threading
+import time
+
+# requests per second to one knack app from this process. Knack allows 10 per app,
+# so with 2 gunicorn workers each process gets half
+KNACK_RATE_LIMIT = float(os.getenv("KNACK_RATE_LIMIT", "5"))
+KNACK_RATE_BURST = int(os.getenv("KNACK_RATE_BURST", "5"))
+KNACK_MAX_RETRIES = int(os.getenv("KNACK_MAX_RETRIES", "3"))
+KNACK_RETRY_BASE_DELAY = 0.5
+KNACK_RETRY_MAX_DELAY = 10
+
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+# a 5xx may come back after knack stored the record, so only verbs that can be
+# repeated safely are retried on one. a 429 means the request was never processed
+IDEMPOTENT_METHODS = {"GET", "PUT", "DELETE"}
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every thread calling one knack app.
+
+    reserve() takes a token and returns how long the caller must wait for it, letting
+    the bucket go negative, so callers are served in order and the same bucket works
+    for threads (time.sleep) and coroutines (asyncio.sleep).
+    """
+
+    def __init__(self, rate=KNACK_RATE_LIMIT, burst=KNACK_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.waits = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.acquired = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.acquired += 1
+            if wait:
+                self.waits += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            return wait
+
+    def release(self, wait):
+        """Gives back a token from reserve() that wasn't used, wait is what reserve() returned"""
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+            self.acquired -= 1
+            if wait:
+                self.waits -= 1
+                self.total_wait -= wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            return {
+                "acquired": self.acquired,
+                "waited": self.waits,
+                "total_wait_seconds": round(self.total_wait, 3),
+                "max_wait_seconds": round(self.max_wait, 3),
+            }
+
+
+def parse_retry_after(value):
+    """Returns the delay in seconds from a Retry-After header, in seconds or HTTP date form"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_retry_delay(method, status_code, headers, attempt):
+    """
+    :param method: HTTP verb of the request
+    :param status_code: status code knack responded with
+    :param headers: response headers
+    :param attempt: number of retries already made
+    :return: seconds to wait before retrying, or None if the response should be returned as is
+    """
+    if attempt >= KNACK_MAX_RETRIES:
+        return None
+    if status_code != 429 and not (
+        status_code in RETRY_STATUS_CODES and method in IDEMPOTENT_METHODS
+    ):
+        return None
+    retry_after = parse_retry_after(headers.get("Retry-After"))
+    if retry_after is not None:
+        # spread out callers told to come back at the same moment
+        return min(retry_after, KNACK_RETRY_MAX_DELAY) + random.uniform(0, 0.25)
+    # full jitter exponential backoff
+    return random.uniform(
+        0, min(KNACK_RETRY_MAX_DELAY, KNACK_RETRY_BASE_DELAY * 2**attempt)
+    )
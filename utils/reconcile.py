@@ -0,0 +1,304 @@
+from decimal import Decimal, InvalidOperation
+
+from jsonschema import ValidationError
+
+from utils.knack_client import KNACK_ROWS_PER_PAGE
+from utils.knack_records import RecordProjection
+from utils.line_items import Permit
+from utils.postback import (
+    REFUND_RECORD_FIELDS,
+    create_knack_payload,
+    create_message_json,
+    create_refund_payload,
+    get_handler,
+    get_permits,
+    get_validators,
+    payment_status_map,
+    unpack_custom_attributes,
+    validate,
+)
+from utils.request_body import loads
+
+
+def normalize_citybase_id(value):
+    """Knack number fields come back as 70020064, 70020064.0 or "70,020,064", returns "70020064" """
+    if value is None:
+        return None
+    text = str(value).replace(",", "").strip()
+    try:
+        return str(int(float(text)))
+    except ValueError:
+        return text
+
+
+def normalize_amount(value):
+    """Knack currency fields come back as "-$1,250.00" or -1250, returns "1250.00" without the sign"""
+    if value is None:
+        return None
+    text = str(value).replace("$", "").replace(",", "").strip().lstrip("-")
+    try:
+        return f"{Decimal(text):.2f}"
+    except InvalidOperation:
+        return text
+
+
+class KnackIndex:
+    """
+    What one knack app holds about citybase payments: the (citybase id, status, invoice)
+    of every message, the status of every transaction record and the amounts of the
+    refund transactions of each invoice. Only these few values are kept, never whole
+    records, so an app with tens of thousands of records fits in a few megabytes.
+    """
+
+    __slots__ = ("handler", "messages", "transaction_statuses", "refunds")
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.messages = set()
+        self.transaction_statuses = {}
+        # invoice -> amounts of its refund transactions, an invoice can be refunded in parts
+        self.refunds = {}
+
+    def message_fields(self):
+        messages = self.handler.fields.messages
+        return (
+            messages.messages_citybase_id,
+            f"{messages.messages_citybase_id}_raw",
+            messages.messages_status,
+            messages.messages_invoice_id,
+        )
+
+    def transaction_fields(self):
+        return RecordProjection(
+            (
+                "id",
+                self.handler.fields.transactions.transaction_status,
+                self.handler.fields.transaction_refund.invoice_id,
+                self.handler.fields.transaction_refund.total_amount,
+            )
+        )
+
+    def add_message(self, record):
+        messages = self.handler.fields.messages
+        citybase_id = record.get(
+            f"{messages.messages_citybase_id}_raw",
+            record.get(messages.messages_citybase_id),
+        )
+        self.messages.add(
+            (
+                normalize_citybase_id(citybase_id),
+                record.get(messages.messages_status),
+                record.get(messages.messages_invoice_id),
+            )
+        )
+
+    def add_transaction(self, record):
+        status = record.get(self.handler.fields.transactions.transaction_status)
+        self.transaction_statuses[record["id"]] = status
+        if status == payment_status_map["refunded"]:
+            refund_fields = self.handler.fields.transaction_refund
+            self.refunds.setdefault(record.get(refund_fields.invoice_id), []).append(
+                normalize_amount(record.get(refund_fields.total_amount))
+            )
+
+
+def build_index(knack_client, handler, rows_per_page=KNACK_ROWS_PER_PAGE):
+    """
+    Streams the messages and transactions objects of handler's knack app into a KnackIndex
+    :param knack_client: KnackClient of the app
+    :param handler: KnackAppHandler of the app
+    """
+    index = KnackIndex(handler)
+    for record in knack_client.iter_records(
+        handler.messages_object_id, index.message_fields(), rows_per_page
+    ):
+        index.add_message(record)
+    for record in knack_client.iter_records(
+        handler.transactions_object_id, index.transaction_fields(), rows_per_page
+    ):
+        index.add_transaction(record)
+    return index
+
+
+def iter_payment_reports(lines):
+    """
+    Decodes a citybase export one line at a time, so it is never held in memory whole
+    :param lines: iterable of NDJSON lines, ex: an open file
+    :return: generator of (line number, payment report, or the ValueError decoding it)
+    """
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, loads(line)
+        except ValueError as e:
+            yield line_number, e
+
+
+def _mismatch(kind, line_number, report=None, permit=None, **details):
+    data = report.get("data") if isinstance(report, dict) else None
+    data = data if isinstance(data, dict) else {}
+    attributes = permit.custom_attributes if permit is not None else {}
+    return {
+        "kind": kind,
+        "line_number": line_number,
+        "citybase_id": data.get("id"),
+        "status": data.get("status"),
+        "knack_app": attributes.get("knack_app"),
+        "invoice_number": attributes.get("invoice_number"),
+        "knack_record_id": attributes.get("knack_record_id"),
+        **details,
+    }
+
+
+def reconcile(reports, indexes, today_date):
+    """
+    Compares citybase payment reports with what knack holds and yields what is missing.
+
+    Every report should have a message record per permit. A refund in an app that
+    inserts refund records should have a REFUND transaction of its amount for the
+    permit's invoice.
+    Otherwise the permit's transaction record should have the status of the latest
+    report for it, by created_at. Only the latest report per transaction record is
+    kept until the end, so memory grows with the number of permits, not of reports.
+
+    Repairs are the writes a postback would have sent. A missing refund record's repair
+    has no payload, since it needs the transaction record, see build_refund_repair.
+
+    :param reports: iterable of (line number, payment report or ValueError), see iter_payment_reports
+    :param indexes: dict of knack app to KnackIndex, reports for other apps are skipped
+    :param today_date: mm/dd/YYYY H:M datetime string used in repair payloads
+    :return: generator of mismatch dicts
+    """
+    payment_reporting_validator, custom_attributes_validator = get_validators()
+    latest = {}
+    for line_number, report in reports:
+        if isinstance(report, Exception):
+            yield _mismatch("invalid", line_number, error=str(report))
+            continue
+        try:
+            validate(report, payment_reporting_validator)
+            custom_attributes = unpack_custom_attributes(
+                report["data"]["custom_attributes"]
+            )
+            validate(custom_attributes, custom_attributes_validator)
+            permits = get_permits(report, custom_attributes)
+        except ValidationError as e:
+            yield _mismatch("invalid", line_number, report, error=e.message)
+            continue
+        data = report["data"]
+        if data["status"] not in payment_status_map:
+            yield _mismatch(
+                "invalid", line_number, report, error=f"unknown status {data['status']}"
+            )
+            continue
+        index = indexes.get(custom_attributes["knack_app"])
+        if index is None:
+            continue
+        handler = index.handler
+        citybase_id = normalize_citybase_id(data["id"])
+        if not permits:
+            permits = [Permit(None, custom_attributes, str(data["total_amount"]))]
+
+        for permit in permits:
+            knack_invoice = permit.custom_attributes["invoice_number"]
+            if (citybase_id, data["status"], knack_invoice) not in index.messages:
+                yield _mismatch(
+                    "missing_message",
+                    line_number,
+                    report,
+                    permit,
+                    repair={
+                        "method": "POST",
+                        "object_id": handler.messages_object_id,
+                        "record_id": "",
+                        "payload": create_message_json(
+                            data["id"],
+                            today_date,
+                            knack_invoice,
+                            data["status"],
+                            handler.knack_app,
+                        ),
+                    },
+                )
+            if data["status"] == "refunded" and handler.refund_creates_record:
+                refund_amounts = index.refunds.get(knack_invoice, [])
+                expected = normalize_amount(permit.payment_amount)
+                if expected not in refund_amounts:
+                    # refunds of other amounts are earlier partial refunds of the invoice
+                    details = {"expected": expected, "found": refund_amounts}
+                    yield _mismatch(
+                        "refund_amount" if refund_amounts else "missing_refund",
+                        line_number,
+                        report,
+                        permit,
+                        **(details if refund_amounts else {}),
+                        repair={
+                            "method": "POST",
+                            "object_id": handler.transactions_object_id,
+                            "record_id": "",
+                            "payload": None,
+                            "payment_amount": permit.payment_amount,
+                        },
+                    )
+                continue
+            key = (handler.knack_app, permit.custom_attributes["knack_record_id"])
+            previous = latest.get(key)
+            if previous is None or previous[0] <= data["created_at"]:
+                # keep only what the mismatch needs, not the whole report
+                summary = {"data": {"id": data["id"], "status": data["status"]}}
+                latest[key] = (data["created_at"], line_number, summary, permit)
+
+    for (knack_app, knack_record_id), (
+        _,
+        line_number,
+        report,
+        permit,
+    ) in latest.items():
+        index = indexes[knack_app]
+        status = report["data"]["status"]
+        expected = payment_status_map[status]
+        found = index.transaction_statuses.get(knack_record_id)
+        if knack_record_id not in index.transaction_statuses:
+            yield _mismatch(
+                "missing_transaction", line_number, report, permit, expected=expected
+            )
+        elif found != expected:
+            yield _mismatch(
+                "transaction_status",
+                line_number,
+                report,
+                permit,
+                expected=expected,
+                found=found,
+                repair={
+                    "method": "PUT",
+                    "object_id": index.handler.transactions_object_id,
+                    "record_id": knack_record_id,
+                    "payload": create_knack_payload(status, today_date, knack_app),
+                },
+            )
+
+
+def build_refund_repair(mismatch, knack_client, today_date, payment_amount):
+    """
+    Builds the payload of a missing_refund repair from the transaction being refunded,
+    the same way the postback does
+    :param payment_amount: the repair's payment_amount
+    :return: the repair's payload
+    """
+    knack_app = mismatch["knack_app"]
+    handler = get_handler(knack_app)
+    record_data = knack_client.get_record(
+        handler.transactions_object_id,
+        mismatch["knack_record_id"],
+        REFUND_RECORD_FIELDS[knack_app],
+    )
+    return create_refund_payload(
+        record_data,
+        mismatch["status"],
+        payment_amount,
+        mismatch["invoice_number"],
+        today_date,
+        knack_app,
+    )
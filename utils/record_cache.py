@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from utils.knack_records import RecordProjection
+
+KNACK_RECORD_CACHE_TTL = float(os.getenv("KNACK_RECORD_CACHE_TTL", "300"))
+KNACK_RECORD_CACHE_SIZE = int(os.getenv("KNACK_RECORD_CACHE_SIZE", "1000"))
+
+
+def project(record, fields):
+    """
+    Returns only the given keys of a knack record, or the whole record if fields is None
+    :param fields: iterable of keys, or a knack_records.RecordProjection
+    """
+    if fields is None:
+        return record
+    if isinstance(fields, RecordProjection):
+        return fields.decode(record)
+    return {field: record[field] for field in fields if field in record}
+
+
+class RecordCache:
+    """
+    Bounded LRU cache of knack records keyed by (object_id, record_id).
+
+    Entries expire after ttl seconds and must be invalidated whenever this process
+    writes to the record. Each entry remembers which fields it holds, so a lookup for
+    fields the cached projection doesn't include is a miss.
+    """
+
+    def __init__(self, ttl=KNACK_RECORD_CACHE_TTL, max_entries=KNACK_RECORD_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, object_id, record_id, fields=None):
+        key = (object_id, record_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, cached_fields, record = entry
+                if expires_at < time.monotonic():
+                    del self._entries[key]
+                elif cached_fields is None or (
+                    fields is not None and set(fields) <= cached_fields
+                ):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return project(record, fields)
+            self.misses += 1
+            return None
+
+    def set(self, object_id, record_id, record, fields=None):
+        key = (object_id, record_id)
+        with self._lock:
+            self._entries[key] = (
+                time.monotonic() + self.ttl,
+                None if fields is None else frozenset(fields),
+                record,
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, object_id, record_id):
+        with self._lock:
+            self._entries.pop((object_id, record_id), None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,3 +1,13 @@
+from utils.knack_apps import KNACK_APP_CONFIG
+
+# values of the banner_type custom attribute, one per street banner parent reservation
+BANNER_TYPES = [
+    key
+    for config in KNACK_APP_CONFIG.values()
+    if config["parent_key"] == "banner_type"
+    for key in config["parent_reservations"]
+]
+
 payment_reporting_schema = {
     "type": "object",
     "properties": {
@@ -126,8 +136,8 @@ custom_attributes_schema = {
         "knack_record_id": {"type": "string"},
         "invoice_number": {"type": "string"},
         "parent_record_id": {"type": "string"},
-        "banner_type": {"type": "string", "enum": ["LAMPPOST", "OVER_THE_STREET"]},
-        "knack_app": {"type": "string", "enum": ["STREET_BANNER", "SMART_MOBILITY"]},
+        "banner_type": {"type": "string", "enum": BANNER_TYPES},
+        "knack_app": {"type": "string", "enum": list(KNACK_APP_CONFIG)},
     },
     "required": ["knack_record_id", "invoice_number", "parent_record_id", "knack_app"],
 }
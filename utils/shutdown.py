@@ -0,0 +1,96 @@
+from contextlib import contextmanager
+import os
+import threading
+
+from utils.deadline import POSTBACK_DEADLINE_SECONDS, deadline
+
+# seconds postbacks in flight get to finish once a worker is told to stop, keep
+# gunicorn's graceful_timeout above this plus KNACK_READ_TIMEOUT
+SHUTDOWN_DRAIN_SECONDS = float(os.getenv("SHUTDOWN_DRAIN_SECONDS", "10"))
+
+
+class Drain:
+    """
+    Tracks the postbacks a worker is applying so it can stop without leaving one half
+    written to Knack.
+
+    Once begin() is called new postbacks are turned away, background workers are told
+    to stop, and the deadline of every postback in flight is cut to drain_seconds. A
+    postback that finishes its Knack calls in time is answered as usual. One still
+    waiting on Knack raises DeadlineExceeded before its next call and is handed to the
+    deadline queue or the dead letters, which resume it after the restart.
+    """
+
+    def __init__(self, drain_seconds=SHUTDOWN_DRAIN_SECONDS):
+        self.drain_seconds = drain_seconds
+        self.stopping = False
+        self._deadlines = set()
+        self._requests = 0
+        self._stop_callbacks = []
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    @contextmanager
+    def track(self, seconds=POSTBACK_DEADLINE_SECONDS, background=False):
+        """
+        Runs the block under deadline(seconds), cut short if the worker starts stopping
+        :param background: True for queue and dead letter workers, which aren't counted
+            as busy request threads
+        """
+        with deadline(seconds) as current:
+            with self._lock:
+                if self.stopping:
+                    current.shorten(self.drain_seconds)
+                self._deadlines.add(current)
+                if not background:
+                    self._requests += 1
+            try:
+                yield current
+            finally:
+                with self._lock:
+                    self._deadlines.discard(current)
+                    if not background:
+                        self._requests -= 1
+                    if not self._deadlines:
+                        self._idle.notify_all()
+
+    def on_stop(self, callback):
+        """Registers a callable run by begin(), ex: the set method of a worker's stop event"""
+        self._stop_callbacks.append(callback)
+
+    def begin(self):
+        """
+        Starts stopping the worker. Safe to call from a signal handler, it only takes
+        the drain's own lock and doesn't log
+        :return: number of postbacks in flight
+        """
+        with self._lock:
+            if self.stopping:
+                return len(self._deadlines)
+            self.stopping = True
+            for current in self._deadlines:
+                current.shorten(self.drain_seconds)
+            in_flight = len(self._deadlines)
+        for callback in self._stop_callbacks:
+            callback()
+        return in_flight
+
+    def wait(self, timeout=None):
+        """
+        Waits for the postbacks in flight to finish
+        :return: number still in flight after timeout, 0 once drained
+        """
+        with self._idle:
+            self._idle.wait_for(lambda: not self._deadlines, timeout)
+            return len(self._deadlines)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._deadlines)
+
+    def requests_in_flight(self):
+        """Number of postbacks being applied by request threads"""
+        return self._requests
+
+
+drain = Drain()
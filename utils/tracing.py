@@ -0,0 +1,241 @@
+from collections import deque
+from contextlib import contextmanager
+import contextvars
+from datetime import datetime
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+# share of postbacks traced, from 0 (none) to 1 (every one)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+# where finished traces go, comma separated: ring (kept in memory for
+# /admin/traces), file (appended to TRACE_FILE_PATH as NDJSON) or none
+TRACE_EXPORTERS = os.getenv("TRACE_EXPORTERS", "ring")
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "500"))
+TRACE_FILE_PATH = os.getenv("TRACE_FILE_PATH", "traces.ndjson")
+
+
+class Span:
+    """
+    One timed step of a traced postback, ex: a Knack call. attributes describe the step,
+    set them with set() so code that isn't traced can call it on the no-op span too
+    """
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "duration", "attributes")
+
+    def __init__(self, name, parent_id, attributes):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attributes):
+        pass
+
+
+# yielded instead of a Span when the postback isn't sampled
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """A root span and every span started under it, in any thread"""
+
+    __slots__ = ("trace_id", "started_at", "root", "spans")
+
+    def __init__(self, name, attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.started_at = datetime.now().isoformat()
+        self.root = Span(name, None, attributes)
+        # appended to from the threads of run_concurrently, list.append is thread safe
+        self.spans = []
+
+    def to_dict(self):
+        root = self.root
+        return {
+            "trace_id": self.trace_id,
+            "name": root.name,
+            "started_at": self.started_at,
+            "pid": os.getpid(),
+            "duration_ms": _milliseconds(root.duration),
+            "attributes": root.attributes,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    # from the start of the trace
+                    "offset_ms": _milliseconds(span.start - root.start),
+                    "duration_ms": _milliseconds(span.duration),
+                    "attributes": span.attributes,
+                }
+                for span in self.spans
+            ],
+        }
+
+
+def _milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class RingBufferExporter:
+    """Keeps the last size traces of this worker in memory, see /admin/traces"""
+
+    def __init__(self, size=TRACE_RING_SIZE):
+        self._traces = deque(maxlen=size)
+
+    def export(self, trace):
+        self._traces.append(trace)
+
+    def recent(self, limit=None):
+        """:return: list of trace dicts, newest first"""
+        traces = list(self._traces)
+        traces.reverse()
+        return [trace.to_dict() for trace in traces[:limit]]
+
+
+class FileExporter:
+    """
+    Appends each trace to path as one line of JSON. Every gunicorn worker appends to the
+    same file, each trace is written whole in a single write so lines don't interleave
+    """
+
+    def __init__(self, path=TRACE_FILE_PATH):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, trace):
+        line = json.dumps(trace.to_dict(), default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                # opened by the worker that writes first, not inherited over a fork
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def make_exporters(names=TRACE_EXPORTERS):
+    """
+    :param names: comma separated exporter names, see TRACE_EXPORTERS
+    :return: list of exporters
+    """
+    factories = {"ring": RingBufferExporter, "file": FileExporter}
+    exporters = []
+    for name in names.split(","):
+        name = name.strip()
+        if not name or name == "none":
+            continue
+        if name not in factories:
+            raise ValueError(f"Unknown trace exporter {name}, use ring, file or none")
+        exporters.append(factories[name]())
+    return exporters
+
+
+class Tracer:
+    """
+    Samples postbacks and hands each finished trace to every exporter. An exporter is
+    any object with an export(trace) method
+    """
+
+    def __init__(self, sample_rate=TRACE_SAMPLE_RATE, exporters=None):
+        self.sample_rate = sample_rate
+        self.exporters = make_exporters() if exporters is None else exporters
+
+    def find_exporter(self, exporter_type):
+        """Returns the first exporter of exporter_type, or None"""
+        for exporter in self.exporters:
+            if isinstance(exporter, exporter_type):
+                return exporter
+        return None
+
+    def sampled(self):
+        return self.exporters and random.random() < self.sample_rate
+
+    def export(self, trace):
+        for exporter in self.exporters:
+            exporter.export(trace)
+
+
+tracer = Tracer()
+
+# (trace, span) of the step being run, None outside of a sampled trace
+_current = contextvars.ContextVar("trace_span", default=None)
+
+
+def current_span():
+    """Returns the span being run, or NOOP_SPAN outside of a sampled trace"""
+    current = _current.get()
+    return NOOP_SPAN if current is None else current[1]
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """
+    Traces the block if the postback is sampled, yields its root span, or NOOP_SPAN.
+    Inside a trace already, the block is a span of that trace instead. The trace is
+    exported once the block exits; an exception is recorded as the root's error
+    """
+    if _current.get() is not None:
+        with span(name, **attributes) as child:
+            yield child
+        return
+    if not tracer.sampled():
+        yield NOOP_SPAN
+        return
+    trace = Trace(name, attributes)
+    token = _current.set((trace, trace.root))
+    try:
+        yield trace.root
+    except BaseException as e:
+        trace.root.set(error=repr(e))
+        raise
+    finally:
+        _current.reset(token)
+        trace.root.finish()
+        tracer.export(trace)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the block as a child of the current span, yields it, or NOOP_SPAN outside of a
+    sampled trace. Threads started by run_concurrently and asyncio tasks inherit the
+    current span
+    """
+    current = _current.get()
+    if current is None:
+        yield NOOP_SPAN
+        return
+    trace, parent = current
+    child = Span(name, parent.span_id, attributes)
+    trace.spans.append(child)
+    token = _current.set((trace, child))
+    try:
+        yield child
+    except BaseException as e:
+        child.set(error=repr(e))
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
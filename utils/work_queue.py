@@ -0,0 +1,190 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+PENDING = "pending"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+class SqliteStore:
+    """
+    SQLite database in WAL mode, which can be shared by every gunicorn worker process.
+    Subclasses list the statements creating their tables in schema
+    """
+
+    schema = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self.schema:
+            conn.execute(statement)
+
+    def _connection(self):
+        # sqlite connections can't be shared across threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class WorkQueue(SqliteStore):
+    """
+    Table of entries applied by background threads, see start_workers.
+
+    Entries are pending until claimed, processing while a thread applies them, then done,
+    or pending again with a backoff until they run out of attempts and are failed.
+    Claims are made inside an immediate transaction so an entry is only handed to one
+    thread of one worker process. The table needs the columns id, citybase_id, state,
+    attempts, available_at, last_error and updated_at.
+    """
+
+    table = None
+    # used in log lines, ex: Queued postback
+    entry_name = "Entry"
+    max_attempts = 5
+    # a processing entry that hasn't been touched in this long belongs to a worker that died
+    stale_seconds = 300
+    poll_interval = 1.0
+    logger = logging.getLogger(__name__)
+
+    def backoff(self, attempts):
+        """Seconds before an entry that failed its attempts-th attempt is due again"""
+        return min(2**attempts, 300)
+
+    def describe(self, entry):
+        """Names entry in log lines"""
+        return f"{entry['citybase_id']} - {self.entry_name}"
+
+    def decode(self, row):
+        """Turns a row into the entry handed to the workers"""
+        return dict(row)
+
+    def claim(self):
+        """Marks the oldest entry due as processing and returns it, or None if there is none"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT * FROM {self.table} WHERE state = ? AND available_at <= ? ORDER BY id LIMIT 1",
+                (PENDING, now),
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    f"UPDATE {self.table} SET state = ?, attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                    (PROCESSING, now, row["id"]),
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        entry = self.decode(row)
+        entry["attempts"] += 1
+        return entry
+
+    def complete(self, entry_id):
+        self._connection().execute(
+            f"UPDATE {self.table} SET state = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+            (DONE, time.time(), entry_id),
+        )
+
+    def fail(self, entry, error):
+        """Puts the entry back with a backoff, or marks it failed once out of attempts"""
+        now = time.time()
+        if entry["attempts"] >= self.max_attempts:
+            state, available_at = FAILED, now
+        else:
+            state, available_at = PENDING, now + self.backoff(entry["attempts"])
+        self._connection().execute(
+            f"UPDATE {self.table} SET state = ?, available_at = ?, last_error = ?, updated_at = ? WHERE id = ?",
+            (state, available_at, str(error), now, entry["id"]),
+        )
+        return state
+
+    def requeue_stale(self):
+        """Returns entries left in processing by a worker that exited mid-entry"""
+        now = time.time()
+        cursor = self._connection().execute(
+            f"UPDATE {self.table} SET state = ?, available_at = ?, updated_at = ? WHERE state = ? AND updated_at < ?",
+            (PENDING, now, now, PROCESSING, now - self.stale_seconds),
+        )
+        return cursor.rowcount
+
+    def maintain(self):
+        """Housekeeping run by the workers about once a minute"""
+        self.requeue_stale()
+
+    def counts(self):
+        """Returns the number of entries per state"""
+        rows = (
+            self._connection()
+            .execute(
+                f"SELECT state, COUNT(*) AS count FROM {self.table} GROUP BY state"
+            )
+            .fetchall()
+        )
+        return {row["state"]: row["count"] for row in rows}
+
+
+def _work(work_queue, handler, stop_event):
+    last_maintenance = 0
+    while not stop_event.is_set():
+        if time.monotonic() - last_maintenance > 60:
+            work_queue.maintain()
+            last_maintenance = time.monotonic()
+
+        entry = work_queue.claim()
+        if entry is None:
+            stop_event.wait(work_queue.poll_interval)
+            continue
+
+        name = work_queue.describe(entry)
+        try:
+            body, status_code = handler(entry)
+        except Exception as e:
+            work_queue.logger.exception(f"{name} raised an error")
+            body, status_code = repr(e), None
+
+        if status_code is not None and status_code < 300:
+            work_queue.complete(entry["id"])
+            work_queue.logger.info(f"{name} applied: {body}")
+        else:
+            state = work_queue.fail(entry, f"{status_code}: {body}")
+            work_queue.logger.error(
+                f"{name} attempt {entry['attempts']} failed, now {state}: {body}"
+            )
+
+
+def start_workers(work_queue, handler, count, thread_name):
+    """
+    Starts background threads that apply the entries of a WorkQueue
+
+    :param handler: callable(entry) that applies one entry and returns a (body, status_code) tuple
+    :param count: number of threads
+    :param thread_name: prefix of the threads' names
+    :return: threading.Event that stops the threads when set
+    """
+    stop_event = threading.Event()
+    for i in range(count):
+        threading.Thread(
+            target=_work,
+            args=(work_queue, handler, stop_event),
+            name=f"{thread_name}-{i}",
+            daemon=True,
+        ).start()
+    return stop_event
@@ -0,0 +1,175 @@
+import asyncio
+import os
+import threading
+
+from utils.deadline import current_deadline, latest_deadline, use_deadline
+
+# merge PUTs to a record that arrive while another PUT to it is being sent
+KNACK_WRITE_COALESCE = os.getenv("KNACK_WRITE_COALESCE", "false").lower() == "true"
+
+# when merged writes set a field to different transaction statuses, the later status in
+# this list wins regardless of arrival order, so a refund is never overwritten by a payment
+PAYMENT_STATUS_PRECEDENCE = {"PAID": 0, "VOID": 1, "REFUND": 2}
+
+
+def merge_payload(merged, payload, precedence=PAYMENT_STATUS_PRECEDENCE):
+    """
+    Merges payload into merged in place, the last writer wins per field
+    :param merged: payload of the writes merged so far
+    :param payload: payload of the newest write
+    :param precedence: rank of each status value, a lower ranked status never replaces a higher one
+    """
+    for field, value in payload.items():
+        current = merged.get(field)
+        if (
+            current in precedence
+            and value in precedence
+            and precedence[value] < precedence[current]
+        ):
+            continue
+        merged[field] = value
+    return merged
+
+
+class _PendingWrite:
+    __slots__ = ("payload", "done", "deadlines", "response", "error")
+
+    def __init__(self, payload, done):
+        self.payload = dict(payload)
+        self.done = done
+        # of every caller merged in, the request is sent under the latest one
+        self.deadlines = [current_deadline()]
+        self.response = None
+        self.error = None
+
+
+class WriteCoalescer:
+    """
+    Merges PUTs to the same knack record into a single request while an earlier PUT to
+    it is being sent.
+
+    A PUT to a record nothing is being sent to goes out at once. PUTs that arrive while
+    it is in flight are merged into one pending write, sent by the first of them once
+    the earlier request finished. Every merged caller gets the same response (or
+    exception) back. The merged request is sent under the latest deadline of its
+    callers, so one caller running out of time doesn't fail the others.
+    """
+
+    def __init__(
+        self,
+        send,
+        enabled=KNACK_WRITE_COALESCE,
+        precedence=PAYMENT_STATUS_PRECEDENCE,
+    ):
+        """
+        :param send: callable(object_id, record_id, payload) that sends one PUT
+        """
+        self.send = send
+        self.enabled = enabled
+        self.precedence = precedence
+        self.submitted = 0
+        self.sent = 0
+        # key -> write being sent
+        self._in_flight = {}
+        # key -> write waiting for the one in flight, others merge into it
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key, payload, create_done):
+        """
+        Adds payload to the write waiting for key, or starts a new one
+        :return: (write, True if the caller sends it, the write in flight to wait for first)
+        """
+        with self._lock:
+            self.submitted += 1
+            pending = self._pending.get(key)
+            if pending is not None:
+                merge_payload(pending.payload, payload, self.precedence)
+                pending.deadlines.append(current_deadline())
+                return pending, False, None
+            pending = _PendingWrite(payload, create_done())
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self._in_flight[key] = pending
+            else:
+                self._pending[key] = pending
+            return pending, True, in_flight
+
+    def _take(self, key):
+        """Stops merging into the write waiting for key, it is sent next"""
+        with self._lock:
+            pending = self._in_flight[key] = self._pending.pop(key)
+            return pending
+
+    def _finish(self, key, pending):
+        with self._lock:
+            self.sent += 1
+            if self._in_flight.get(key) is pending:
+                del self._in_flight[key]
+
+    def put(self, object_id, record_id, payload):
+        if not self.enabled:
+            with self._lock:
+                self.submitted += 1
+                self.sent += 1
+            return self.send(object_id, record_id, payload)
+
+        key = (object_id, record_id)
+        pending, first, in_flight = self._join(key, payload, threading.Event)
+        if first:
+            if in_flight is not None:
+                in_flight.done.wait()
+                self._take(key)
+            try:
+                with use_deadline(latest_deadline(pending.deadlines)):
+                    pending.response = self.send(object_id, record_id, pending.payload)
+            except Exception as e:
+                pending.error = e
+            finally:
+                self._finish(key, pending)
+                pending.done.set()
+        else:
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.response
+
+    def stats(self):
+        with self._lock:
+            return {"submitted": self.submitted, "sent": self.sent}
+
+
+class AsyncWriteCoalescer(WriteCoalescer):
+    """WriteCoalescer for a coroutine send, all callers must share one event loop"""
+
+    async def put(self, object_id, record_id, payload):
+        if not self.enabled:
+            with self._lock:
+                self.submitted += 1
+                self.sent += 1
+            return await self.send(object_id, record_id, payload)
+
+        key = (object_id, record_id)
+        pending, first, in_flight = self._join(key, payload, asyncio.Event)
+        if first:
+            try:
+                if in_flight is not None:
+                    try:
+                        await in_flight.done.wait()
+                    finally:
+                        self._take(key)
+                with use_deadline(latest_deadline(pending.deadlines)):
+                    pending.response = await self.send(
+                        object_id, record_id, pending.payload
+                    )
+            except BaseException as e:
+                # a cancelled first caller fails the callers waiting on it too
+                pending.error = e
+            finally:
+                self._finish(key, pending)
+                pending.done.set()
+        else:
+            await pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.response